@@ -0,0 +1,7 @@
+"""
+Lab operations scripts behind a single labops command.
+
+Kept free of imports so that starting labops stays fast.
+"""
+
+__version__ = '0.1.0'
@@ -0,0 +1,3 @@
+from labops.cli import main
+
+main()
@@ -0,0 +1,141 @@
+"""
+Run the lab operations scripts as labops subcommands.
+
+    labops <command> [args]
+
+A command's script is only read when the command runs, so starting labops
+costs little more than starting Python. Scripts come from the installed
+package, from a zipapp built by build-zipapp, or from the repository.
+"""
+
+import os
+import sys
+
+COMMANDS = {
+    'setup': ('setup.sh', 'Set up conda, the lab repositories and ssh'),
+    'profiles': ('setup_snakemake_profiles.py', 'Install Snakemake profiles'),
+    'benchmarks': ('smk_benchmarks.py',
+                   'Track Snakemake rule benchmarks across runs'),
+    'screenshare': ('screenshare_tunnel.py',
+                    'Connect to, list and stop screenshare tunnels'),
+    'screenshare-client': ('screenshare_client.py',
+                           'Add a screenshare host on this computer'),
+    'screenshare-host': ('screenshare_host.py',
+                         'Allow screensharing to this Mac'),
+    'glances': ('glance_minerva', 'Monitor a Minerva node with Glances'),
+    'sshfs': ('prep_sshfs.sh', 'Install the mc and mu sshfs mount commands'),
+    'ssh-keeper': ('ssh_keeper.py',
+                   'Keep a logged-in ssh connection open for all scripts'),
+    'build-zipapp': (None, 'Build a single-file labops.pyz'),
+}
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_data(*parts):
+    """
+    Read a file shipped with labops.
+
+    Files are looked up in the labops package first, then next to it. Scripts
+    are in labops/scripts when installed or in a zipapp, and in scripts next
+    to labops in the repository.
+
+    Returns:
+        tuple: The path the file was read from and its contents as bytes.
+    """
+    for base in [HERE, os.path.dirname(HERE)]:
+        path = os.path.join(base, *parts)
+        try:
+            # Works inside a zipapp too
+            return path, __loader__.get_data(path)
+        except OSError:
+            continue
+    sys.exit(f'labops: {os.path.join(*parts)} is missing from this install')
+
+
+def run_script(name, args, env=None):
+    """Run a bundled script with args and exit with its status."""
+    path, source = read_data('scripts', name)
+    if name.endswith('.py'):
+        sys.argv = [path, *args]
+        globs = {'__name__': '__main__', '__file__': path}
+        exec(compile(source, path, 'exec'), globs)
+        sys.exit(0)
+    import subprocess
+    # bash -c so that scripts inside a zipapp need not be extracted
+    r = subprocess.run(['bash', '-c', source.decode(), name, *args], env=env)
+    sys.exit(r.returncode)
+
+
+def setup(args):
+    """Run setup.sh with setup.py and labops.util from this install."""
+    import shutil
+    import tempfile
+    src = tempfile.mkdtemp(prefix='labops_setup_')
+    try:
+        # setup.sh copies these instead of downloading them
+        files = {('scripts', 'setup.py'): read_data('scripts', 'setup.py'),
+                 ('labops', '__init__.py'): read_data('__init__.py'),
+                 ('labops', 'util.py'): read_data('util.py')}
+        for (sub, name), (_, data) in files.items():
+            os.makedirs(os.path.join(src, sub), exist_ok=True)
+            with open(os.path.join(src, sub, name), 'wb') as f:
+                f.write(data)
+        run_script('setup.sh', args, env={**os.environ, 'LABOPS_SRC': src})
+    finally:
+        shutil.rmtree(src)
+
+
+def build_zipapp(args):
+    """Build labops and its scripts into one executable zip file."""
+    import shutil
+    import zipapp
+    import tempfile
+    target = os.path.abspath(args[0] if args else os.path.expanduser(
+        '~/.cache/labops/labops.pyz'))
+    root = os.path.dirname(HERE)
+    with tempfile.TemporaryDirectory() as staging:
+        shutil.copytree(HERE, os.path.join(staging, 'labops'),
+                        ignore=shutil.ignore_patterns('__pycache__'))
+        scripts = os.path.join(staging, 'labops', 'scripts')
+        if not os.path.isdir(scripts):
+            shutil.copytree(os.path.join(root, 'scripts'), scripts,
+                            ignore=shutil.ignore_patterns('__pycache__',
+                                                          '*.zip'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        zipapp.create_archive(staging, target,
+                              interpreter='/usr/bin/env python3',
+                              main='labops.cli:main', compressed=True)
+    print(f'Built {target}')
+
+
+def usage():
+    width = max(len(c) for c in COMMANDS)
+    lines = [f'  {c:<{width}}  {d}' for c, (_, d) in COMMANDS.items()]
+    return ('usage: labops <command> [args]\n\n' + __doc__.strip().split(
+        '\n\n')[-1] + '\n\ncommands:\n' + '\n'.join(lines) +
+        '\n\nRun labops <command> --help for the options of a command.')
+
+
+def main():
+    args = sys.argv[1:]
+    if not args or args[0] in ['-h', '--help']:
+        print(usage())
+        return
+    if args[0] == '--version':
+        from labops import __version__
+        print(f'labops {__version__}')
+        return
+    command, rest = args[0], args[1:]
+    if command not in COMMANDS:
+        sys.exit(f'labops: unknown command {command}\n\n{usage()}')
+    if command == 'setup':
+        setup(rest)
+    elif command == 'build-zipapp':
+        build_zipapp(rest)
+    else:
+        run_script(COMMANDS[command][0], rest)
+
+
+if __name__ == '__main__':
+    main()
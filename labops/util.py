@@ -0,0 +1,70 @@
+"""
+Path, directory and size helpers shared by the lab operations scripts.
+"""
+
+import os
+import re
+import pathlib
+
+
+# From pythoncircle.com
+def octal_to_string(octal):
+    octal = int(f'{octal:o}')
+    result = ''
+    value_letters = [(4,'r'),(2,'w'),(1,'x')]
+    # Iterate over each of the digits in octal
+    for digit in [int(n) for n in str(octal)]:
+        # Check for each of the permissions values
+        for value, letter in value_letters:
+            if digit >= value:
+                result += letter
+                digit -= value
+            else:
+                result += '-'
+    return result
+
+
+def nicepath(path, *args):
+    if type(path) in [str, pathlib.PosixPath]:
+        path = [path]
+    if args:
+        path += args
+    return os.path.join(*[os.path.normpath(x) for x in path])
+
+
+def mkdir(path, *args, **kwargs):
+    if type(path) in [str, pathlib.PosixPath]:
+        path = [path]
+    if args:
+        path += args
+    path = nicepath(path)
+    mkdirkwargs = {k: v for k, v in kwargs.items() if k != 'fixperms'}
+    valid_modes = [0o500, 0o510, 0o511, 0o550, 0o551, 0o555,
+                   0o700, 0o710, 0o711, 0o750, 0o751, 0o755,
+                   0o770, 0o771, 0o775, 0o777]
+
+    setmode = False
+    if 'mode' in kwargs.keys():
+        err = 'Bad mode for folder: {}'.format(octal_to_string(kwargs['mode']))
+        assert kwargs['mode'] in valid_modes, err
+        setmode = True
+
+    if not os.path.exists(path):
+        os.makedirs(path, **mkdirkwargs)
+    elif 'fixperms' in kwargs.keys() and kwargs['fixperms'] is True:
+        assert setmode is True, 'Mode not specified'
+        os.chmod(path, kwargs['mode'])
+
+
+def human(size):
+    for unit in ['B', 'K', 'M', 'G', 'T']:
+        if abs(size) < 1024 or unit == 'T':
+            return f'{size:.1f}{unit}' if unit != 'B' else f'{size}B'
+        size /= 1024
+
+
+def parse_size(text):
+    """Parse a size such as 500G or 1.5T into bytes."""
+    m = re.fullmatch(r'\s*([\d.]+)\s*([BKMGT]?)i?B?\s*', text.upper())
+    assert m, f'Cannot read size {text!r}, use e.g. 500G or 2T'
+    return int(float(m.group(1)) * 1024 ** 'BKMGT'.index(m.group(2) or 'B'))
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+"""
+Index file metadata on Minerva so trees can be searched without sshfs.
+
+On Minerva, build walks the given trees into a sqlite index of path, size,
+mtime and owner. Later builds only list directories whose mtime changed
+since the last build; unchanged directories are descended using the
+subdirectories already in the index. Run it from cron or as a batch job:
+
+    bsub -P acc_LOAD -q premium -W 4:00 -n 1 -R rusage[mem=4000] \\
+      fsindex.py build /sc/arion/projects/load
+
+On your computer, sync copies the index over ssh, after which find, du and
+newest answer from the local copy.
+
+Files modified in place do not change the mtime of their directory, so
+their size and mtime are only refreshed by build --full.
+"""
+
+import os
+import sys
+import pwd
+import time
+import sqlite3
+import argparse
+import subprocess
+
+try:
+    from labops.util import human
+except ImportError:
+    # Run from a checkout, also through a symlink in ~/local/scripts
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.realpath(__file__))))
+    from labops.util import human
+
+DB_CLUSTER = os.path.expanduser('~/.fsindex/index.sqlite')
+DB_LOCAL = os.path.expanduser('~/.cache/lab_operations/fsindex.sqlite')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY, mtime REAL, scanned REAL);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, dir TEXT, name TEXT, size INTEGER, mtime REAL,
+    uid INTEGER, is_dir INTEGER);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime);
+CREATE TABLE IF NOT EXISTS owners (uid INTEGER PRIMARY KEY, owner TEXT);
+'''
+
+
+def prefix_range(path):
+    """Bounds selecting every path below a directory using the primary key."""
+    path = path.rstrip('/')
+    return path + '/', path + '0'  # '0' sorts right after '/'
+
+
+def scan_dir(db, path, st, stats):
+    """Replace the index entries for one directory with its current contents."""
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                est = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            entries.append((entry.path, path, entry.name, est.st_size,
+                            est.st_mtime, est.st_uid,
+                            int(entry.is_dir(follow_symlinks=False))))
+    old_dirs = {r[0] for r in db.execute(
+        'SELECT path FROM files WHERE dir = ? AND is_dir = 1', (path,))}
+    new_dirs = {e[0] for e in entries if e[6]}
+    for gone in old_dirs - new_dirs:
+        lo, hi = prefix_range(gone)
+        db.execute('DELETE FROM files WHERE path >= ? AND path < ?', (lo, hi))
+        db.execute('DELETE FROM dirs WHERE path = ? OR '
+                   '(path >= ? AND path < ?)', (gone, lo, hi))
+    db.execute('DELETE FROM files WHERE dir = ?', (path,))
+    db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', entries)
+    db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+               (path, st.st_mtime, time.time()))
+    stats['scanned'] += 1
+    return sorted(new_dirs)
+
+
+def build(args):
+    os.makedirs(os.path.dirname(args.db), exist_ok=True)
+    db = sqlite3.connect(args.db)
+    db.executescript(SCHEMA)
+    stats = {'scanned': 0, 'skipped': 0}
+    t0 = time.time()
+    for root in args.roots:
+        stack = [os.path.abspath(root)]
+        while stack:
+            path = stack.pop()
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            row = db.execute('SELECT mtime FROM dirs WHERE path = ?',
+                             (path,)).fetchone()
+            if args.full or row is None or row[0] != st.st_mtime:
+                try:
+                    subdirs = scan_dir(db, path, st, stats)
+                except PermissionError:
+                    continue
+            else:
+                subdirs = [r[0] for r in db.execute(
+                    'SELECT path FROM files WHERE dir = ? AND is_dir = 1',
+                    (path,))]
+                stats['skipped'] += 1
+            stack.extend(subdirs)
+            if stats['scanned'] % 1000 == 999:
+                db.commit()
+    for (uid,) in db.execute('SELECT DISTINCT uid FROM files').fetchall():
+        try:
+            name = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            name = str(uid)
+        db.execute('INSERT OR REPLACE INTO owners VALUES (?, ?)', (uid, name))
+    db.commit()
+
+    # Compact copy that is never half-written, for sync to fetch
+    export = args.db.replace('.sqlite', '') + '.export.sqlite'
+    if os.path.exists(export + '.tmp'):
+        os.remove(export + '.tmp')
+    db.execute('VACUUM INTO ?', (export + '.tmp',))
+    db.close()
+    os.replace(export + '.tmp', export)
+    print(f'Listed {stats["scanned"]} directories, reused {stats["skipped"]} '
+          f'unchanged ones in {time.time() - t0:.0f}s')
+
+
+def sync(args):
+    remote = DB_CLUSTER.replace(os.path.expanduser('~') + '/', '')
+    remote = args.remote_db or remote.replace('.sqlite', '.export.sqlite')
+    os.makedirs(os.path.dirname(args.db), exist_ok=True)
+    tmp = args.db + '.tmp'
+    cmd = ['rsync', '-z', '--inplace', f'{args.host}:{remote}', tmp]
+    if subprocess.run(['which', 'rsync'], capture_output=True).returncode:
+        cmd = ['scp', '-C', f'{args.host}:{remote}', tmp]
+    if os.path.exists(args.db) and not os.path.exists(tmp):
+        # rsync only sends the changed blocks of the previous copy
+        subprocess.run(['cp', args.db, tmp], check=True)
+    subprocess.run(cmd, check=True)
+    os.replace(tmp, args.db)
+    print(f'Index saved to {args.db}')
+
+
+def connect(args):
+    assert os.path.exists(args.db), \
+        f'No index at {args.db}. Run fsindex.py sync or build first.'
+    return sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
+
+
+def under(args):
+    """SQL condition and parameters restricting results to --under."""
+    if not args.under:
+        return '1', ()
+    return 'path >= ? AND path < ?', prefix_range(args.under)
+
+
+def find(args):
+    db = connect(args)
+    cond, params = under(args)
+    rows = db.execute(
+        f'SELECT path, size, mtime FROM files WHERE name GLOB ? AND {cond} '
+        'LIMIT ?', (args.pattern, *params, args.limit))
+    for path, size, mtime in rows:
+        print(f'{human(size):>8}  '
+              f'{time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime))}  '
+              f'{path}')
+
+
+def du(args):
+    db = connect(args)
+    root = args.path.rstrip('/')
+    lo, hi = prefix_range(root)
+    depth = root.count('/') + args.depth
+    rows = db.execute(
+        'SELECT path, size FROM files WHERE path >= ? AND path < ? '
+        'AND is_dir = 0', (lo, hi))
+    totals = {}
+    for path, size in rows:
+        key = '/'.join(path.split('/')[:depth + 1])
+        totals[key] = totals.get(key, 0) + size
+    for key, size in sorted(totals.items(), key=lambda kv: -kv[1]):
+        print(f'{human(size):>8}  {key}')
+    print(f'{human(sum(totals.values())):>8}  {root} (total)')
+
+
+def newest(args):
+    db = connect(args)
+    cond, params = under(args)
+    rows = db.execute(
+        'SELECT path, size, mtime, COALESCE(owner, uid) FROM files '
+        f'LEFT JOIN owners USING (uid) WHERE is_dir = 0 AND {cond} '
+        'ORDER BY mtime DESC LIMIT ?', (*params, args.limit))
+    for path, size, mtime, owner in rows:
+        print(f'{time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime))}  '
+              f'{owner:<10}  {human(size):>8}  {path}')
+
+
+if __name__ == '__main__':
+    db_default = DB_CLUSTER if os.path.exists(DB_CLUSTER) else DB_LOCAL
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.strip().split('\n')[2:]))
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_build = sub.add_parser('build', help='Build or update the index '
+                             '(on Minerva)')
+    p_build.add_argument('roots', nargs='+', help='Trees to index, e.g. '
+                         '/sc/arion/projects/load')
+    p_build.add_argument('--full', action='store_true',
+                         help='Rescan every directory')
+    p_build.set_defaults(func=build, db=DB_CLUSTER)
+
+    p_sync = sub.add_parser('sync', help='Copy the index from Minerva')
+    p_sync.add_argument('--host', default='minerva',
+                        help='SSH host (default: minerva)')
+    p_sync.add_argument('--remote-db', help='Index to copy (default: '
+                        '~/.fsindex/index.export.sqlite on the host)')
+    p_sync.set_defaults(func=sync, db=DB_LOCAL)
+
+    p_find = sub.add_parser('find', help='Find files by name')
+    p_find.add_argument('pattern', help='Glob on the file name, e.g. '
+                        '"*.vcf.gz"')
+    p_find.set_defaults(func=find)
+
+    p_du = sub.add_parser('du', help='Disk usage below a directory')
+    p_du.add_argument('path')
+    p_du.add_argument('--depth', type=int, default=1,
+                      help='Levels to break down (default: 1)')
+    p_du.set_defaults(func=du)
+
+    p_new = sub.add_parser('newest', help='Most recently modified files')
+    p_new.set_defaults(func=newest)
+
+    for p in [p_find, p_new]:
+        p.add_argument('--under', help='Only paths below this directory')
+        p.add_argument('-n', '--limit', type=int, default=20,
+                       help='Maximum results (default: 20)')
+    for p in [p_find, p_du, p_new]:
+        p.set_defaults(db=db_default)
+    for p in [p_build, p_sync, p_find, p_du, p_new]:
+        p.add_argument('--db', type=os.path.abspath, help='Index file')
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except (AssertionError, subprocess.CalledProcessError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+
+"""
+Record node metrics into a fixed-size ring buffer on disk and export them.
+
+The ring buffer is a single memory-mapped file. A small header holds the
+number of samples written so far and the metadata; the samples are stored
+column by column as float64 so a time window can be read without touching
+the other columns. Once the buffer is full the oldest samples are
+overwritten.
+
+Samples come from a running Glances server (--url) or directly from /proc.
+The ring buffer needs numpy.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import datetime
+import urllib.request
+
+MAGIC = b'GLNCRING'
+HEADER_SIZE = 4096
+COLUMNS = ['time', 'job_id', 'cpu_pct', 'load1', 'load5', 'load15',
+           'mem_used', 'mem_pct', 'swap_pct', 'net_rx_bps', 'net_tx_bps',
+           'disk_read_bps', 'disk_write_bps']
+
+
+class RingBuffer:
+    """
+    Columnar ring buffer of float64 samples backed by a memory-mapped file.
+
+    Args:
+        path (str): The file holding the buffer.
+        capacity (int, optional): Number of samples to keep. Only used when
+            the file is created.
+        node (str, optional): Node name stored in the header on creation.
+    """
+
+    def __init__(self, path, capacity=None, node=None):
+        import numpy as np
+        self.path = path
+        if not os.path.exists(path):
+            assert capacity, 'Capacity needed to create a ring buffer'
+            self._create(capacity, node)
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        assert header[:8] == MAGIC, f'{path} is not a glances ring buffer'
+        self.capacity = int(np.frombuffer(header, '<u8', 1, 16)[0])
+        self.meta = json.loads(header[24:].rstrip(b'\0'))
+        assert self.meta['columns'] == COLUMNS, \
+            f'{path} was written with different columns'
+        self._count = np.memmap(path, '<u8', 'r+', 8, (1,))
+        self.data = np.memmap(path, '<f8', 'r+', HEADER_SIZE,
+                              (len(COLUMNS), self.capacity))
+
+    def _create(self, capacity, node):
+        import numpy as np
+        meta = {'columns': COLUMNS, 'node': node,
+                'created': time.time()}
+        meta = json.dumps(meta).encode()
+        assert len(meta) <= HEADER_SIZE - 24, 'Metadata too long'
+        header = (MAGIC + np.array([0, capacity], '<u8').tobytes()
+                  + meta.ljust(HEADER_SIZE - 24, b'\0'))
+        with open(self.path, 'wb') as f:
+            f.write(header)
+            f.truncate(HEADER_SIZE + 8 * len(COLUMNS) * capacity)
+
+    @property
+    def count(self):
+        return int(self._count[0])
+
+    def append(self, sample):
+        """
+        Write one sample, overwriting the oldest if the buffer is full.
+
+        Args:
+            sample (dict): Values keyed by column name. Missing columns are
+                stored as NaN.
+        """
+        import numpy as np
+        i = self.count % self.capacity
+        self.data[:, i] = [sample.get(c, np.nan) for c in COLUMNS]
+        # Bump the count only after the row is complete
+        self._count[0] = self.count + 1
+        self._count.flush()
+
+    def window(self, start=None, end=None, job_id=None):
+        """
+        Return the samples in a time window in chronological order.
+
+        Args:
+            start (float, optional): First epoch time to include.
+            end (float, optional): Last epoch time to include.
+            job_id (int, optional): Only include samples tagged with this job.
+
+        Returns:
+            dict: Column name to numpy array.
+        """
+        import numpy as np
+        n = min(self.count, self.capacity)
+        first = self.count % self.capacity if self.count > self.capacity else 0
+        order = (np.arange(n) + first) % self.capacity
+        times = self.data[0, order]
+        keep = np.ones(n, bool)
+        if start is not None:
+            keep &= times >= start
+        if end is not None:
+            keep &= times <= end
+        if job_id is not None:
+            keep &= self.data[1, order] == job_id
+        idx = order[keep]
+        return {c: np.asarray(self.data[j, idx]) for j, c in enumerate(COLUMNS)}
+
+
+class ProcSampler:
+    """Sample node counters from /proc, computing rates between calls."""
+
+    def __init__(self):
+        self.prev = None
+
+    @staticmethod
+    def _counters():
+        with open('/proc/stat') as f:
+            cpu = [int(x) for x in f.readline().split()[1:]]
+        net_rx = net_tx = 0
+        with open('/proc/net/dev') as f:
+            for line in f.readlines()[2:]:
+                iface, stats = line.split(':', 1)
+                if iface.strip() == 'lo':
+                    continue
+                stats = stats.split()
+                net_rx += int(stats[0])
+                net_tx += int(stats[8])
+        disks = set(os.listdir('/sys/block'))
+        disk_r = disk_w = 0
+        with open('/proc/diskstats') as f:
+            for line in f:
+                fields = line.split()
+                if fields[2] in disks:
+                    disk_r += int(fields[5]) * 512
+                    disk_w += int(fields[9]) * 512
+        return {'time': time.time(), 'cpu_busy': sum(cpu) - sum(cpu[3:5]),
+                'cpu_total': sum(cpu), 'net_rx': net_rx, 'net_tx': net_tx,
+                'disk_r': disk_r, 'disk_w': disk_w}
+
+    def sample(self):
+        now = self._counters()
+        with open('/proc/loadavg') as f:
+            load = [float(x) for x in f.read().split()[:3]]
+        mem = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                key, val = line.split(':')
+                mem[key] = int(val.split()[0]) * 1024
+        mem_used = mem['MemTotal'] - mem['MemAvailable']
+        swap_used = mem['SwapTotal'] - mem['SwapFree']
+        sample = {'time': now['time'], 'load1': load[0], 'load5': load[1],
+                  'load15': load[2], 'mem_used': mem_used,
+                  'mem_pct': 100 * mem_used / mem['MemTotal'],
+                  'swap_pct': (100 * swap_used / mem['SwapTotal']
+                               if mem['SwapTotal'] else 0)}
+        if self.prev is not None:
+            dt = now['time'] - self.prev['time']
+            dcpu = now['cpu_total'] - self.prev['cpu_total']
+            if dcpu > 0:
+                sample['cpu_pct'] = (100 * (now['cpu_busy'] -
+                                            self.prev['cpu_busy']) / dcpu)
+            for key, col in [('net_rx', 'net_rx_bps'), ('net_tx', 'net_tx_bps'),
+                             ('disk_r', 'disk_read_bps'),
+                             ('disk_w', 'disk_write_bps')]:
+                sample[col] = (now[key] - self.prev[key]) / dt
+        self.prev = now
+        return sample
+
+
+class GlancesSampler:
+    """
+    Sample node metrics from the REST API of a running Glances server.
+
+    Args:
+        url (str): Base URL of the server, e.g. http://localhost:61208
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.api = None
+        for version in [4, 3]:
+            try:
+                self._get(f'/api/{version}/pluginslist')
+            except OSError:
+                continue
+            self.api = f'/api/{version}'
+            break
+        assert self.api, f'No Glances API found at {url}'
+
+    def _get(self, endpoint):
+        with urllib.request.urlopen(self.url + endpoint, timeout=10) as r:
+            return json.load(r)
+
+    def _plugin(self, name):
+        try:
+            return self._get(f'{self.api}/{name}')
+        except OSError:
+            # Plugin disabled or server restarting
+            return None
+
+    @staticmethod
+    def _rate(entries, v4_key, v3_key):
+        total = 0
+        for e in entries:
+            if v4_key in e:
+                total += e[v4_key]
+            elif e.get('time_since_update'):
+                total += e[v3_key] / e['time_since_update']
+        return total
+
+    def sample(self):
+        sample = {'time': time.time()}
+        cpu = self._plugin('cpu')
+        if cpu:
+            sample['cpu_pct'] = cpu['total']
+        load = self._plugin('load')
+        if load:
+            sample.update({'load1': load['min1'], 'load5': load['min5'],
+                           'load15': load['min15']})
+        mem = self._plugin('mem')
+        if mem:
+            sample.update({'mem_used': mem['used'], 'mem_pct': mem['percent']})
+        swap = self._plugin('memswap')
+        if swap:
+            sample['swap_pct'] = swap['percent']
+        net = self._plugin('network')
+        if net:
+            net = [e for e in net if e.get('interface_name') != 'lo']
+            sample['net_rx_bps'] = self._rate(net, 'bytes_recv_rate_per_sec',
+                                              'rx')
+            sample['net_tx_bps'] = self._rate(net, 'bytes_sent_rate_per_sec',
+                                              'tx')
+        disk = self._plugin('diskio')
+        if disk:
+            sample['disk_read_bps'] = self._rate(disk, 'read_bytes_rate_per_sec',
+                                                 'read_bytes')
+            sample['disk_write_bps'] = self._rate(disk,
+                                                  'write_bytes_rate_per_sec',
+                                                  'write_bytes')
+        return sample
+
+
+def parse_time(value):
+    """Parse epoch seconds or an ISO 8601 local date and time."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def default_file(node):
+    return os.path.expanduser(
+        f'~/minerva_jobs/glances/glances_{node}.ring')
+
+
+def record(args):
+    ring = RingBuffer(args.file, capacity=args.capacity, node=args.node)
+    sampler = GlancesSampler(args.url) if args.url else ProcSampler()
+    print(f'Recording {args.node} to {args.file} every {args.interval}s '
+          f'({ring.capacity} samples kept)')
+    stop = time.time() + args.duration if args.duration else None
+    while stop is None or time.time() < stop:
+        sample = sampler.sample()
+        sample['job_id'] = args.job
+        ring.append(sample)
+        time.sleep(args.interval)
+
+
+def read_window(args):
+    ring = RingBuffer(args.file)
+    data = ring.window(parse_time(args.start), parse_time(args.end), args.job)
+    return ring.meta['node'], data
+
+
+def export(args):
+    import numpy as np
+    node, data = read_window(args)
+    n = len(data['time'])
+    if args.output and args.output.endswith('.parquet'):
+        try:
+            import pandas as pd
+        except ModuleNotFoundError:
+            print('Python package \'pandas\' (with pyarrow) is needed for '
+                  'Parquet export.')
+            sys.exit(1)
+        df = pd.DataFrame(data)
+        df.insert(0, 'node', node)
+        df.to_parquet(args.output, index=False)
+    else:
+        out = open(args.output, 'w') if args.output else sys.stdout
+        out.write(','.join(['node'] + COLUMNS) + '\n')
+        for i in range(n):
+            row = [node] + ['' if np.isnan(data[c][i])
+                            else f'{data[c][i]:.15g}' for c in COLUMNS]
+            out.write(','.join(row) + '\n')
+        if args.output:
+            out.close()
+    print(f'Exported {n} samples', file=sys.stderr)
+
+
+def plot(args):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ModuleNotFoundError:
+        print('Python package \'matplotlib\' is needed for plotting.')
+        sys.exit(1)
+    node, data = read_window(args)
+    assert len(data['time']) > 0, 'No samples in the selected window'
+    times = [datetime.datetime.fromtimestamp(t) for t in data['time']]
+    fig, axes = plt.subplots(len(args.columns), 1, sharex=True,
+                             figsize=(10, 2.5 * len(args.columns)),
+                             squeeze=False)
+    for ax, col in zip(axes[:, 0], args.columns):
+        ax.plot(times, data[col])
+        ax.set_ylabel(col)
+    title = node if args.job is None else f'{node} job {args.job:.0f}'
+    axes[0, 0].set_title(title)
+    fig.autofmt_xdate()
+    fig.savefig(args.output, bbox_inches='tight')
+    print(f'Saved plot to {args.output}')
+
+
+if __name__ == '__main__':
+    node = socket.gethostname().split('.')[0]
+    job = os.environ.get('LSB_JOBID')
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_rec = sub.add_parser('record', help='Sample metrics into the buffer')
+    p_rec.add_argument('--url', help='Glances server to sample. Reads /proc '
+                       'directly if not given.')
+    p_rec.add_argument('--interval', type=float, default=5,
+                       help='Seconds between samples (default: 5)')
+    p_rec.add_argument('--capacity', type=int, default=100000,
+                       help='Samples to keep when creating the buffer '
+                       '(default: 100000)')
+    p_rec.add_argument('--duration', type=float,
+                       help='Stop after this many seconds')
+    p_rec.add_argument('--job', type=float, default=float(job or 'nan'),
+                       help='LSF job ID to tag samples with '
+                       '(default: $LSB_JOBID)')
+    p_rec.set_defaults(func=record)
+
+    p_exp = sub.add_parser('export', help='Export a time window as CSV or '
+                           'Parquet')
+    p_exp.add_argument('-o', '--output', help='Output file. Parquet if it '
+                       'ends in .parquet, CSV otherwise (default: stdout)')
+    p_exp.set_defaults(func=export)
+
+    p_plot = sub.add_parser('plot', help='Plot a time window')
+    p_plot.add_argument('-o', '--output', default='glances_record.png',
+                        help='Image file (default: glances_record.png)')
+    p_plot.add_argument('--columns', nargs='+',
+                        default=['cpu_pct', 'load1', 'mem_pct'],
+                        choices=COLUMNS[2:], help='Metrics to plot')
+    p_plot.set_defaults(func=plot)
+
+    for p in [p_exp, p_plot]:
+        p.add_argument('--start', help='Start of the window, as epoch seconds '
+                       'or YYYY-MM-DDTHH:MM[:SS]')
+        p.add_argument('--end', help='End of the window')
+        p.add_argument('--job', type=float, help='Only samples from this job')
+    for p in [p_rec, p_exp, p_plot]:
+        p.add_argument('--node', default=node,
+                       help='Node the metrics are from (default: this node)')
+        p.add_argument('--file', help='Ring buffer file (default: '
+                       '~/minerva_jobs/glances/glances_<node>.ring)')
+
+    args = parser.parse_args()
+    if args.file is None:
+        args.file = default_file(args.node)
+    os.makedirs(os.path.dirname(os.path.abspath(args.file)), exist_ok=True)
+    try:
+        args.func(args)
+    except ModuleNotFoundError as e:
+        print(f'Python package \'{e.name}\' is needed for the ring buffer.',
+              file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+"""
+Index the LSF and Snakemake logs of a workflow to find failed jobs fast.
+
+Run it in the workflow directory. It reads the LSF job reports in the job
+logs of the lsf profile (logs/cluster) and of the Snakemake 8 LSF executor
+(.snakemake/lsf_logs), and the errors in .snakemake/log, into
+.snakemake/joblog_index.sqlite. Each query first reads only what was
+appended to the logs since the last one, so it also works while the
+workflow is running:
+
+    joblog_index.py failed
+    joblog_index.py oom
+    joblog_index.py top-mem -n 20
+    joblog_index.py rule bwa_mem
+
+Queries print the LSF job ID, rule, how the job ended, the maximum and
+requested memory, and the run time, followed by the log file.
+"""
+
+import os
+import re
+import sys
+import time
+import sqlite3
+import argparse
+
+DB = os.path.join('.snakemake', 'joblog_index.sqlite')
+JOB_LOGS = ['logs/cluster', '.snakemake/lsf_logs']
+SNAKEMAKE_LOGS = os.path.join('.snakemake', 'log')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, size INTEGER, mtime REAL, offset INTEGER,
+    state TEXT);
+CREATE TABLE IF NOT EXISTS jobs (
+    lsf_id INTEGER PRIMARY KEY, rule TEXT, name TEXT, log TEXT,
+    status TEXT, reason TEXT, exit_code INTEGER, max_mem_mb REAL,
+    req_mem_mb REAL, run_s REAL, cpu_s REAL, finished REAL);
+CREATE INDEX IF NOT EXISTS jobs_rule ON jobs (rule);
+CREATE TABLE IF NOT EXISTS errors (
+    log TEXT, offset INTEGER, rule TEXT, jobid INTEGER, lsf_id INTEGER,
+    message TEXT, PRIMARY KEY (log, offset));
+CREATE INDEX IF NOT EXISTS errors_lsf_id ON errors (lsf_id);
+'''
+
+REPORT = [
+    (re.compile(r'^Subject: Job (\d+): <(.*)> in cluster'), 'subject'),
+    (re.compile(r'^Successfully completed\.'), 'done'),
+    (re.compile(r'^(TERM_\w+):'), 'reason'),
+    (re.compile(r'^Exited with exit code (\d+)'), 'exit_code'),
+    (re.compile(r'^Exited with signal termination: (\w+)'), 'signal'),
+    (re.compile(r'^Terminated at (.+)'), 'finished'),
+    (re.compile(r'^\s+Max Memory :\s+([\d.]+) (\w+)'), 'max_mem_mb'),
+    (re.compile(r'^\s+Total Requested Memory :\s+([\d.]+) (\w+)'),
+     'req_mem_mb'),
+    (re.compile(r'^\s+Run time :\s+([\d.]+) sec'), 'run_s'),
+    (re.compile(r'^\s+CPU time :\s+([\d.]+) sec'), 'cpu_s')]
+
+MB = {'KB': 1 / 1024, 'MB': 1, 'GB': 1024, 'TB': 1024 ** 2}
+
+
+def rule_from_path(path):
+    """Rule name from the job log directory layout of either profile."""
+    parts = path.split('/')
+    for root in JOB_LOGS:
+        depth = root.count('/') + 1
+        if parts[:depth] == root.split('/') and len(parts) > depth + 1:
+            rule = parts[depth]
+            return rule[5:] if rule.startswith('rule_') else rule
+    return None
+
+
+def parse_report(lines, path, job, db):
+    """
+    Add the LSF job report lines of a job log to the index.
+
+    Args:
+        lines (list): Complete lines appended to the log.
+        path (str): The log file.
+        job (str): LSF job ID whose report the previous lines were in.
+        db (sqlite3.Connection): The index.
+
+    Returns:
+        str: LSF job ID of the report the last line is in.
+    """
+    for line in lines:
+        for pattern, field in REPORT:
+            m = pattern.match(line)
+            if not m:
+                continue
+            if field == 'subject':
+                job = m.group(1)
+                name = m.group(2)
+                rule = rule_from_path(path) or name.split('.')[0]
+                db.execute('INSERT OR IGNORE INTO jobs (lsf_id, rule, name, '
+                           'log) VALUES (?, ?, ?, ?)', (job, rule, name, path))
+            elif job is None:
+                break
+            elif field == 'done':
+                db.execute("UPDATE jobs SET status = 'done', exit_code = 0 "
+                           'WHERE lsf_id = ?', (job,))
+            elif field == 'reason':
+                db.execute("UPDATE jobs SET status = 'exit', reason = ? "
+                           'WHERE lsf_id = ?', (m.group(1), job))
+            elif field == 'exit_code':
+                db.execute("UPDATE jobs SET status = 'exit', exit_code = ?, "
+                           'reason = COALESCE(reason, ?) WHERE lsf_id = ?',
+                           (int(m.group(1)), f'exit {m.group(1)}', job))
+            elif field == 'signal':
+                db.execute("UPDATE jobs SET status = 'exit', "
+                           'reason = COALESCE(reason, ?) WHERE lsf_id = ?',
+                           (m.group(1), job))
+            elif field == 'finished':
+                try:
+                    t = time.mktime(time.strptime(m.group(1).strip(),
+                                                  '%a %b %d %H:%M:%S %Y'))
+                except ValueError:
+                    t = None
+                db.execute('UPDATE jobs SET finished = ? WHERE lsf_id = ?',
+                           (t, job))
+            elif field in ['max_mem_mb', 'req_mem_mb']:
+                value = float(m.group(1)) * MB.get(m.group(2).upper(), 1)
+                db.execute(f'UPDATE jobs SET {field} = ? WHERE lsf_id = ?',
+                           (value, job))
+            else:
+                db.execute(f'UPDATE jobs SET {field} = ? WHERE lsf_id = ?',
+                           (float(m.group(1)), job))
+            break
+    return job
+
+
+def parse_snakemake_log(lines, path, state, db):
+    """
+    Add the errors in a Snakemake log to the index.
+
+    An error starts with "Error in rule NAME:" and is followed by indented
+    details, including the Snakemake job ID and the LSF job ID.
+
+    Args:
+        lines (list): Complete lines appended to the log, with the offset
+            of each in the file.
+        path (str): The log file.
+        state (str): Offset of the error the previous lines were in.
+        db (sqlite3.Connection): The index.
+
+    Returns:
+        str: Offset of the error the last line is in, if any.
+    """
+    current = int(state) if state else None
+    for n, line in lines:
+        m = re.match(r'Error in rule (\S+):', line)
+        if m:
+            current = n
+            db.execute('INSERT OR REPLACE INTO errors (log, offset, rule, '
+                       'message) VALUES (?, ?, ?, ?)',
+                       (path, n, m.group(1), line.strip()))
+            continue
+        if current is None:
+            continue
+        if line.strip() and not line[0].isspace():
+            current = None
+            continue
+        m = re.match(r'\s+jobid: (\d+)', line)
+        if m:
+            db.execute('UPDATE errors SET jobid = ? WHERE log = ? AND '
+                       'offset = ?', (int(m.group(1)), path, current))
+        m = re.match(r"\s+(?:cluster_jobid|external_jobid): '?(\d+)", line) \
+            or re.search(r"LSF-?job '?(\d+)", line)
+        if m:
+            db.execute('UPDATE errors SET lsf_id = ? WHERE log = ? AND '
+                       'offset = ?', (int(m.group(1)), path, current))
+        if re.match(r'\s+message:', line):
+            db.execute('UPDATE errors SET message = ? WHERE log = ? AND '
+                       'offset = ?', (line.strip(), path, current))
+    return str(current) if current is not None else None
+
+
+def log_files():
+    for root in JOB_LOGS:
+        for dirpath, _, names in os.walk(root):
+            for name in names:
+                if name.endswith(('.out', '.log')):
+                    yield os.path.join(dirpath, name), 'job'
+    if os.path.isdir(SNAKEMAKE_LOGS):
+        for name in sorted(os.listdir(SNAKEMAKE_LOGS)):
+            if name.endswith('.log'):
+                yield os.path.join(SNAKEMAKE_LOGS, name), 'snakemake'
+
+
+def update(args):
+    """Read what was added to the logs since the last update."""
+    os.makedirs(os.path.dirname(args.db), exist_ok=True)
+    db = sqlite3.connect(args.db)
+    db.executescript(SCHEMA)
+    known = {r[0]: r[1:] for r in db.execute(
+        'SELECT path, size, mtime, offset, state FROM files')}
+    stats = {'read': 0, 'skipped': 0, 'bytes': 0}
+    for path, kind in log_files():
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        size, mtime, offset, state = known.get(path, (0, 0, 0, None))
+        if (size, mtime) == (st.st_size, st.st_mtime):
+            stats['skipped'] += 1
+            continue
+        if st.st_size < offset:
+            offset, state = 0, None  # rewritten
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(st.st_size - offset)
+        # Leave a partly written last line for the next update
+        data = data[:data.rfind(b'\n') + 1]
+        if offset == 0 and kind == 'snakemake':
+            db.execute('DELETE FROM errors WHERE log = ?', (path,))
+        lines = [line.decode(errors='replace')
+                 for line in data.split(b'\n')[:-1]]
+        if kind == 'job':
+            state = parse_report(lines, path, state, db)
+        else:
+            starts = [offset]
+            for line in data.split(b'\n')[:-1]:
+                starts.append(starts[-1] + len(line) + 1)
+            state = parse_snakemake_log(list(zip(starts, lines)), path,
+                                        state, db)
+        offset += len(data)
+        db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                   (path, st.st_size, st.st_mtime, offset, state))
+        stats['read'] += 1
+        stats['bytes'] += len(data)
+    db.commit()
+    if not args.quiet:
+        print(f'Read {stats["bytes"] / 1e6:.1f} MB from {stats["read"]} '
+              f'changed logs, skipped {stats["skipped"]} unchanged',
+              file=sys.stderr)
+    return db
+
+
+def gigabytes(mb):
+    return f'{mb / 1024:.1f}G' if mb is not None else '-'
+
+
+def print_jobs(rows):
+    print(f'{"LSF job":>10}  {"Rule":<24} {"Ended":<16} {"Max mem":>9} '
+          f'{"Req mem":>9} {"Run time":>9}  Log')
+    for lsf_id, rule, status, reason, max_mem, req_mem, run_s, log in rows:
+        ended = reason or status or 'running'
+        runtime = f'{run_s / 60:.1f}m' if run_s is not None else '-'
+        print(f'{lsf_id:>10}  {rule or "?":<24} {ended:<16} '
+              f'{gigabytes(max_mem):>9} {gigabytes(req_mem):>9} {runtime:>9}  {log}')
+
+
+JOB_COLUMNS = ('lsf_id, rule, status, reason, max_mem_mb, req_mem_mb, run_s, '
+               'log')
+
+
+def failed(args):
+    db = update(args)
+    print_jobs(db.execute(
+        f"SELECT {JOB_COLUMNS} FROM jobs WHERE status = 'exit' "
+        'ORDER BY finished DESC LIMIT ?', (args.limit,)))
+    errors = db.execute(
+        'SELECT errors.rule, jobid, errors.lsf_id, message FROM errors '
+        'LEFT JOIN jobs USING (lsf_id) WHERE jobs.lsf_id IS NULL '
+        'OR jobs.status IS NOT \'exit\' LIMIT ?', (args.limit,)).fetchall()
+    if errors:
+        print('\nErrors in the Snakemake logs without a failed LSF report:')
+        for rule, jobid, lsf_id, message in errors:
+            print(f'  {rule} (job {jobid}, LSF {lsf_id or "?"}): {message}')
+
+
+def termination(reason):
+    def query(args):
+        db = update(args)
+        print_jobs(db.execute(
+            f'SELECT {JOB_COLUMNS} FROM jobs WHERE reason = ? '
+            'ORDER BY finished DESC LIMIT ?', (reason, args.limit)))
+    return query
+
+
+def top_mem(args):
+    db = update(args)
+    print_jobs(db.execute(
+        f'SELECT {JOB_COLUMNS} FROM jobs WHERE max_mem_mb IS NOT NULL '
+        'ORDER BY max_mem_mb DESC LIMIT ?', (args.limit,)))
+
+
+def rule(args):
+    db = update(args)
+    if args.name:
+        print_jobs(db.execute(
+            f'SELECT {JOB_COLUMNS} FROM jobs WHERE rule = ? '
+            'ORDER BY finished DESC LIMIT ?', (args.name, args.limit)))
+        return
+    print(f'{"Rule":<24} {"Jobs":>6} {"Done":>6} {"Failed":>6} {"OOM":>5} '
+          f'{"Runlim":>6} {"Max mem":>9} {"Req mem":>9} {"Max time":>9}')
+    for r in db.execute(
+            "SELECT rule, COUNT(*), SUM(status = 'done'), "
+            "SUM(status = 'exit'), SUM(reason = 'TERM_MEMLIMIT'), "
+            "SUM(reason = 'TERM_RUNLIMIT'), MAX(max_mem_mb), "
+            'MAX(req_mem_mb), MAX(run_s) FROM jobs GROUP BY rule '
+            'ORDER BY SUM(status = \'exit\') DESC, rule'):
+        name, n, done, fail, oom, runlim, mem, req, run_s = r
+        print(f'{name or "?":<24} {n:>6} {done or 0:>6} {fail or 0:>6} '
+              f'{oom or 0:>5} {runlim or 0:>6} {gigabytes(mem):>9} '
+              f'{gigabytes(req):>9} '
+              f'{(run_s or 0) / 60:>8.1f}m')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.strip().split('\n')[2:]))
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_update = sub.add_parser('update', help='Only update the index')
+    p_update.set_defaults(func=update)
+    p_failed = sub.add_parser('failed', help='Jobs that did not complete')
+    p_failed.set_defaults(func=failed)
+    p_oom = sub.add_parser('oom', help='Jobs killed at their memory limit')
+    p_oom.set_defaults(func=termination('TERM_MEMLIMIT'))
+    p_run = sub.add_parser('runlimit', help='Jobs killed at their run time '
+                           'limit')
+    p_run.set_defaults(func=termination('TERM_RUNLIMIT'))
+    p_mem = sub.add_parser('top-mem', help='Jobs using the most memory')
+    p_mem.set_defaults(func=top_mem)
+    p_rule = sub.add_parser('rule', help='Summary per rule, or the jobs of '
+                            'one rule')
+    p_rule.add_argument('name', nargs='?', help='Rule to list jobs for')
+    p_rule.set_defaults(func=rule)
+
+    queries = [p_failed, p_oom, p_run, p_mem, p_rule]
+    for p in queries:
+        p.add_argument('-n', '--limit', type=int, default=50,
+                       help='Maximum jobs to list (default: 50)')
+    for p in [p_update] + queries:
+        p.add_argument('--db', default=DB, type=os.path.abspath,
+                       help=f'Index file (default: {DB})')
+        p.add_argument('-q', '--quiet', action='store_true',
+                       help='Do not report what was read')
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except AssertionError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+"""
+Copy files between your computer and Minerva over several parallel streams.
+
+The files are split into chunks of about equal total size, and each chunk
+is sent by its own rsync. Interrupted files are kept and resumed, and the
+whole file checksum is verified after resuming. Exactly one of source and
+destination is remote, written as host:path:
+
+    mtransfer.py copy results/ minerva:/sc/arion/projects/load/results
+    mtransfer.py copy minerva:/sc/arion/projects/load/gwas/sumstats sumstats
+
+By default all streams share the ControlMaster connection in
+~/.ssh/cm_socket that setup.py configures, so you only authenticate once.
+With --no-mux every stream opens its own connection. That is usually faster
+over high latency links, but each connection asks for your password and
+token.
+
+selftest copies a generated tree to and from a local sshd, interrupts and
+resumes one file, and checks every checksum.
+"""
+
+import os
+import re
+import sys
+import time
+import heapq
+import shlex
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+SOCKDIR = os.path.expanduser('~/.ssh/cm_socket')
+CONTROLPATH = os.path.join(SOCKDIR, '%r@%h:%p')
+
+
+def split_remote(spec):
+    """Split host:path into (host, path); host is None for local paths."""
+    host, sep, path = spec.partition(':')
+    if not sep or '/' in host or os.path.exists(spec):
+        return None, spec
+    return host, path
+
+
+def ssh_command(args):
+    if args.no_mux:
+        return ['ssh', '-o', 'ControlMaster=no', '-o', 'ControlPath=none']
+    return ['ssh', '-o', f'ControlPath={CONTROLPATH}',
+            '-o', 'ControlMaster=auto', '-o', 'ControlPersist=5m']
+
+
+def list_local(path):
+    """
+    List the files to send from a local path.
+
+    Returns:
+        tuple: The base directory and a list of (size, path relative to it).
+    """
+    path = os.path.abspath(path)
+    if os.path.isfile(path):
+        return os.path.dirname(path), [(os.path.getsize(path),
+                                        os.path.basename(path))]
+    files = []
+    for root, _, names in os.walk(path):
+        for name in names:
+            full = os.path.join(root, name)
+            if os.path.isfile(full) and not os.path.islink(full):
+                files.append((os.path.getsize(full),
+                              os.path.relpath(full, path)))
+    return path, files
+
+
+def list_remote(host, path, args):
+    """Like list_local, for a path on host. Also opens the shared master."""
+    script = (f'p={shlex.quote(path.rstrip("/") or "/")}; '
+              'if [ -f "$p" ]; then echo file; cd "$(dirname "$p")" && '
+              'find "$(basename "$p")" -maxdepth 0 -printf "%s %p\\n"; '
+              'else echo dir; cd "$p" && find . -type f -printf "%s %P\\n"; '
+              'fi')
+    r = subprocess.run([*ssh_command(args), host, script],
+                       capture_output=True, text=True)
+    assert r.returncode == 0, \
+        f'Could not list {host}:{path}: {r.stderr.strip()}'
+    kind, *lines = r.stdout.splitlines()
+    files = []
+    for line in lines:
+        size, _, rel = line.partition(' ')
+        files.append((int(size), rel))
+    base = os.path.dirname(path.rstrip('/')) if kind == 'file' else path
+    return base, files
+
+
+def balance(files, n):
+    """
+    Split files into n chunks of similar total size.
+
+    Files are assigned largest first to the chunk with the fewest bytes.
+
+    Returns:
+        list: Chunks as (total bytes, list of relative paths), without
+            empty chunks.
+    """
+    heap = [(0, i) for i in range(n)]
+    chunks = [[] for _ in range(n)]
+    totals = [0] * n
+    for size, rel in sorted(files, reverse=True):
+        total, i = heapq.heappop(heap)
+        chunks[i].append(rel)
+        totals[i] = total + size
+        heapq.heappush(heap, (totals[i], i))
+    return [(t, c) for t, c in zip(totals, chunks) if c]
+
+
+def wire_bytes(stats):
+    """Bytes rsync sent and received over ssh, from its --stats output."""
+    return sum(int(re.sub(r'[,.]', '', n)) for n in re.findall(
+        r'Total bytes (?:sent|received): ([\d,.]+)', stats))
+
+
+def run_stream(i, chunk, src, dest, args, tmpdir):
+    """Run one rsync for a chunk. Returns (bytes, seconds, returncode)."""
+    listfile = os.path.join(tmpdir, f'chunk{i}')
+    with open(listfile, 'w') as f:
+        f.write('\n'.join(chunk) + '\n')
+    cmd = ['rsync', '-a', '--partial', '--append-verify', '--stats',
+           f'--files-from={listfile}',
+           '-e', ' '.join(shlex.quote(a) for a in ssh_command(args)),
+           src, dest]
+    t0 = time.perf_counter()
+    r = subprocess.run(cmd, capture_output=True, text=True)
+    if r.returncode != 0:
+        print(f'Stream {i} failed:\n{r.stderr.strip()}', file=sys.stderr)
+    return wire_bytes(r.stdout), time.perf_counter() - t0, r.returncode
+
+
+def copy(args):
+    """
+    Copy args.src to args.dest in parallel streams.
+
+    Returns:
+        dict: Bytes over the wire, elapsed seconds and failed streams.
+    """
+    src_host, src_path = split_remote(args.src)
+    dest_host, dest_path = split_remote(args.dest)
+    assert (src_host is None) != (dest_host is None), \
+        'Exactly one of source and destination must be host:path'
+    host = src_host or dest_host
+    if not args.no_mux:
+        os.makedirs(SOCKDIR, mode=0o700, exist_ok=True)
+    if src_host:
+        base, files = list_remote(src_host, src_path, args)
+        src = f'{src_host}:{base.rstrip("/")}/'
+        os.makedirs(dest_path, exist_ok=True)
+        dest = dest_path
+    else:
+        base, files = list_local(src_path)
+        src = base + '/'
+        # Also opens the shared master before the streams start
+        r = subprocess.run([*ssh_command(args), host,
+                            f'mkdir -p {shlex.quote(dest_path)}'])
+        assert r.returncode == 0, f'Could not create {args.dest}'
+        dest = f'{dest_host}:{dest_path}'
+    assert files, f'No files found in {args.src}'
+
+    chunks = balance(files, args.streams)
+    total = sum(s for s, _ in files)
+    print(f'{len(files)} files, {total / 1e6:.1f} MB in {len(chunks)} streams')
+    t0 = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            ThreadPoolExecutor(len(chunks)) as pool:
+        results = list(pool.map(
+            lambda ic: run_stream(ic[0], ic[1][1], src, dest, args, tmpdir),
+            enumerate(chunks)))
+    elapsed = time.perf_counter() - t0
+
+    sent = sum(r[0] for r in results)
+    for i, ((size, chunk), (nbytes, secs, code)) in \
+            enumerate(zip(chunks, results)):
+        state = 'ok' if code == 0 else f'failed ({code})'
+        print(f'  stream {i}: {len(chunk)} files, {nbytes / 1e6:.1f} MB in '
+              f'{secs:.1f}s, {nbytes / 1e6 / max(secs, 1e-3):.1f} MB/s, '
+              f'{state}')
+    print(f'Transferred {sent / 1e6:.1f} MB in {elapsed:.1f}s: '
+          f'{sent / 1e6 / elapsed:.1f} MB/s')
+    failed = sum(r[2] != 0 for r in results)
+    if failed:
+        print(f'{failed} streams failed. Run the same command again to resume.',
+              file=sys.stderr)
+    return {'bytes': sent, 'seconds': elapsed, 'failed': failed}
+
+
+def tree_digests(root):
+    """SHA-256 of every file below root, keyed by relative path."""
+    _, files = list_local(root)
+    digests = {}
+    for _, rel in files:
+        with open(os.path.join(root, rel), 'rb') as f:
+            digests[rel] = hashlib.sha256(f.read()).hexdigest()
+    return digests
+
+
+def selftest(args):
+    """Push, resume and pull a generated tree through a local sshd."""
+    work = tempfile.mkdtemp(prefix='mtransfer_')
+    try:
+        src = os.path.join(work, 'src')
+        sizes = [args.mb << 20] + [(args.mb << 20) // (k + 2)
+                                   for k in range(7)] + [1024] * 50
+        for k, size in enumerate(sizes):
+            sub = os.path.join(src, f'd{k % 3}')
+            os.makedirs(sub, exist_ok=True)
+            with open(os.path.join(sub, f'f{k}.bin'), 'wb') as f:
+                f.write(os.urandom(size))
+        want = tree_digests(src)
+        copy_args = argparse.Namespace(streams=args.streams,
+                                       no_mux=args.no_mux)
+
+        copy_args.src, copy_args.dest = src, f'{args.host}:{work}/remote'
+        copy(copy_args)
+        assert tree_digests(os.path.join(work, 'remote')) == want, \
+            'Pushed files differ'
+
+        # Truncate the largest file, as if the stream had been interrupted
+        big = os.path.join(work, 'remote', 'd0', 'f0.bin')
+        with open(big, 'r+b') as f:
+            f.truncate(os.path.getsize(big) // 3)
+        result = copy(copy_args)
+        assert tree_digests(os.path.join(work, 'remote')) == want, \
+            'Resumed files differ'
+        assert result['bytes'] < sizes[0], 'Resume sent the whole file again'
+
+        copy_args.src = f'{args.host}:{work}/remote'
+        copy_args.dest = os.path.join(work, 'back')
+        copy(copy_args)
+        assert tree_digests(os.path.join(work, 'back')) == want, \
+            'Pulled files differ'
+        print('Self-test passed')
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.strip().split('\n')[2:]))
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_copy = sub.add_parser('copy', help='Copy files')
+    p_copy.add_argument('src', help='File or directory, e.g. minerva:/sc/...')
+    p_copy.add_argument('dest', help='Directory to copy into')
+    p_copy.set_defaults(func=copy)
+
+    p_test = sub.add_parser('selftest', help='Test against a local sshd')
+    p_test.add_argument('--host', default='localhost',
+                        help='SSH host whose filesystem is this one '
+                        '(default: localhost)')
+    p_test.add_argument('--mb', type=int, default=64,
+                        help='Size of the largest test file in MiB '
+                        '(default: 64)')
+    p_test.set_defaults(func=selftest)
+
+    for p in [p_copy, p_test]:
+        p.add_argument('-j', '--streams', type=int, default=4,
+                       help='Parallel streams (default: 4)')
+        p.add_argument('--no-mux', action='store_true',
+                       help='Open a separate connection for each stream')
+
+    args = parser.parse_args()
+    try:
+        result = args.func(args)
+    except AssertionError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if result and result['failed']:
+        sys.exit(1)
@@ -1,5 +1,11 @@
 #!/usr/bin/env bash
 
+# log in once through ssh_keeper.py if installed, so mc reuses the login
+if command -v ssh_keeper.py > /dev/null; then
+  echo "Logging in to Minerva; enter Minerva password and token if prompted"
+  ssh_keeper.py start minerva || exit 1
+fi
+
 # get groups and group IDs from Minerva
 echo "Getting groups from Minerva; enter Minerva password and token if prompted"
 groupinfo=$(ssh minerva 'id $USER' | \
@@ -38,24 +44,115 @@ sudo chmod 644 /etc/synthetic.conf
 echo Adding SSHFS scripts if absent
 mkdir -p $HOME/local/scripts
 
-[[ -f $HOME/local/scripts/mc ]] || cat > $HOME/local/scripts/mc <<EOL
+# Replace mc and mu scripts from before mount profiles and ssh_keeper.py
+if [[ -f $HOME/local/scripts/mc ]] && ! grep -q "MC_KEEPER" $HOME/local/scripts/mc; then
+  echo "Updating mc and mu to support mount profiles and ssh_keeper.py"
+  rm -f $HOME/local/scripts/mc $HOME/local/scripts/mu
+fi
+
+[[ -f $HOME/local/scripts/mc ]] || cat > $HOME/local/scripts/mc <<'EOL'
 #!/usr/bin/env bash
-cd
+# Mount Minerva over sshfs with a performance profile (MC_PROFILES)
 
-mount | grep -q /sc && diskutil unmount force /sc
-mount | grep -q /hpc && diskutil unmount force /hpc
-killall -9 sshfs
+usage() {
+  cat <<EOF
+Usage: $(basename "$0") [-p profile] [-m mountpoint] [-n] [path ...]
 
-sshfs -o noappledouble -o volname=minerva_sc -o follow_symlinks minerva:/sc /sc/
-sshfs -o noappledouble -o volname=minerva_hpc -o follow_symlinks minerva:/hpc /hpc/
-cd -
+Mount /sc and /hpc from Minerva, or only the given paths, e.g.
+/sc/arion/projects/load. Paths are mounted at the same place locally.
+
+  -p  Profile (default: browse)
+        browse     long attribute and directory caches, for ls and Finder
+        bulk-read  kernel caching and large reads, for opening big files
+        safe-write no caching and synchronous writes, for editing shared files
+  -m  Mount a single path somewhere else
+  -n  Print the sshfs commands without running them
+EOF
+  exit 1
+}
+
+profile=browse
+mountpoint=""
+dryrun=false
+while getopts "p:m:nh" opt; do
+  case $opt in
+    p) profile=$OPTARG ;;
+    m) mountpoint=$OPTARG ;;
+    n) dryrun=true ;;
+    *) usage ;;
+  esac
+done
+shift $((OPTIND - 1))
+
+opts="-o noappledouble -o follow_symlinks"
+case $profile in
+  browse)
+  opts+=" -o cache=yes -o cache_timeout=600 -o cache_stat_timeout=600"
+  opts+=" -o cache_dir_timeout=600 -o cache_link_timeout=600"
+  opts+=" -o attr_timeout=600 -o entry_timeout=600 -o negative_timeout=60"
+  opts+=" -o reconnect -o Compression=yes -o Ciphers=aes128-gcm@openssh.com"
+  ;;
+  bulk-read)
+  # iosize is the largest read macFUSE will issue
+  opts+=" -o cache=yes -o cache_timeout=600 -o kernel_cache -o auto_cache"
+  opts+=" -o iosize=1048576 -o attr_timeout=600 -o entry_timeout=600"
+  opts+=" -o reconnect -o Compression=no -o Ciphers=aes128-gcm@openssh.com"
+  ;;
+  safe-write)
+  opts+=" -o cache=no -o attr_timeout=0 -o entry_timeout=0"
+  opts+=" -o sshfs_sync -o sync_readdir -o Compression=no"
+  ;;
+  *)
+  echo "Unknown profile: $profile" >&2
+  usage
+  ;;
+esac
+
+if [[ $# -eq 0 ]]; then
+  [[ -n $mountpoint ]] && usage
+  set -- /sc /hpc
+fi
+if [[ -n $mountpoint && $# -gt 1 ]]; then
+  echo "-m only works with a single path" >&2
+  exit 1
+fi
+
+run() {
+  if [[ $dryrun == true ]]; then
+    echo "$@"
+  else
+    "$@"
+  fi
+}
+
+# Mount over the master ssh_keeper.py keeps for minerva, so mounting needs
+# no login of its own (MC_KEEPER)
+if command -v ssh_keeper.py > /dev/null; then
+  [[ $dryrun == true ]] || ssh_keeper.py start minerva || exit 1
+  opts+=" -o ControlPath=$(ssh_keeper.py socket minerva)"
+fi
+
+cd
+for path in "$@"; do
+  path=${path%/}
+  target=${mountpoint:-$path}
+  if mount | grep -q " on $target "; then
+    run diskutil unmount force "$target"
+  fi
+  [[ -d $target ]] || run mkdir -p "$target"
+  run sshfs $opts -o volname="minerva_$(basename "$path")" \
+    minerva:"$path" "$target"
+done
+cd - > /dev/null
 EOL
 
-[[ -f $HOME/local/scripts/mu ]] || cat > $HOME/local/scripts/mu <<EOL
+[[ -f $HOME/local/scripts/mu ]] || cat > $HOME/local/scripts/mu <<'EOL'
 #!/usr/bin/env bash
-mount | grep -q /sc && diskutil unmount force /sc
-mount | grep -q /hpc && diskutil unmount force /hpc
-killall -9 sshfs
+# Unmount everything mc mounted (MC_PROFILES)
+mount | awk '$1 ~ /^minerva:/ { print $3 }' | while read -r mp; do
+  diskutil unmount force "$mp"
+done
+killall -9 sshfs 2> /dev/null
 EOL
 
 chmod +x $HOME/local/scripts/mc
@@ -65,5 +162,8 @@ if ! which mc > /dev/null; then
   echo 'export PATH=$HOME/local/scripts:$PATH' >> $HOME/.zshrc
 fi
 
+echo "mc mounts /sc and /hpc, or single paths like /sc/arion/projects/load."
+echo "Pick a profile with mc -p browse|bulk-read|safe-write; see mc -h."
+echo "sshfs_bench.py compares the profiles on your connection."
 echo Done. Please make sure SSHFS is installed and then restart
 
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+"""
+Run an I/O-heavy Snakemake rule on node-local disk instead of GPFS.
+
+run copies the inputs to a directory in $TMPDIR (or /local/tmp), runs the
+command there and copies the outputs back, each to a temporary name that is
+renamed into place, so a failed or killed job never leaves a partial output
+on GPFS. Relative paths work unchanged in the command, and absolute input
+paths in it are replaced by their staged copies:
+
+    rule sort_bam:
+        input: "aligned/{sample}.bam"
+        output: "sorted/{sample}.bam"
+        shell:
+            "scratch_stage.py run --rule sort_bam -i {input:q} -o {output:q} "
+            "-- samtools sort -T tmp -o {output:q} {input:q}"
+
+Each run logs its read and write calls to .snakemake/scratch_stage.jsonl in
+the workflow directory. The calls the command made, and the files it created,
+stayed on the node; report compares them with the calls staging made on
+GPFS:
+
+    scratch_stage.py report
+
+classes applies the rule classes in a profile's scratch.yaml, written by
+setup_snakemake_profiles.py, as set-resources in its config.yaml:
+
+    scratch_stage.py classes ~/.config/snakemake/lsf8
+"""
+
+import os
+import re
+import ast
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+LOG = os.path.join('.snakemake', 'scratch_stage.jsonl')
+
+
+def scratch_root(path=None):
+    """The node-local directory to stage in, or None if there is none."""
+    for root in [path, os.environ.get('TMPDIR'), '/local/tmp']:
+        if root and os.path.isdir(root) and os.access(root, os.W_OK):
+            return root
+    return None
+
+
+def io_counters():
+    """Read and write counts of this process and its finished children."""
+    try:
+        with open('/proc/self/io') as f:
+            return {k: int(v) for k, v in
+                    (line.split(': ') for line in f.read().splitlines())}
+    except OSError:
+        return {}
+
+
+def io_delta(before):
+    after = io_counters()
+    return {k: after[k] - before.get(k, 0) for k in
+            ['syscr', 'syscw', 'rchar', 'wchar'] if k in after}
+
+
+def count_files(path):
+    return sum(len(names) for _, _, names in os.walk(path))
+
+
+def copy_path(src, dest):
+    if os.path.isdir(src):
+        shutil.copytree(src, dest, symlinks=True)
+    else:
+        shutil.copy2(src, dest)
+
+
+def stage_in(inputs, workdir):
+    """
+    Copy inputs below workdir, keeping relative paths relative.
+
+    Returns:
+        dict: Staged path of each absolute input.
+    """
+    moved = {}
+    for path in inputs:
+        rel = path.lstrip(os.sep) if os.path.isabs(path) else path
+        assert not rel.startswith('..'), \
+            f'Cannot stage {path}, it is outside the working directory'
+        dest = os.path.join(workdir, rel)
+        os.makedirs(os.path.dirname(dest) or workdir, exist_ok=True)
+        copy_path(path, dest)
+        if os.path.isabs(path):
+            moved[path] = dest
+    return moved
+
+
+def staged_command(command, moved):
+    """
+    Replace absolute input paths in the command by their staged copies.
+
+    A path is only replaced where it is a whole argument, or a whole word of
+    a shell string or of an option like --in=PATH, so that a staged
+    /x/s1.bam does not also rewrite /x/s1.bam.bai.
+    """
+    for path, dest in moved.items():
+        word = re.compile(rf'(?<![^\s=\'"]){re.escape(path)}(?![^\s\'"])')
+        command = [word.sub(lambda m: dest, a) for a in command]
+    return command
+
+
+def stage_out(outputs, workdir):
+    """Copy outputs back, renaming each into place once complete."""
+    missing = [p for p in outputs
+               if not os.path.lexists(os.path.join(workdir, p))]
+    assert not missing, f'Command did not create {", ".join(missing)}'
+    for path in outputs:
+        src = os.path.join(workdir, path)
+        destdir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(destdir, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='.scratch_stage_', dir=destdir)
+        try:
+            staged = os.path.join(tmp, os.path.basename(path))
+            copy_path(src, staged)
+            if os.path.isdir(staged) and os.path.isdir(path):
+                # Directories cannot be replaced by a rename
+                old = os.path.join(tmp, '.old')
+                os.rename(path, old)
+            os.replace(staged, path)
+        finally:
+            shutil.rmtree(tmp)
+
+
+def run(args):
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    assert command, 'No command given after --'
+    for path in args.output:
+        assert not os.path.isabs(path), \
+            f'Outputs must be relative to the workflow directory: {path}'
+    root = scratch_root(args.scratch)
+    if root is None:
+        print('No node-local scratch directory, running in place',
+              file=sys.stderr)
+        return subprocess.run(command if len(command) > 1 else command[0],
+                              shell=len(command) == 1).returncode
+
+    record = {'rule': args.rule, 'host': os.uname().nodename,
+              'scratch': root, 'start': time.time()}
+    workdir = tempfile.mkdtemp(prefix='scratch_stage_', dir=root)
+    try:
+        t0 = time.perf_counter()
+        io0 = io_counters()
+        moved = stage_in(args.input, workdir)
+        record['stage_in'] = io_delta(io0)
+        record['stage_in']['seconds'] = time.perf_counter() - t0
+        files_in = count_files(workdir)
+
+        for path in args.output:
+            # The command only has to create the files, as in place
+            os.makedirs(os.path.dirname(os.path.join(workdir, path)),
+                        exist_ok=True)
+        command = staged_command(command, moved)
+        t0 = time.perf_counter()
+        io0 = io_counters()
+        # A single argument is a shell command, as Snakemake passes it
+        returncode = subprocess.run(
+            command if len(command) > 1 else command[0],
+            shell=len(command) == 1, cwd=workdir).returncode
+        record['command'] = io_delta(io0)
+        record['command']['seconds'] = time.perf_counter() - t0
+        record['command']['files'] = count_files(workdir) - files_in
+        record['returncode'] = returncode
+
+        if returncode == 0:
+            t0 = time.perf_counter()
+            io0 = io_counters()
+            try:
+                stage_out(args.output, workdir)
+            except AssertionError as e:
+                print(e, file=sys.stderr)
+                returncode = record['returncode'] = 1
+            record['stage_out'] = io_delta(io0)
+            record['stage_out']['seconds'] = time.perf_counter() - t0
+    finally:
+        if args.keep:
+            print(f'Kept scratch directory {workdir}', file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    gpfs = sum(record[s].get(k, 0) for s in ['stage_in', 'stage_out']
+               if s in record for k in ['syscr', 'syscw'])
+    local = record['command'].get('syscr', 0) + \
+        record['command'].get('syscw', 0)
+    print(f'scratch_stage: {local} read/write calls on {root} instead of '
+          f'GPFS, {gpfs} for staging', file=sys.stderr)
+    if args.log:
+        os.makedirs(os.path.dirname(args.log) or '.', exist_ok=True)
+        with open(args.log, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    return returncode
+
+
+def report(args):
+    assert os.path.exists(args.log), f'No staging log at {args.log}'
+    rules = {}
+    with open(args.log) as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # partly written by a job that was killed
+            r = rules.setdefault(rec.get('rule') or '(no rule)', {
+                'jobs': 0, 'failed': 0, 'local': 0, 'gpfs': 0, 'files': 0,
+                'staged': 0, 'stage_s': 0, 'command_s': 0})
+            r['jobs'] += 1
+            r['failed'] += rec.get('returncode') != 0
+            cmd = rec.get('command', {})
+            r['local'] += cmd.get('syscr', 0) + cmd.get('syscw', 0)
+            r['files'] += cmd.get('files', 0)
+            r['command_s'] += cmd.get('seconds', 0)
+            for stage in ['stage_in', 'stage_out']:
+                s = rec.get(stage, {})
+                r['gpfs'] += s.get('syscr', 0) + s.get('syscw', 0)
+                r['staged'] += s.get('wchar', 0)
+                r['stage_s'] += s.get('seconds', 0)
+    assert rules, f'No runs logged in {args.log}'
+
+    print(f'{"Rule":<24} {"Jobs":>5} {"Failed":>6} {"Local ops":>10} '
+          f'{"GPFS ops":>9} {"Avoided":>9} {"Staged":>9} {"Staging":>8}')
+    total = {k: 0 for k in next(iter(rules.values()))}
+    for rule, r in sorted(rules.items(), key=lambda kv: kv[1]['gpfs'] -
+                          kv[1]['local']):
+        for k in total:
+            total[k] += r[k]
+        print_row(rule, r)
+    if len(rules) > 1:
+        print_row('total', total)
+    print('\nAvoided counts read/write calls the commands made on local disk, '
+          'less those\nstaging made on GPFS. The commands also created '
+          f'{total["files"]} files on local disk.')
+
+
+def print_row(name, r):
+    share = r['stage_s'] / max(r['stage_s'] + r['command_s'], 1e-9)
+    print(f'{name:<24} {r["jobs"]:>5} {r["failed"]:>6} {r["local"]:>10} '
+          f'{r["gpfs"]:>9} {r["local"] - r["gpfs"]:>9} '
+          f'{r["staged"] / 1e9:>7.2f}GB {100 * share:>7.0f}%')
+
+
+def resource_value(value):
+    """
+    Write a resource value the way Snakemake evaluates it.
+
+    Snakemake evaluates set-resources values as Python expressions, so a bare
+    path like /local/tmp is a syntax error and fails every job of the rule.
+    Strings are quoted, and the result must parse back to the same value.
+    """
+    text = (str(value) if isinstance(value, (int, float))
+            and not isinstance(value, bool) else repr(str(value)))
+    try:
+        parsed = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        parsed = None
+    assert parsed == value or parsed == str(value), \
+        f'Cannot write resource value {value!r} for Snakemake'
+    return text
+
+
+def classes(args):
+    import yaml
+    classfile = os.path.join(args.profile, 'scratch.yaml')
+    config = os.path.join(args.profile, 'config.yaml')
+    assert os.path.isfile(classfile), \
+        f'No {classfile}. Create the profile with scratch staging first.'
+    with open(classfile) as f:
+        rule_classes = yaml.safe_load(f) or {}
+    with open(config) as f:
+        conf = yaml.safe_load(f) or {}
+
+    wanted = {}
+    for name, cls in rule_classes.items():
+        for rule in cls.get('rules') or []:
+            for key, value in (cls.get('resources') or {}).items():
+                assert (rule, key) not in wanted, \
+                    f'{rule} gets {key} from more than one class'
+                wanted[rule, key] = value
+    # Rule-specific resources as rule:key=value, which Snakemake 7 and 8 read
+    current = conf.get('set-resources') or []
+    if isinstance(current, dict):
+        current = [f'{rule}:{k}={v}' for rule, res in current.items()
+                   for k, v in res.items()]
+    kept = [s for s in current
+            if tuple(s.split('=', 1)[0].split(':', 1)) not in wanted]
+    conf['set-resources'] = kept + [f'{rule}:{key}={resource_value(value)}'
+                                    for (rule, key), value in wanted.items()]
+    if not conf['set-resources']:
+        del conf['set-resources']
+    with open(config + '.tmp', 'w') as f:
+        yaml.dump(conf, f, default_flow_style=False)
+    os.replace(config + '.tmp', config)
+    print(f'Set {len(wanted)} rule resources from {len(rule_classes)} '
+          f'classes in {config}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.strip().split('\n')[2:]))
+    sub = parser.add_subparsers(dest='subcommand', required=True)
+
+    p_run = sub.add_parser('run', help='Run a command on staged copies')
+    p_run.add_argument('-i', '--input', nargs='*', default=[],
+                       help='Files and directories the command reads')
+    p_run.add_argument('-o', '--output', nargs='*', default=[],
+                       help='Files and directories the command creates, '
+                       'relative to the workflow directory')
+    p_run.add_argument('--rule', help='Rule name for the log')
+    p_run.add_argument('--scratch', help='Directory to stage in '
+                       '(default: $TMPDIR, then /local/tmp)')
+    p_run.add_argument('--keep', action='store_true',
+                       help='Keep the scratch directory, for debugging')
+    p_run.add_argument('command', nargs=argparse.REMAINDER,
+                       help='Command after --, or a single shell string')
+    p_run.set_defaults(func=run)
+
+    p_report = sub.add_parser('report', help='GPFS operations avoided per '
+                              'rule')
+    p_report.set_defaults(func=report)
+
+    for p in [p_run, p_report]:
+        p.add_argument('--log', default=LOG,
+                       help=f'Staging log (default: {LOG})')
+
+    p_classes = sub.add_parser('classes', help='Apply scratch.yaml rule '
+                               'classes to a profile')
+    p_classes.add_argument('profile', help='Profile directory')
+    p_classes.set_defaults(func=classes)
+
+    args = parser.parse_args()
+    try:
+        returncode = args.func(args)
+    except (AssertionError, OSError, subprocess.CalledProcessError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    sys.exit(returncode or 0)
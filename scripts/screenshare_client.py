@@ -10,50 +10,19 @@ import csv
 import shutil
 import urllib.request
 
-def octal_to_string(octal):
-    octal = int(f'{octal:o}')
-    result = ''
-    value_letters = [(4,'r'),(2,'w'),(1,'x')]
-    # Iterate over each of the digits in octal
-    for digit in [int(n) for n in str(octal)]:
-        # Check for each of the permissions values
-        for value, letter in value_letters:
-            if digit >= value:
-                result += letter
-                digit -= value
-            else:
-                result += '-'
-    return result
-
-def nicepath(path, *args):
-    if type(path) in [str, pathlib.PosixPath]:
-        path = [path]
-    if args:
-        path += args
-    return os.path.join(*[os.path.normpath(x) for x in path])
-
-def mkdir(path, *args, **kwargs):
-    if type(path) in [str, pathlib.PosixPath]:
-        path = [path]
-    if args:
-        path += args
-    path = nicepath(path)
-    mkdirkwargs = {k: v for k, v in kwargs.items() if k != 'fixperms'}
-    valid_modes = [0o500, 0o510, 0o511, 0o550, 0o551, 0o555,
-                   0o700, 0o710, 0o711, 0o750, 0o751, 0o755,
-                   0o770, 0o771, 0o775, 0o777]
-
-    setmode = False
-    if 'mode' in kwargs.keys():
-        err = 'Bad mode for folder: {}'.format(octal_to_string(kwargs['mode']))
-        assert kwargs['mode'] in valid_modes, err
-        setmode = True
-
-    if not os.path.exists(path):
-        os.makedirs(path, **mkdirkwargs)
-    elif 'fixperms' in kwargs.keys() and kwargs['fixperms'] is True:
-        assert setmode is True, 'Mode not specified'
-        os.chmod(path, kwargs['mode'])
+try:
+    from labops.util import nicepath, mkdir
+except ImportError:
+    # Run from a checkout of lab_operations
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    try:
+        from labops.util import nicepath, mkdir
+    except ImportError:
+        sys.exit('Run this through labops: bash <(curl -s https://raw.'
+                 'githubusercontent.com/marcoralab/lab_operations/main/'
+                 'scripts/labops_bootstrap) screenshare-client '
+                 + ' '.join(sys.argv[1:]))
 
 def make_key(home):
     f_elyptic = nicepath(home, '.ssh/id_ed25519')
@@ -144,38 +113,28 @@ r = subprocess.Popen(cmd_copykey, shell=True)
 r.communicate()
 assert r.returncode == 0, 'Error extracting app'
 
+## Download tunnel manager
+
+tunnel_url = "https://raw.githubusercontent.com/marcoralab/lab_operations/refs/heads/main/scripts/screenshare_tunnel.py"
+script_path = nicepath(hdir, "local", "scripts")
+mkdir(script_path)
+tunnel_path = nicepath(script_path, "screenshare_tunnel.py")
+# Lab members already have it linked from the repo by setup.py
+if not os.path.islink(tunnel_path):
+    urllib.request.urlretrieve(tunnel_url, tunnel_path)
+    os.chmod(tunnel_path, 0o755)
+
 ## Set up function in zshrc
 
 zsh_func_name = "sshvnc"
 zsh_func = f'''
 # BEGIN {zsh_func_name}
 function {zsh_func_name}() {{
-  local config_file="$HOME/.screenshare.hosts"
-  if [[ ! -f "$config_file" ]]; then
-    echo "Config file not found: $config_file" >&2
-    return 1
-  fi
-
-  if (( $# == 0 )); then
-    if (( $(wc -l < "$config_file") == 1 )); then
-      line=$(<"$config_file")
-    else
-      echo "Expected exactly one entry in config when no argument is given." >&2
-      return 1
-    fi
-  elif (( $# == 1 )); then
-    line=$(awk -v key="$1" '$1 == key {{ print; exit }}' "$config_file")
-    if [[ -z "$line" ]]; then
-      echo "No entry found for: $1" >&2
-      return 1
-    fi
-  else
-    echo "Too many arguments." >&2
-    return 1
-  fi
-  read -r sname port usr hname <<< "$line"
-  ssh -L ${{port}}:localhost:5900 "${{usr}}@${{hname}}" -fNT
-  open vnc://localhost:${{port}}
+  local manager="$HOME/local/scripts/screenshare_tunnel.py"
+  case "$1" in
+    connect|list|stop|watch) python3 "$manager" "$@" ;;
+    *) python3 "$manager" connect "$@" ;;
+  esac
 }}
 # END {zsh_func_name}
 '''
@@ -212,3 +171,5 @@ if nrow_conf == 1:
 else:
     print(f"You can then connect by running {zsh_func_name} {sname}")
 print("Or you can run the 'Launch Screenshare' app.")
+print(f"Tunnels stay up between connections. Use '{zsh_func_name} list' to "
+      f"see them and '{zsh_func_name} stop [name]' to close them.")
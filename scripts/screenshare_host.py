@@ -45,6 +45,6 @@ hname = socket.getfqdn()
 hname_short = hname.split(".")[0]
 
 print('Please run the following command where you will be accessing this computer to complete setup:')
-print(f'''python3 <(curl -s https://raw.githubusercontent.com/marcoralab/lab_operations/main/scripts/screenshare_client) {hname_short} {usr} {hname}''')
+print(f'''bash <(curl -s https://raw.githubusercontent.com/marcoralab/lab_operations/main/scripts/labops_bootstrap) screenshare-client {hname_short} {usr} {hname}''')
 print(f'\nYou can replace {hname_short} with a descriptive name for this computer')
 
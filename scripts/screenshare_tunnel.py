@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+"""
+Manage persistent VNC tunnels to the hosts in ~/.screenshare.hosts.
+
+Each host gets one SSH master connection that carries the VNC port forward.
+The master is controlled through a socket in ~/.ssh/cm_socket, so connecting
+again reuses the running tunnel instead of spawning a new ssh process.
+
+If ssh_keeper.py is installed, the forward is added to the master it keeps
+for the host, so the tunnel shares one login with ssh, sshfs and the other
+lab scripts. Stopping the tunnel then only cancels the forward and leaves
+the master open for them.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import socket
+import shutil
+import argparse
+import functools
+import subprocess
+
+CONFCOLS = ['sname', 'port', 'usr', 'hname']
+FILE_CONF = os.path.expanduser('~/.screenshare.hosts')
+SOCKDIR = os.path.expanduser('~/.ssh/cm_socket')
+FILE_TRANSPORT = os.path.expanduser(
+    '~/.config/lab_operations/ssh_transport.json')
+
+
+def read_hosts():
+    assert os.path.exists(FILE_CONF), f'Config file not found: {FILE_CONF}'
+    with open(FILE_CONF, newline='') as f:
+        reader = csv.reader(f, delimiter=' ')
+        return {row[0]: dict(zip(CONFCOLS, row)) for row in reader if row}
+
+
+def pick_host(hosts, sname=None):
+    if sname is None:
+        assert len(hosts) == 1, \
+            'Expected exactly one entry in config when no host is given.'
+        return next(iter(hosts.values()))
+    assert sname in hosts, f'No entry found for: {sname}'
+    return hosts[sname]
+
+
+def target(entry):
+    return f'{entry["usr"]}@{entry["hname"]}'
+
+
+def keeper():
+    """Path of ssh_keeper.py, or None if it is not installed."""
+    return shutil.which('ssh_keeper.py')
+
+
+@functools.lru_cache()
+def keeper_socket(host):
+    r = subprocess.run([keeper(), 'socket', host], capture_output=True,
+                       text=True)
+    assert r.returncode == 0, r.stderr.strip()
+    return r.stdout.strip()
+
+
+def own_sockpath(entry):
+    """Socket of a master opened for the tunnel alone, without the keeper."""
+    return os.path.join(SOCKDIR, f'screenshare_{entry["sname"]}')
+
+
+def sockpath(entry):
+    """Socket of the master carrying the tunnel."""
+    if os.path.exists(own_sockpath(entry)) or not keeper():
+        return own_sockpath(entry)
+    return keeper_socket(target(entry))
+
+
+def wantpath(entry):
+    return own_sockpath(entry) + '.want'
+
+
+def forward(entry):
+    return f'{entry["port"]}:localhost:5900'
+
+
+def ssh_control(entry, command):
+    """Send a control command (check, exit, forward, cancel) to the master."""
+    fwd = ['-L', forward(entry)] if command in ['forward', 'cancel'] else []
+    cmd = ['ssh', '-S', sockpath(entry), '-O', command, *fwd, target(entry)]
+    return subprocess.run(cmd, capture_output=True, text=True)
+
+
+def port_open(port):
+    with socket.socket() as s:
+        s.settimeout(1)
+        return s.connect_ex(('localhost', int(port))) == 0
+
+
+def status(entry):
+    """
+    Check whether the tunnel to a host is up.
+
+    Returns:
+        str: The master's pid if it is running and forwarding, else None.
+    """
+    if not os.path.exists(sockpath(entry)):
+        return None
+    r = ssh_control(entry, 'check')
+    if r.returncode != 0 or not port_open(entry['port']):
+        return None
+    return r.stderr.strip().partition('pid=')[2].rstrip(')') or '?'
+
+
+def transport_options(entry):
+    """Options saved by ssh_transport_bench.py for the host, as ssh -o args."""
+    if not os.path.exists(FILE_TRANSPORT):
+        return []
+    with open(FILE_TRANSPORT) as f:
+        saved = json.load(f)
+    rec = saved.get(entry['sname'], saved.get(entry['hname'], {}))
+    return [arg for k, v in rec.get('options', {}).items()
+            if k != 'ControlMaster' for arg in ['-o', f'{k}={v}']]
+
+
+def start(entry):
+    """Start the master connection and port forward for a host."""
+    os.makedirs(SOCKDIR, mode=0o700, exist_ok=True)
+    sock = own_sockpath(entry)
+    if os.path.exists(sock):
+        # Stale socket from a master that died
+        ssh_control(entry, 'exit')
+        if os.path.exists(sock):
+            os.remove(sock)
+    if keeper():
+        # Log in once through the keeper, or reuse its master, and add the
+        # forward to it. Transport options come from ~/.ssh/config here.
+        r = subprocess.run([keeper(), 'start', target(entry)])
+        assert r.returncode == 0, f'Could not log in to {entry["hname"]}'
+        r = ssh_control(entry, 'forward')
+        assert r.returncode == 0, \
+            f'Could not forward port {entry["port"]}: {r.stderr.strip()}'
+        open(wantpath(entry), 'w').close()
+        return
+    cmd = ['ssh', '-M', '-S', sock, '-fNT',
+           '-o', 'ControlPersist=yes',
+           '-o', 'ExitOnForwardFailure=yes',
+           '-o', 'ServerAliveInterval=15',
+           '-o', 'ServerAliveCountMax=3',
+           *transport_options(entry),
+           '-L', f'{entry["port"]}:localhost:5900',
+           f'{entry["usr"]}@{entry["hname"]}']
+    r = subprocess.run(cmd)
+    assert r.returncode == 0, f'Could not open tunnel to {entry["hname"]}'
+    open(wantpath(entry), 'w').close()
+
+
+def open_vnc(port):
+    url = f'vnc://localhost:{port}'
+    opener = 'open' if sys.platform == 'darwin' else 'xdg-open'
+    subprocess.run([opener, url])
+
+
+def connect(args):
+    entry = pick_host(read_hosts(), args.host)
+    if status(entry):
+        print(f'Reusing tunnel to {entry["sname"]}')
+    else:
+        print(f'Opening tunnel to {entry["sname"]}')
+        start(entry)
+    if not args.no_open:
+        open_vnc(entry['port'])
+
+
+def list_tunnels(args):
+    hosts = read_hosts()
+    assert hosts, f'No hosts configured in {FILE_CONF}'
+    width = max(len(s) for s in hosts)
+    for sname, entry in hosts.items():
+        pid = status(entry)
+        state = f'up (pid {pid})' if pid else 'down'
+        print(f'{sname:<{width}}  localhost:{entry["port"]:<5}  '
+              f'{entry["usr"]}@{entry["hname"]}  {state}')
+
+
+def stop(args):
+    hosts = read_hosts()
+    entries = (hosts.values() if args.all
+               else [pick_host(hosts, args.host)])
+    for entry in entries:
+        if os.path.exists(wantpath(entry)):
+            os.remove(wantpath(entry))
+        if os.path.exists(own_sockpath(entry)):
+            ssh_control(entry, 'exit')
+            print(f'Stopped tunnel to {entry["sname"]}')
+        elif keeper() and status(entry):
+            ssh_control(entry, 'cancel')
+            print(f'Stopped tunnel to {entry["sname"]}, the ssh_keeper.py '
+                  'master stays open')
+
+
+def watch(args):
+    """Reconnect tunnels that were opened with connect until stopped."""
+    while True:
+        for entry in read_hosts().values():
+            if os.path.exists(wantpath(entry)) and not status(entry):
+                print(f'Tunnel to {entry["sname"]} is down; reconnecting')
+                try:
+                    start(entry)
+                except AssertionError as e:
+                    print(e)
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_con = sub.add_parser('connect', help='Connect, reusing the tunnel if '
+                           'it is up')
+    p_con.add_argument('host', nargs='?', help='Host name from the config. '
+                       'Optional if there is only one.')
+    p_con.add_argument('--no-open', action='store_true',
+                       help='Only bring up the tunnel')
+    p_con.set_defaults(func=connect)
+
+    p_list = sub.add_parser('list', help='List hosts and tunnel status')
+    p_list.set_defaults(func=list_tunnels)
+
+    p_stop = sub.add_parser('stop', help='Close tunnels')
+    p_stop.add_argument('host', nargs='?', help='Host name from the config')
+    p_stop.add_argument('--all', action='store_true', help='Close all tunnels')
+    p_stop.set_defaults(func=stop)
+
+    p_watch = sub.add_parser('watch', help='Keep connected tunnels alive')
+    p_watch.add_argument('--interval', type=float, default=30,
+                         help='Seconds between health checks (default: 30)')
+    p_watch.set_defaults(func=watch)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except AssertionError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
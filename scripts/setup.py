@@ -1,58 +1,27 @@
+import io
 import os
 import re
+import json
 import sys
+import time
+import itertools
+import threading
+import contextlib
 import importlib.util
+import concurrent.futures
 import shutil
 import subprocess
 import pygit2
 import pathlib
 from tqdm import tqdm
 
-# From pythoncircle.com
-def octal_to_string(octal):
-    octal = int(f'{octal:o}')
-    result = ''
-    value_letters = [(4,'r'),(2,'w'),(1,'x')]
-    # Iterate over each of the digits in octal
-    for digit in [int(n) for n in str(octal)]:
-        # Check for each of the permissions values
-        for value, letter in value_letters:
-            if digit >= value:
-                result += letter
-                digit -= value
-            else:
-                result += '-'
-    return result
-
-def nicepath(path, *args):
-    if type(path) in [str, pathlib.PosixPath]:
-        path = [path]
-    if args:
-        path += args
-    return os.path.join(*[os.path.normpath(x) for x in path])
-
-def mkdir(path, *args, **kwargs):
-    if type(path) in [str, pathlib.PosixPath]:
-        path = [path]
-    if args:
-        path += args
-    path = nicepath(path)
-    mkdirkwargs = {k: v for k, v in kwargs.items() if k != 'fixperms'}
-    valid_modes = [0o500, 0o510, 0o511, 0o550, 0o551, 0o555,
-                   0o700, 0o710, 0o711, 0o750, 0o751, 0o755,
-                   0o770, 0o771, 0o775, 0o777]
-
-    setmode = False
-    if 'mode' in kwargs.keys():
-        err = 'Bad mode for folder: {}'.format(octal_to_string(kwargs['mode']))
-        assert kwargs['mode'] in valid_modes, err
-        setmode = True
-
-    if not os.path.exists(path):
-        os.makedirs(path, **mkdirkwargs)
-    elif 'fixperms' in kwargs.keys() and kwargs['fixperms'] is True:
-        assert setmode is True, 'Mode not specified'
-        os.chmod(path, kwargs['mode'])
+try:
+    from labops.util import nicepath, mkdir
+except ImportError:
+    # Run from a checkout, or from the copy setup.sh makes next to labops/
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    from labops.util import nicepath, mkdir
 
 def get_os_type():
     name = os.uname().sysname
@@ -70,8 +39,10 @@ def make_keys(home, overwrite=False):
             os.remove(f_rsa)
         cmd_rsakey = ('ssh-keygen -t rsa -b 4096 '
                       f'-f {f_rsa} -P ""')
-        r = subprocess.Popen(cmd_rsakey, shell=True)
-        r.communicate()
+        # Captured so the output stays with its stage when run in parallel
+        r = subprocess.run(cmd_rsakey, shell=True, capture_output=True,
+                           text=True)
+        print(r.stdout + r.stderr, end='')
         assert r.returncode == 0, 'Error generating RSA key'
     else:
         print('Keys already exist. Skipping RSA ssh-keygen')
@@ -79,8 +50,9 @@ def make_keys(home, overwrite=False):
     if not os.path.isfile(f_elyptic):
         cmd_elyptickey = ('ssh-keygen -t ed25519 -a 100 '
                           f'-f {f_elyptic} -P ""')
-        r = subprocess.Popen(cmd_elyptickey, shell=True)
-        r.communicate()
+        r = subprocess.run(cmd_elyptickey, shell=True, capture_output=True,
+                           text=True)
+        print(r.stdout + r.stderr, end='')
         assert r.returncode == 0, 'Error generating elyptic key'
     else:
         print('Keys already exist. Skipping elyptic ssh-keygen')
@@ -104,6 +76,62 @@ def link_if_absent(src, dst=None, destdir=None):
     else:
         return dst
 
+def transport_options(host):
+    """
+    Read the ssh options recommended for a host by ssh_transport_bench.py.
+
+    Args:
+        host (str): The host name the benchmark results were saved under.
+
+    Returns:
+        dict: ssh option names to values. Empty if the host was not tested.
+    """
+    recfile = nicepath(os.environ['HOME'], '.config', 'lab_operations',
+                       'ssh_transport.json')
+    if not os.path.exists(recfile):
+        return {}
+    with open(recfile) as f:
+        recommendations = json.load(f)
+    return recommendations.get(host, {}).get('options', {})
+
+_trace_lock = threading.Lock()
+_trace_local = threading.local()
+_trace_ids = itertools.count(1)
+
+@contextlib.contextmanager
+def span(name):
+    """
+    Time a setup stage and append it to the trace file from setup.sh.
+
+    Spans opened inside another span are recorded as its children. Top level
+    spans are children of the setup.sh stage in LABOPS_TRACE_PARENT. Does
+    nothing if LABOPS_TRACE is not set. Also works as a function decorator.
+
+    Args:
+        name (str): The stage name shown in the summary.
+    """
+    trace = os.environ.get('LABOPS_TRACE')
+    if not trace:
+        yield
+        return
+    if not hasattr(_trace_local, 'stack'):
+        _trace_local.stack = [os.environ.get('LABOPS_TRACE_PARENT', '')]
+    span_id = f'py{os.getpid()}-{next(_trace_ids)}'
+    parent = _trace_local.stack[-1]
+    _trace_local.stack.append(span_id)
+    start = time.time()
+    try:
+        yield
+    finally:
+        _trace_local.stack.pop()
+        event = {'name': name, 'cat': 'setup', 'ph': 'X',
+                 'ts': int(start * 1e6),
+                 'dur': int((time.time() - start) * 1e6),
+                 'pid': os.getpid(), 'tid': threading.get_native_id(),
+                 'args': {'id': span_id, 'parent': parent}}
+        with _trace_lock, open(trace, 'a') as f:
+            f.write(json.dumps(event, separators=(',', ':')) + '\n')
+
 def compare_paths(x, y):
     def forcomp(path):
         nice = nicepath(path)
@@ -230,269 +258,455 @@ def update_repository(repo_name, url, path, branch='main'):
         repo = pygit2.Repository(path)
         pull(repo, branch=branch, repo_name=repo_name, remote_url=url)
 
-os_type = get_os_type()
-
-shell = os.path.basename(os.environ['SHELL'])
 
-home = os.environ['HOME']
-isminerva = bool(re.search("hpc", home))
+class StageOutput:
+    """
+    Stream that sends writes from a running stage to that stage's buffer.
 
-assert 'SETUP_SCRIPT' in os.environ.keys(), 'Run setup.sh instead!'
-assert os.environ['SETUP_SCRIPT'] == '1', 'Run setup.sh instead!'
+    Installed as sys.stdout and sys.stderr by run_stages so the output of
+    stages running at the same time is not interleaved. Writes from other
+    threads go to the wrapped stream.
 
-for x in ['scripts', 'src', 'bin']: mkdir(home, 'local', x)
+    Args:
+        stream (file): The stream to wrap.
+    """
 
-path_labops = nicepath(home, 'local', 'src', 'lab_operations')
-path_serverscripts = nicepath(home, 'local', 'src', 'minerva_servers')
+    local = threading.local()
 
-update_repository(
-    repo_name='Scripts and config files',
-    url='https://github.com/marcoralab/lab_operations.git',
-    path=path_labops)
+    def __init__(self, stream):
+        self.stream = stream
 
-update_repository(
-    repo_name='Server scripts',
-    url='https://github.com/BEFH/minerva_servers.git',
-    path=path_serverscripts,
-    branch="master")
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        return (buffer if buffer is not None else self.stream).write(text)
 
-# Symlink config files
+    def flush(self):
+        self.stream.flush()
 
-f_conf = [f for f in pathlib.Path(path_labops + "/config_files/").glob('*')
-          if not f.name.endswith(".condarc")]
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
 
-f_conflinks = [link_if_absent(src, destdir=home) for src in f_conf]
+def run_stages(stages):
+    """
+    Run setup stages concurrently, each once its dependencies have finished.
 
-discrep_conf = {os.path.basename(x): y for x, y in zip(f_conf, f_conflinks)
-                if not compare_paths(x, y)}
+    The output of each stage is printed in one piece when it finishes. A
+    stage whose dependency failed is skipped. Prompts must be answered
+    before calling this, since stages run in background threads.
 
-if len(discrep_conf) > 0:
-    for f, realpath in discrep_conf.items():
-        print(f'Warning: The config file {f} does not point to the lab repo.')
-        if realpath == nicepath(home, f):
-            print('         It is a file in your home directory\n')
-        else:
-            print('         It points to the following file:')
-            print(f'         {realpath}\n')
+    Args:
+        stages (dict): Stage names to (function, list of dependency names).
 
-scriptdir = nicepath(home, 'local', 'scripts')
-bindir = nicepath(home, 'local', 'bin')
-scriptdir_team = nicepath('/sc/arion/projects/load', 'scripts')
+    Returns:
+        list: Names of the stages that failed or were skipped.
+    """
+    done, failed = set(), set()
+    running = {}
+    timing = {}
+    print_lock = threading.Lock()
+    stdout, stderr = sys.stdout, sys.stderr
+
+    def run(name, func):
+        StageOutput.local.buffer = io.StringIO()
+        start = time.time()
+        try:
+            with span(name):
+                func()
+            ok = True
+        except Exception as e:
+            print(f'Error: {type(e).__name__}: {e}')
+            ok = False
+        timing[name] = time.time() - start
+        output = StageOutput.local.buffer.getvalue()
+        StageOutput.local.buffer = None
+        # Keep only the last state of lines redrawn with \r (progress bars)
+        lines = [[part for part in line.split('\r') if part.strip()][-1:]
+                 for line in output.split('\n')]
+        with print_lock:
+            state = 'done' if ok else 'FAILED'
+            stdout.write(f'==> {name}: {state} in {timing[name]:.1f}s\n')
+            stdout.write(''.join(f'    {l[0]}\n' for l in lines if l))
+            stdout.flush()
+        return ok
+
+    unknown = {d for _, deps in stages.values() for d in deps} - set(stages)
+    assert not unknown, f'Unknown setup stages: {", ".join(sorted(unknown))}'
+    start = time.time()
+    sys.stdout, sys.stderr = StageOutput(stdout), StageOutput(stderr)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(len(stages)) as pool:
+            while len(done) + len(failed) < len(stages):
+                progress = False
+                for name, (func, deps) in stages.items():
+                    if name in done or name in failed or name in running:
+                        continue
+                    if any(d in failed for d in deps):
+                        with print_lock:
+                            print(f'==> {name}: skipped, it needs '
+                                  f'{", ".join(d for d in deps if d in failed)}')
+                        failed.add(name)
+                        progress = True
+                    elif all(d in done for d in deps):
+                        running[name] = pool.submit(run, name, func)
+                        progress = True
+                if not running and not progress:
+                    # The remaining stages wait on a dependency cycle
+                    waiting = [n for n in stages
+                               if n not in done and n not in failed]
+                    with print_lock:
+                        print(f'==> skipped {", ".join(waiting)}: their '
+                              'dependencies form a cycle')
+                    failed.update(waiting)
+                    break
+                finished, _ = concurrent.futures.wait(
+                    running.values(),
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for name in [n for n, f in running.items() if f in finished]:
+                    (done if running.pop(name).result() else failed).add(name)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    if timing:
+        print(f'Setup stages took {time.time() - start:.1f}s; the longest '
+              f'was {max(timing, key=timing.get)} at '
+              f'{max(timing.values()):.1f}s.')
+    return sorted(failed)
+
+def ask_profile(label, name, ask_install=True):
+    """
+    Ask up front whether and how to install a Snakemake profile.
 
-if not scriptdir in os.environ['PATH'].split(':'):
-    if shell == 'fish':
-        shell_conf = nicepath(home, '.config', 'fish', 'config.fish')
-    elif shell == 'bash':
-        shell_conf = nicepath(home, '.bashrc')
-    elif shell == 'zsh':
-        shell_conf = nicepath(home, '.zshrc')
-    else:
-        shell_conf = input("Enter absolute path to your shell config file:")
+    Args:
+        label (str): Description of the profile for the prompts.
+        name (str): The default profile name.
+        ask_install (bool): Ask whether to install it at all.
 
-    with open(shell_conf, "a") as f:
-        if shell == 'fish':
-            f.write(f'\nfish_add_path -g "{scriptdir}"\n')
-            f.write(f'\nfish_add_path -g "{bindir}"\n')
-            if isminerva:
-                f.write(f'\nfish_add_path -g "{scriptdir_team}"\n')
-        else:
-            f.write(f'\nexport PATH="{scriptdir}:$PATH"\n')
-            f.write(f'\nexport PATH="{bindir}:$PATH"\n')
-            if isminerva:
-                f.write(f'\nexport PATH="{scriptdir_team}:$PATH"\n')
-
-mkdir(home, '.ssh', mode=0o700)
-
-if not isminerva:
-    mkdir(home, '.ssh', 'cm_socket', mode=0o700)
-    configpath = nicepath(home, '.ssh', 'config')
-    minerva_username = input("Enter minerva username: ")
-    ssh_config = '''Host minerva
+    Returns:
+        dict: install (bool), and if installing, the profile name and
+            whether to overwrite it.
+    """
+    import click
+    confdir = os.path.expanduser('~/.config/snakemake')
+    if ask_install and not click.confirm(f'Install {label} profile?',
+                                         default=True):
+        return {'install': False}
+    if not os.path.isdir(os.path.join(confdir, name)):
+        return {'install': True, 'name': name, 'overwrt': False}
+    print(f'{label} "{name}" profile already exists.')
+    if click.confirm(f'Continue without creating new {label} profile?',
+                     default=True):
+        return {'install': False}
+    if click.confirm(f'Overwrite {label} profile?', default=True):
+        return {'install': True, 'name': name, 'overwrt': True}
+    return {'install': True, 'overwrt': False,
+            'name': click.prompt(f'New {label} profile name:')}
+
+SSH_CONFIG = '''Host minerva
   HostName minerva12.hpc.mssm.edu
   User {}
   ForwardX11Trusted yes
-Host *
+{}Host *
   ControlPath ~/.ssh/cm_socket/%r@%h:%p
   ControlMaster auto
   ControlPersist 1m
   Compression yes
   ServerAliveInterval 240
   ServerAliveCountMax 2
-'''.format(minerva_username)
-    if os.path.exists(configpath):
-        print('Check that the following exists in your .ssh/config:')
-        print('\n' + ssh_config + '\n\n')
-    else:
-        print('writing to ~/.ssh/config...')
-        with open(configpath,"w") as f:
-            f.writelines(ssh_config)
-    os.chmod(configpath, 0o644)
-    print('making ssh keys...')
-    make_keys(home)
+'''
 
-    f_scpt = [f for f in pathlib.Path(path_labops + "/scripts/").glob('*')
-              if not f.name.startswith("setup")]
+def main():
+    os_type = get_os_type()
 
-    f_scptlinks = [link_if_absent(src, destdir=[home, 'local', 'scripts'])
-                   for src in f_scpt]
+    shell = os.path.basename(os.environ['SHELL'])
 
-    f_rslink = link_if_absent(nicepath(path_serverscripts, 'rstudio_minerva'),
-                              destdir=[home, 'local', 'scripts'])
+    home = os.environ['HOME']
+    isminerva = bool(re.search("hpc", home))
 
-    f_vsclink = link_if_absent(nicepath(path_serverscripts, 'vscode_minerva'),
-                              destdir=[home, 'local', 'scripts'])
+    assert 'SETUP_SCRIPT' in os.environ.keys(), 'Run setup.sh instead!'
+    assert os.environ['SETUP_SCRIPT'] == '1', 'Run setup.sh instead!'
 
-    f_scptlinks_sub = [re.sub("^\.\.", nicepath(home, "local"), x)
-                       for x in f_scptlinks]
+    for x in ['scripts', 'src', 'bin']: mkdir(home, 'local', x)
 
-    discrep_srpt = {os.path.basename(x): y
-                    for x, y in zip(f_scpt, f_scptlinks_sub)
-                    if not compare_paths(x, y)}
+    path_labops = nicepath(home, 'local', 'src', 'lab_operations')
+    path_serverscripts = nicepath(home, 'local', 'src', 'minerva_servers')
 
-    if len(discrep_srpt) > 0:
-        for f, realpath in discrep_srpt.items():
-            print(f'Warning: The script {f} does not point to the lab repo.')
-            if realpath == nicepath(home, f):
-                print('         It is a file in your script directory\n')
-            else:
-                print('         It points to the following file:')
-                print(f'         {realpath}\n')
-else:
-    print('making ssh keys...')
-    make_keys(home, overwrite=True)
-
-    print('setting up singularity cache')
-    user = os.environ['USER']
-    cachedir = ['/sc/arion/work', user, 'singularity', 'cache']
-    sdir = [home, '.singularity']
-    mkdir(cachedir)
-    mkdir(sdir)
-    cachedir_home = nicepath(sdir + ['cache'])
-    if os.path.islink(cachedir_home):
-        os.remove(cachedir_home)
-    elif os.path.exists(cachedir_home):
-        for root, dirs, files in os.walk(cachedir_home,
-                                         topdown=False):
-            for name in files:
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
-        os.rmdir(cachedir_home)
-
-    os.symlink(nicepath(cachedir), cachedir_home)
-
-    print('installing LSF profile for snakemake')
-    # load in profile script as a module
-    profscript = nicepath(home, 'local', 'src', 'lab_operations',
-                          'scripts', 'setup_snakemake_profiles.py')
-    spec = importlib.util.spec_from_file_location('snakeprofile', profscript)
-    sp = importlib.util.module_from_spec(spec)
-    sys.modules['snakeprofile'] = sp
-    spec.loader.exec_module(sp)
-    import click
-    #Add the profile
-    confdir = os.path.expanduser('~/.config/snakemake')
-    proj = click.prompt('Minerva Project:', default='acc_LOAD')
-
-    profile_name='lsf'
-    tf_overwrite = False
-    lsfexists = False
-    makelsf = True
-    outpath = os.path.join(confdir, 'lsf')
-
-    if os.path.isdir(outpath):
-        print('lsf profile already exists.')
-        lsfexists = True
-        mkprompt = 'Continue without creating new LSF profile?'
-        makelsf = not click.confirm(mkprompt, default=True)
-
-    if makelsf and lsfexists:
-        if click.confirm('Overwrite LSF profile?', default=True):
-            tf_overwrite = True
-        else:
-            profile_name = click.prompt('Profile Name:')
-    else:
-        profile_name='choose_quiet'
+    scriptdir = nicepath(home, 'local', 'scripts')
+    bindir = nicepath(home, 'local', 'bin')
+    scriptdir_team = nicepath('/sc/arion/projects/load', 'scripts')
 
-    if makelsf:
-        try:
-            outpath = sp.install_lsf_profile(use_defaults=True,
-                                             project=proj,
-                                             overwrt=tf_overwrite,
-                                             p_name=profile_name)
-        except sp.OutputDirExistsException:
-            print('lsf profile already exists.')
-            if click.confirm('Overwrite LSF profile?', default=True):
-                outpath = sp.install_lsf_profile(use_defaults=tf_default,
-                                                 project=proj,
-                                                 overwrt=True)
-            else:
-                profile_name = click.prompt('New profile name:')
-                outpath = sp.install_lsf_profile(use_defaults=tf_default,
-                                                 project=proj,
-                                                 p_name=profile_name)
-        else:
-            print("LSF profile installed.")
+    mkdir(home, '.ssh', mode=0o700)
 
+    # Ask everything up front so the stages can run unattended and in parallel
 
-    try:
-        if click.confirm("Install Snakemake 7 local profile?", default=True):
-            sp.install_local_profile(lsf_profile=outpath, profile_name="local")
-    except sp.OutputDirExistsException:
-        print('Snakemake 7 "local" profile already exists.')
-        mkprompt = 'Continue without creating new local profile?'
-        makelocal = not click.confirm(mkprompt, default=True)
-        if makelocal and click.confirm('Overwrite Snakemake 7 local profile?',
-                                       default=True):
-            sp.install_local_profile(lsf_profile=outpath,
-                                     profile_name="local",
-                                     overwrt=True)
-        elif makelocal:
-            local_name = click.prompt('New Snakemake 7 local profile name:')
-            sp.install_local_profile(profile_name=local_name)
+    if shell == 'fish':
+        shell_rc = nicepath(home, '.config', 'fish', 'config.fish')
+    elif shell == 'bash':
+        shell_rc = nicepath(home, '.bashrc')
+    elif shell == 'zsh':
+        shell_rc = nicepath(home, '.zshrc')
     else:
-        print("Snakemake 7 local profile installed.")
+        shell_rc = None
 
-    try:
-        if click.confirm("Install Snakemake 8 LSF profile?", default=True):
-            sp.install_lsf8_profile(lsf_profile=outpath,
-                                    profile_name="lsf8",
-                                    project=proj)
-    except sp.OutputDirExistsException:
-        print('Snakemake 8 "lsf8" profile already exists.')
-        mkprompt = 'Continue without creating new Snakemake 8 LSF profile?'
-        makelsf8 = not click.confirm(mkprompt, default=True)
-        if makelsf8 and click.confirm('Overwrite Snakemake 8 LSF profile?',
-                                       default=True):
-            sp.install_lsf8_profile(lsf_profile=outpath,
-                                    project=proj,
-                                    profile_name="local",
-                                    overwrt=True)
-        elif makelsf8:
-            lsf8_name = click.prompt('New Snakemake 8 LSF profile name:')
-            sp.install_lsf8_profile(profile_name=lsf8_name,
-                                    project=proj)
-    except Exception as e:
-        print("Failed to install Snakemake 8 LSF profile.")
-    else:
-        print("Snakemake 8 LSF profile installed.")
+    shell_conf = None
+    if not scriptdir in os.environ['PATH'].split(':'):
+        if shell_rc is None:
+            shell_rc = input("Enter absolute path to your shell config file:")
+        shell_conf = shell_rc
 
-    try:
-        if click.confirm("Install Snakemake 8 local profile?", default=True):
-            sp.install_local8_profile(lsf_profile=outpath, profile_name="local8")
-    except sp.OutputDirExistsException:
-        print('Snakemake 8 "local8" profile already exists.')
-        mkprompt = 'Continue without creating new Snakemake 8 local profile?'
-        makelocal = not click.confirm(mkprompt, default=True)
-        if makelocal and click.confirm('Overwrite Snakemake 8 local profile?',
-                                       default=True):
-            sp.install_local8_profile(lsf_profile=outpath,
-                                      profile_name="local8",
-                                      overwrt=True)
-        elif makelocal:
-            local8_name = click.prompt('New local profile name:')
-            sp.install_local8_profile(profile_name=local8_name)
-    except Exception as e:
-        print("Failed to install Snakemake 8 local profile.")
+    if not isminerva:
+        minerva_username = input("Enter minerva username: ")
+    else:
+        import click
+        proj = click.prompt('Minerva Project:', default='acc_LOAD')
+        profiles = {
+            'lsf': ask_profile('LSF', 'lsf', ask_install=False),
+            'local': ask_profile('Snakemake 7 local', 'local'),
+            'lsf8': ask_profile('Snakemake 8 LSF', 'lsf8'),
+            'local8': ask_profile('Snakemake 8 local', 'local8')}
+        scratch = click.confirm('Let LSF jobs put shadow directories and '
+                                'staged files on node-local disk?',
+                                default=True)
+
+    # Stages
+
+    def update_labops():
+        update_repository(
+            repo_name='Scripts and config files',
+            url='https://github.com/marcoralab/lab_operations.git',
+            path=path_labops)
+
+    def update_serverscripts():
+        update_repository(
+            repo_name='Server scripts',
+            url='https://github.com/BEFH/minerva_servers.git',
+            path=path_serverscripts,
+            branch="master")
+
+    def link_config():
+        f_conf = [f for f in pathlib.Path(path_labops + "/config_files/").glob('*')
+                  if not f.name.endswith(".condarc")]
+
+        f_conflinks = [link_if_absent(src, destdir=home) for src in f_conf]
+
+        discrep_conf = {os.path.basename(x): y
+                        for x, y in zip(f_conf, f_conflinks)
+                        if not compare_paths(x, y)}
+
+        if len(discrep_conf) > 0:
+            for f, realpath in discrep_conf.items():
+                print(f'Warning: The config file {f} does not point to the lab repo.')
+                if realpath == nicepath(home, f):
+                    print('         It is a file in your home directory\n')
+                else:
+                    print('         It points to the following file:')
+                    print(f'         {realpath}\n')
+
+    def add_to_path():
+        if shell_conf is None:
+            return
+        with open(shell_conf, "a") as f:
+            if shell == 'fish':
+                f.write(f'\nfish_add_path -g "{scriptdir}"\n')
+                f.write(f'\nfish_add_path -g "{bindir}"\n')
+                if isminerva:
+                    f.write(f'\nfish_add_path -g "{scriptdir_team}"\n')
+            else:
+                f.write(f'\nexport PATH="{scriptdir}:$PATH"\n')
+                f.write(f'\nexport PATH="{bindir}:$PATH"\n')
+                if isminerva:
+                    f.write(f'\nexport PATH="{scriptdir_team}:$PATH"\n')
+
+    def write_ssh_config():
+        mkdir(home, '.ssh', 'cm_socket', mode=0o700)
+        configpath = nicepath(home, '.ssh', 'config')
+        # Host settings come before Host * so benchmarked options take precedence
+        minerva_transport = ''.join(f'  {k} {v}\n'
+                                    for k, v in transport_options('minerva').items())
+        if not minerva_transport:
+            print('Tip: run ssh_transport_bench.py minerva after setup to tune '
+                  'compression and ciphers for Minerva.')
+        print('Tip: run ssh_keeper.py start minerva to log in once and keep '
+              'the connection open for ssh, scp, sshfs and the lab scripts.')
+        ssh_config = SSH_CONFIG.format(minerva_username, minerva_transport)
+        if os.path.exists(configpath):
+            print('Check that the following exists in your .ssh/config:')
+            print('\n' + ssh_config + '\n\n')
+        else:
+            print('writing to ~/.ssh/config...')
+            with open(configpath,"w") as f:
+                f.writelines(ssh_config)
+        os.chmod(configpath, 0o644)
+
+    def ssh_keys():
+        print('making ssh keys...')
+        make_keys(home, overwrite=isminerva)
+
+    def link_scripts():
+        f_scpt = [f for f in pathlib.Path(path_labops + "/scripts/").glob('*')
+                  if not f.name.startswith("setup")]
+
+        f_scptlinks = [link_if_absent(src, destdir=[home, 'local', 'scripts'])
+                       for src in f_scpt]
+
+        f_rslink = link_if_absent(nicepath(path_serverscripts, 'rstudio_minerva'),
+                                  destdir=[home, 'local', 'scripts'])
+
+        f_vsclink = link_if_absent(nicepath(path_serverscripts, 'vscode_minerva'),
+                                  destdir=[home, 'local', 'scripts'])
+
+        f_scptlinks_sub = [re.sub("^\.\.", nicepath(home, "local"), x)
+                           for x in f_scptlinks]
+
+        discrep_srpt = {os.path.basename(x): y
+                        for x, y in zip(f_scpt, f_scptlinks_sub)
+                        if not compare_paths(x, y)}
+
+        if len(discrep_srpt) > 0:
+            for f, realpath in discrep_srpt.items():
+                print(f'Warning: The script {f} does not point to the lab repo.')
+                if realpath == nicepath(home, f):
+                    print('         It is a file in your script directory\n')
+                else:
+                    print('         It points to the following file:')
+                    print(f'         {realpath}\n')
+
+    def singularity_cache():
+        print('setting up singularity cache')
+        user = os.environ['USER']
+        cachedir = ['/sc/arion/work', user, 'singularity', 'cache']
+        sdir = [home, '.singularity']
+        mkdir(cachedir)
+        mkdir(sdir)
+        cachedir_home = nicepath(sdir + ['cache'])
+        if os.path.islink(cachedir_home):
+            os.remove(cachedir_home)
+        elif os.path.exists(cachedir_home):
+            for root, dirs, files in os.walk(cachedir_home,
+                                             topdown=False):
+                for name in files:
+                    os.remove(os.path.join(root, name))
+                for name in dirs:
+                    os.rmdir(os.path.join(root, name))
+            os.rmdir(cachedir_home)
+
+        os.symlink(nicepath(cachedir), cachedir_home)
+
+    profile_lock = threading.Lock()
+
+    def load_profile_script():
+        # load in profile script as a module, once, after the update of
+        # lab_operations. Stages call this concurrently, so the others wait
+        # until the module has finished executing.
+        with profile_lock:
+            if 'snakeprofile' in sys.modules:
+                return sys.modules['snakeprofile']
+            profscript = nicepath(home, 'local', 'src', 'lab_operations',
+                                  'scripts', 'setup_snakemake_profiles.py')
+            spec = importlib.util.spec_from_file_location('snakeprofile',
+                                                          profscript)
+            sp = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(sp)
+            sys.modules['snakeprofile'] = sp
+            return sp
+
+    lsf_outpath = os.path.join(os.path.expanduser('~/.config/snakemake'), 'lsf')
+
+    def lsf_profile():
+        nonlocal lsf_outpath
+        sp = load_profile_script()
+        answer = profiles['lsf']
+        if not answer['install']:
+            print('Keeping existing LSF profile.')
+            return
+        # choose_quiet installs as lsf without the name warning
+        p_name = 'choose_quiet' if answer['name'] == 'lsf' else answer['name']
+        lsf_outpath = sp.install_lsf_profile(use_defaults=True,
+                                             project=proj,
+                                             overwrt=answer['overwrt'],
+                                             p_name=p_name, scratch=scratch)
+        print("LSF profile installed.")
+
+    def output_cache():
+        sp = load_profile_script()
+        cachedir = sp.install_output_cache()
+        if cachedir is None:
+            return
+        if shell == 'fish':
+            line = f'set -gx SNAKEMAKE_OUTPUT_CACHE "{cachedir}"'
+        else:
+            line = f'export SNAKEMAKE_OUTPUT_CACHE="{cachedir}"'
+        if shell_rc is None:
+            print('Add this to your shell config to use the shared Snakemake '
+                  f'output cache:\n  {line}')
+            return
+        has_export = False
+        if os.path.exists(shell_rc):
+            with open(shell_rc, 'r') as f:
+                has_export = 'SNAKEMAKE_OUTPUT_CACHE' in f.read()
+        if not has_export:
+            with open(shell_rc, 'a') as f:
+                f.write(f'\n{line}\n')
+        # The profile stages only turn caching on once the variable is set
+        os.environ.setdefault('SNAKEMAKE_OUTPUT_CACHE', cachedir)
+        print(f'Shared Snakemake output cache at {cachedir}')
+
+    def storage_cache():
+        sp = load_profile_script()
+        if sp.install_storage_cache() is not None:
+            print(f'Shared Snakemake storage cache at {sp.STORAGE_CACHE}')
+
+    def snakemake_profile(key, label, install):
+        """Stage installing one of the profiles derived from the LSF profile."""
+        def stage():
+            answer = profiles[key]
+            if not answer['install']:
+                return
+            sp = load_profile_script()
+            kwargs = ({'project': proj, 'scratch': scratch} if key == 'lsf8'
+                      else {})
+            install(sp)(lsf_profile=lsf_outpath, profile_name=answer['name'],
+                        overwrt=answer['overwrt'], **kwargs)
+            print(f"{label} profile installed.")
+        return stage
+
+    stages = {
+        'update lab_operations': (update_labops, []),
+        'update minerva_servers': (update_serverscripts, []),
+        'link config files': (link_config, ['update lab_operations']),
+        'add scripts to PATH': (add_to_path, []),
+        'ssh keys': (ssh_keys, [])}
+
+    if not isminerva:
+        stages.update({
+            'ssh config': (write_ssh_config, []),
+            'link scripts': (link_scripts, ['update lab_operations',
+                                            'update minerva_servers'])})
     else:
-        print("Snakemake 8 local profile installed.")
+        stages.update({
+            'singularity cache': (singularity_cache, []),
+            'Snakemake output cache': (output_cache, ['update lab_operations',
+                                                      'add scripts to PATH']),
+            'Snakemake storage cache': (storage_cache,
+                                        ['update lab_operations']),
+            'LSF profile': (lsf_profile, ['update lab_operations',
+                                          'Snakemake output cache']),
+            'Snakemake 7 local profile': (
+                snakemake_profile('local', 'Snakemake 7 local',
+                                  lambda sp: sp.install_local_profile),
+                ['LSF profile']),
+            'Snakemake 8 LSF profile': (
+                snakemake_profile('lsf8', 'Snakemake 8 LSF',
+                                  lambda sp: sp.install_lsf8_profile),
+                ['LSF profile', 'Snakemake output cache',
+                 'Snakemake storage cache']),
+            'Snakemake 8 local profile': (
+                snakemake_profile('local8', 'Snakemake 8 local',
+                                  lambda sp: sp.install_local8_profile),
+                ['LSF profile', 'Snakemake storage cache'])})
+
+    failed = run_stages(stages)
+    if failed:
+        print(f'These setup stages did not complete: {", ".join(failed)}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -26,6 +26,137 @@ source_bashrc() {
   set -euo pipefail
 }
 
+# Timing spans for each stage, written as Chrome trace events to
+# $LABOPS_TRACE. setup.py adds its own spans under $LABOPS_TRACE_PARENT.
+# Pass --keep-trace to save the trace in ~/.local/share/lab_operations/traces
+# and compare it with the previous saved run. Nothing is uploaded.
+keep_trace=${LABOPS_KEEP_TRACE:-0}
+for arg in "$@"; do
+  if [[ "$arg" == "--keep-trace" ]]; then
+    keep_trace=1
+  fi
+done
+tracedir=$HOME/.local/share/lab_operations/traces
+mkdir -p $HOME/.cache/lab_operations
+# In the home directory so setup.py can write to it from another node
+export LABOPS_TRACE=$HOME/.cache/lab_operations/setup_trace_$$.jsonl
+export LABOPS_TRACE_PARENT=""
+: > $LABOPS_TRACE
+span_stack=()
+span_count=0
+# Background subshells set their own prefix, since they inherit span_count
+span_prefix=sh$$
+
+now_us() {
+  local t=${EPOCHREALTIME:-}
+  if [[ -z "$t" ]]; then # bash < 5
+    t=$(perl -MTime::HiRes=time -e 'printf "%.6f", time' 2> /dev/null \
+      || echo "$(date +%s).000000")
+  fi
+  echo ${t//[.,]/}
+}
+
+span_begin() {
+  span_count=$((span_count + 1))
+  span_stack+=("$span_prefix-$span_count|$(now_us)|$1")
+  export LABOPS_TRACE_PARENT="$span_prefix-$span_count"
+}
+
+span_end() {
+  local n=${#span_stack[@]}
+  local top=${span_stack[$((n - 1))]}
+  local id=${top%%|*} rest=${top#*|}
+  local start=${rest%%|*} name=${rest#*|}
+  unset "span_stack[$((n - 1))]"
+  LABOPS_TRACE_PARENT=""
+  if [[ $n -gt 1 ]]; then
+    LABOPS_TRACE_PARENT=${span_stack[$((n - 2))]%%|*}
+  fi
+  printf '{"name":"%s","cat":"setup","ph":"X","ts":%s,"dur":%s,"pid":%s,"tid":%s,"args":{"id":"%s","parent":"%s"}}\n' \
+    "$name" $start $(($(now_us) - start)) $$ ${BASHPID:-$$} "$id" \
+    "$LABOPS_TRACE_PARENT" >> $LABOPS_TRACE
+}
+
+# Print spans as a tree in start order, with the previous run if given
+trace_summary() {
+  awk -v prev="${2:-}" '
+    function field(key,   s) {
+      if (!match($0, "\"" key "\":\"?[^\",}]*")) return ""
+      s = substr($0, RSTART + length(key) + 3, RLENGTH - length(key) - 3)
+      sub(/^"/, "", s)
+      return s
+    }
+    BEGIN {
+      while (prev != "" && (getline < prev) > 0)
+        if (field("name") != "") before[field("name")] = field("dur") / 1e6
+    }
+    field("name") != "" {
+      n++
+      name[n] = field("name"); ts[n] = field("ts"); dur[n] = field("dur") / 1e6
+      id[n] = field("id"); parent[id[n]] = field("parent")
+      if (dur[n] > total) total = dur[n]
+    }
+    END {
+      for (i = 1; i <= n; i++) {
+        depth = 0
+        for (p = parent[id[i]]; p != "" && depth < 20; p = parent[p]) depth++
+        line = sprintf("%9.1fs %4.0f%%  %" (2 * depth) "s%s", dur[i],
+                       100 * dur[i] / (total ? total : 1), "", name[i])
+        if (name[i] in before) line = line sprintf("  (was %.1fs)", before[name[i]])
+        print ts[i] "\t" line
+      }
+    }' "$1" | sort -n | cut -f2-
+}
+
+trace_finish() {
+  local status=$?
+  while [[ ${#span_stack[@]} -gt 0 ]]; do
+    span_end
+  done
+  echo -e "\nSetup timing:"
+  local previous=""
+  if [[ $keep_trace -eq 1 ]]; then
+    mkdir -p $tracedir
+    previous=$(ls -t $tracedir/setup_*.json 2> /dev/null | head -n 1 || true)
+  fi
+  trace_summary $LABOPS_TRACE "$previous" || true
+  if [[ $keep_trace -eq 1 ]]; then
+    # One event per line, loadable in chrome://tracing or ui.perfetto.dev
+    local saved=$tracedir/setup_$(date +%Y%m%d_%H%M%S)_$(hostname -s).json
+    awk 'BEGIN { print "[" } NR > 1 { print "," } { printf "%s", $0 }
+         END { print "\n]" }' $LABOPS_TRACE > $saved
+    echo "Trace saved to $saved"
+  fi
+  rm -f $LABOPS_TRACE
+  exit $status
+}
+trap trace_finish EXIT
+
+span_begin setup.sh
+
+# Does not depend on the conda setup, so it runs in the background
+apptainer_remotes() {
+  ml -q singularity singularity-ce &>/dev/null && ml -singularity -singularity-ce
+  ml apptainer/1.3.6
+  
+  span_begin "apptainer remotes"
+  set +u +e +o pipefail
+  sycloud_added=false
+  if ! apptainer remote list | grep -q '^SylabsCloud'; then
+    echo "SylabsCloud remote not found, adding it now"
+    apptainer remote add --no-login SylabsCloud cloud.sycloud.io
+    sycloud_added=true
+  fi
+  
+  if ! apptainer remote list | grep -E -q '^SylabsCloud\s+(\w|\.)+\s+YES'; then
+    if [[ $sycloud_added == "false" ]]; then
+      echo "SylabsCloud remote not activated, activating it now"
+    fi
+    apptainer remote use SylabsCloud
+  fi
+  span_end
+}
+
 minerva=0
 
 if echo $HOME | grep -q "^/hpc/users/"; then
@@ -47,6 +178,7 @@ if echo $HOME | grep -q "^/hpc/users/"; then
   newconda=0
   if ! conda --help &> /dev/null; then
     export newconda=1
+    span_begin "install Miniforge"
     echo Installing conda and mamba using Miniforge
     conda_prefix="/sc/arion/work/$USER/conda/miniforge3"
     conda_inst=Miniforge3-$(uname)-$(uname -m).sh
@@ -74,6 +206,7 @@ if echo $HOME | grep -q "^/hpc/users/"; then
       $conda_prefix/bin/conda init bash
       source_bashrc
     fi
+    span_end
     echo Done installing Miniforge
   elif [ -n "${CONDA_PREFIX+x}" ]; then
     source_bashrc
@@ -84,6 +217,12 @@ if echo $HOME | grep -q "^/hpc/users/"; then
     source_bashrc
   fi
 
+  # Output is shown at the end so it does not mix with mamba's
+  apptainer_log=$(mktemp)
+  span_prefix=sh$$-apptainer apptainer_remotes > $apptainer_log 2>&1 &
+  apptainer_pid=$!
+
+  span_begin "update mamba and conda"
   if ! mamba --help &> /dev/null; then
     echo Installing mamba
     conda install -y mamba
@@ -93,6 +232,7 @@ if echo $HOME | grep -q "^/hpc/users/"; then
   fi
   echo Updating mamba and conda
   mamba update -y mamba conda
+  span_end
 
   if ! mamba activate &> /dev/null; then
     echo Initializing mamba
@@ -106,12 +246,14 @@ if echo $HOME | grep -q "^/hpc/users/"; then
 
   if ! conda env list | grep -qE "^py$pyversion\s+"; then
     echo Installing py$pyversion environment
+    span_begin "mamba create py$pyversion"
     mamba create -y -n py$pyversion python=$pyversion snakemake ipython ipdb \
       jupyterlab biopython visidata miller flippyr gh git vim pygit2 tmux \
       htop powerline-status click cookiecutter squashfs-tools radian \
       snakemake-executor-plugin-lsf snakemake-storage-plugin-http \
       snakemake-storage-plugin-ftp \
       r-base=$rversion r-essentials r-languageserver tqdm # r-httpgd
+    span_end
   fi
 
   if [[ "$shelltype" == "bash" ]]; then
@@ -135,6 +277,7 @@ else
     echo Downloading .condarc to home direcctory
     curl https://raw.githubusercontent.com/marcoralab/lab_operations/main/config_files/local.condarc > $HOME/.condarc 2> /dev/null
     echo Ensuring conda and mamba are installed and updated
+    span_begin "install Miniforge"
     conda_inst=Miniforge3-$(uname)-$(uname -m).sh
     curl -L "https://github.com/conda-forge/miniforge/releases/latest/download/$conda_inst" > $conda_inst
     bash $conda_inst -b
@@ -161,23 +304,32 @@ else
       fi
       source $HOME/.bash_profile
     fi
+    span_end
+    span_begin "update mamba and conda"
     mamba update -y mamba conda
+    span_end
+    span_begin "install packages"
     set +u
     mamba install -y python=$pyversion $lcl_pkgs
     set -u
+    span_end
   fi
 
   if [[ $newconda -eq 0 ]]; then
     if [ ! -f $HOME/.condarc ]; then
       curl https://raw.githubusercontent.com/marcoralab/lab_operations/main/config_files/local.condarc > $HOME/.condarc
     fi
+    span_begin "update mamba and conda"
     if ! mamba --help &> /dev/null; then
       conda install -y mamba
     fi
     mamba clean --index-cache -y
     mamba update -y mamba conda
+    span_end
+    span_begin "install packages"
     mamba install -y $lcl_pkgs -c conda-forge
     mamba update -y $lcl_pkgs -c conda-forge
+    span_end
   fi
 
   if [[ $newconda -eq 0 ]] && ! mamba activate &> /dev/null && grep -qv "profile.d/mamba.sh" ~/.bash_profile; then
@@ -194,17 +346,29 @@ fi
 echo Starting python install script
 export SETUP_SCRIPT=1
 
-curl https://raw.githubusercontent.com/marcoralab/lab_operations/main/scripts/setup.py > setup_lab.py
+# setup.py imports its helpers from labops/util.py, so keep the repo layout.
+# labops setup passes its own copies in LABOPS_SRC.
+rm -rf setup_lab
+mkdir -p setup_lab/scripts setup_lab/labops
+for f in scripts/setup.py labops/__init__.py labops/util.py; do
+  if [[ -n "${LABOPS_SRC:-}" ]]; then
+    cp $LABOPS_SRC/$f setup_lab/$f
+  else
+    curl https://raw.githubusercontent.com/marcoralab/lab_operations/main/$f > setup_lab/$f
+  fi
+done
+span_begin setup.py
 if [[ $windows -eq 1 ]]; then
-  $(dirname $CONDA_EXE)/python3 setup_lab.py || \
+  $(dirname $CONDA_EXE)/python3 setup_lab/scripts/setup.py || \
     echo Main setup script failed. Please tell Brian.
 elif [[ $minerva -eq 1 ]]; then
-  ssh -t li04e02 "bash -lc \"SETUP_SCRIPT=1 python3 $PWD/setup_lab.py\"" || \
+  ssh -t li04e02 "bash -lc \"SETUP_SCRIPT=1 LABOPS_TRACE=$LABOPS_TRACE LABOPS_TRACE_PARENT=$LABOPS_TRACE_PARENT python3 $PWD/setup_lab/scripts/setup.py\"" || \
     echo Main setup script failed. Please tell Brian.
 else
-  python3 setup_lab.py || echo Main setup script failed. Please tell Brian.
+  python3 setup_lab/scripts/setup.py || echo Main setup script failed. Please tell Brian.
 fi
-rm setup_lab.py
+span_end
+rm -r setup_lab
 
 if [[ $minerva -eq 1 ]]; then
   if ! grep -q singularity $SHELLCONF; then
@@ -215,24 +379,9 @@ if [[ $minerva -eq 1 ]]; then
     echo "Adding Singularity to .bashrc"
     echo "ml apptainer/1.3.6 2> /dev/null" >> ~/.bashrc
   fi
-  ml -q singularity singularity-ce &>/dev/null && ml -singularity -singularity-ce
-  ml apptainer/1.3.6
-  
-  set +u +e +o pipefail
-  sycloud_added=false
-  if ! apptainer remote list | grep -q '^SylabsCloud'; then
-    echo "SylabsCloud remote not found, adding it now"
-    apptainer remote add --no-login SylabsCloud cloud.sycloud.io
-    sycloud_added=true
-  fi
-  
-  if ! apptainer remote list | grep -E -q '^SylabsCloud\s+(\w|\.)+\s+YES'; then
-    if [[ $sycloud_added == "false" ]]; then
-      echo "SylabsCloud remote not activated, activating it now"
-    fi
-    apptainer remote use SylabsCloud
-  fi
-  set -euo pipefail
+  wait $apptainer_pid || true
+  cat $apptainer_log
+  rm -f $apptainer_log
 fi
 
 if [[ $windows -eq 1 ]]; then
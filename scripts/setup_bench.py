@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the setup.py helpers and Snakemake profile installers.
+
+Every operation runs several times, each time in a fresh temporary home,
+and the median time is compared with a saved baseline. The run fails when
+an operation is slower than its baseline by more than the threshold.
+Most of the cost of these helpers is metadata operations, so put the
+temporary homes on the filesystem you care about with --dir, e.g.
+/sc/arion/work/$USER:
+
+    setup_bench.py --update     # record a baseline
+    setup_bench.py              # compare with it
+
+Git remotes are local bare repositories and cookiecutter is replaced by a
+stand-in that renders the LSF profile without network access. Run it in
+the py3.13 environment, which has pygit2, tqdm and pyyaml.
+
+labops startup is also checked against a fixed budget, with or without a
+baseline, because it is paid by every command.
+
+The same benchmarks run as a pytest suite, with the workspace, cookiecutter
+and baseline as fixtures (tests/conftest.py). They are skipped unless asked
+for, and each operation is a test that fails on a regression, and with
+--bench-budgets also when over budget:
+
+    pytest tests --bench-update         # record a baseline
+    pytest tests --bench -k clone       # compare some operations with it
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import contextlib
+import subprocess
+import importlib.util
+
+import yaml
+import pygit2
+
+SCRIPTDIR = os.path.dirname(os.path.abspath(__file__))
+REPODIR = os.path.dirname(SCRIPTDIR)
+FILE_BASELINE = os.path.expanduser(
+    '~/.local/share/lab_operations/setup_bench.json')
+
+BENCHMARKS = {}
+# Seconds, including Python's own startup
+BUDGETS = {'labops --help': 0.15, 'labops screenshare --help': 0.25}
+
+
+def benchmark(name):
+    """
+    Register a benchmark.
+
+    The decorated function prepares a workspace and returns the function to
+    time, so that the preparation is not part of the measurement.
+    """
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def stub_cookiecutter():
+    """Install a cookiecutter stand-in that renders the LSF profile offline."""
+    class OutputDirExistsException(Exception):
+        pass
+
+    def cookiecutter(template, extra_context=None, output_dir='.',
+                     overwrite_if_exists=False, no_input=False):
+        outdir = os.path.join(output_dir, extra_context['profile_name'])
+        if os.path.exists(outdir) and not overwrite_if_exists:
+            raise OutputDirExistsException(outdir)
+        os.makedirs(outdir, exist_ok=True)
+        config = {k.replace('_', '-'): v for k, v in extra_context.items()
+                  if k != 'profile_name'}
+        with open(os.path.join(outdir, 'config.yaml'), 'w') as f:
+            yaml.dump(config, f, default_flow_style=False)
+        for script in ['lsf_submit.py', 'lsf_status.py', 'lsf_jobscript.sh']:
+            open(os.path.join(outdir, script), 'w').close()
+        return outdir
+
+    main = types.ModuleType('cookiecutter.main')
+    main.cookiecutter = cookiecutter
+    generate = types.ModuleType('cookiecutter.generate')
+    generate.OutputDirExistsException = OutputDirExistsException
+    package = types.ModuleType('cookiecutter')
+    package.main, package.generate = main, generate
+    sys.modules.update({'cookiecutter': package, 'cookiecutter.main': main,
+                        'cookiecutter.generate': generate})
+
+
+def load_script(name, filename):
+    """Import a script from this directory as a module."""
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(SCRIPTDIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_home(base):
+    """Create an empty home directory laid out like one after setup.sh."""
+    home = tempfile.mkdtemp(prefix='home_', dir=base)
+    for sub in [['.config', 'snakemake'], ['local', 'scripts'],
+                ['local', 'src'], ['local', 'bin']]:
+        os.makedirs(os.path.join(home, *sub))
+    return home
+
+
+def make_config_dir(path, nfiles):
+    """Create a directory of small config files, like config_files."""
+    os.makedirs(path)
+    for i in range(nfiles):
+        with open(os.path.join(path, f'.config{i}'), 'w') as f:
+            f.write(f'setting_{i} = {i}\n')
+    return path
+
+
+def make_remote(path, nfiles, file_kb=4):
+    """
+    Create a bare git repository with one commit on main.
+
+    Files are spread over subdirectories of 100 files each.
+    """
+    repo = pygit2.init_repository(path, bare=True, initial_head='main')
+    root = repo.TreeBuilder()
+    for d in range(0, nfiles, 100):
+        sub = repo.TreeBuilder()
+        for i in range(d, min(d + 100, nfiles)):
+            blob = repo.create_blob(os.urandom(file_kb * 512).hex().encode())
+            sub.insert(f'file{i}.txt', blob, pygit2.GIT_FILEMODE_BLOB)
+        root.insert(f'dir{d // 100}', sub.write(), pygit2.GIT_FILEMODE_TREE)
+    add_commit(repo, root.write())
+    return path
+
+
+def add_commit(repo, tree=None):
+    """Commit to main of a bare repository, by default adding one file."""
+    if isinstance(repo, str):
+        repo = pygit2.Repository(repo)
+    sig = pygit2.Signature('bench', 'bench@example.com')
+    parents = [] if repo.head_is_unborn else [repo.head.target]
+    if tree is None:
+        root = repo.TreeBuilder(repo.head.peel().tree)
+        blob = repo.create_blob(f'{time.time()}\n'.encode())
+        root.insert(f'new{time.time_ns()}.txt', blob, pygit2.GIT_FILEMODE_BLOB)
+        tree = root.write()
+    repo.create_commit('refs/heads/main', sig, sig, 'bench', tree, parents)
+
+
+@benchmark('nicepath x10000')
+def bench_nicepath(ws):
+    home = ws.home
+    return lambda: [ws.setup.nicepath(home, 'local', 'src', str(i))
+                    for i in range(10000)]
+
+
+@benchmark('mkdir x500')
+def bench_mkdir(ws):
+    def run():
+        for i in range(500):
+            ws.setup.mkdir(ws.home, 'work', f'd{i // 50}', str(i),
+                           mode=0o755)
+    return run
+
+
+@benchmark('link config files x500')
+def bench_link_config(ws):
+    src = ws.config_dir(500)
+    files = [os.path.join(src, f) for f in sorted(os.listdir(src))]
+
+    def run():
+        # Same calls as the link config files stage of setup.py
+        links = [ws.setup.link_if_absent(f, destdir=ws.home) for f in files]
+        return [ws.setup.compare_paths(x, y) for x, y in zip(files, links)]
+    return run
+
+
+def clone(ws, remote):
+    path = os.path.join(ws.home, 'local', 'src', 'repo')
+    return lambda: ws.setup.update_repository('Bench', remote, path)
+
+
+@benchmark('clone 50 files')
+def bench_clone_small(ws):
+    return clone(ws, ws.remote(50))
+
+
+@benchmark('clone 5000 files')
+def bench_clone_large(ws):
+    return clone(ws, ws.remote(5000))
+
+
+@benchmark('pull up to date')
+def bench_pull_current(ws):
+    run = clone(ws, ws.remote(5000))
+    run()
+    return run
+
+
+@benchmark('pull fast-forward')
+def bench_pull_ff(ws):
+    remote = ws.remote(5000)
+    run = clone(ws, remote)
+    run()
+    add_commit(remote)
+    return run
+
+
+@benchmark('install_lsf_profile')
+def bench_lsf(ws):
+    return lambda: ws.profiles.install_lsf_profile(use_defaults=True,
+                                                   p_name='lsf')
+
+
+def with_lsf_profile(ws):
+    return ws.profiles.install_lsf_profile(use_defaults=True, p_name='lsf')
+
+
+@benchmark('install_local_profile')
+def bench_local(ws):
+    lsf = with_lsf_profile(ws)
+    return lambda: ws.profiles.install_local_profile(lsf_profile=lsf)
+
+
+@benchmark('install_lsf8_profile')
+def bench_lsf8(ws):
+    lsf = with_lsf_profile(ws)
+    return lambda: ws.profiles.install_lsf8_profile(lsf_profile=lsf)
+
+
+@benchmark('install_local8_profile')
+def bench_local8(ws):
+    lsf = with_lsf_profile(ws)
+    return lambda: ws.profiles.install_local8_profile(lsf_profile=lsf)
+
+
+def run_labops(*args):
+    env = {**os.environ, 'PYTHONPATH': REPODIR}
+    return lambda: subprocess.run([sys.executable, '-m', 'labops', *args],
+                                  env=env, stdout=subprocess.DEVNULL,
+                                  check=True)
+
+
+@benchmark('labops --help')
+def bench_labops_help(ws):
+    return run_labops('--help')
+
+
+@benchmark('labops screenshare --help')
+def bench_labops_dispatch(ws):
+    return run_labops('screenshare', '--help')
+
+
+def load_modules():
+    """Import setup.py and setup_snakemake_profiles.py with cookiecutter stubbed."""
+    stub_cookiecutter()
+    os.environ.pop('LABOPS_TRACE', None)
+    return {'setup': load_script('labops_setup', 'setup.py'),
+            'profiles': load_script('snakeprofile',
+                                    'setup_snakemake_profiles.py')}
+
+
+def new_workspace(base, modules):
+    """
+    Lay out a workspace in an empty directory.
+
+    Returns:
+        SimpleNamespace: The base directory, a fresh home, remote(nfiles) and
+            config_dir(nfiles) to create a bare git remote and a directory of
+            config files below base, and the modules under test.
+    """
+    return types.SimpleNamespace(
+        base=base, home=make_home(base),
+        remote=lambda n: make_remote(os.path.join(base, 'remote.git'), n),
+        config_dir=lambda n: make_config_dir(
+            os.path.join(base, 'config_files'), n),
+        **modules)
+
+
+def temp_workspaces(modules, directory=None):
+    """
+    Workspace factory for measure, in temporary directories below directory.
+
+    Each workspace's home is HOME while it is in use, and the workspace is
+    removed afterwards.
+    """
+    @contextlib.contextmanager
+    def workspace():
+        base = tempfile.mkdtemp(prefix='setup_bench_', dir=directory)
+        old_home = os.environ['HOME']
+        try:
+            ws = new_workspace(base, modules)
+            os.environ['HOME'] = ws.home
+            yield ws
+        finally:
+            os.environ['HOME'] = old_home
+            shutil.rmtree(base)
+    return workspace
+
+
+def measure(name, workspace, repeat):
+    """
+    Run one benchmark repeat times, each in a fresh workspace.
+
+    Args:
+        workspace: Callable returning a context manager for a new workspace,
+            e.g. from temp_workspaces.
+
+    Returns:
+        float: The median time in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        quiet = io.StringIO()
+        with workspace() as ws, contextlib.redirect_stdout(quiet), \
+                contextlib.redirect_stderr(quiet):
+            run = BENCHMARKS[name](ws)
+            t0 = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+
+def read_baseline(path):
+    """Saved results by operation, empty if there is no baseline yet."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get('results', {})
+
+
+def save_baseline(path, directory, results):
+    """Save results as the baseline, keeping operations that were not run."""
+    baseline = {'host': platform.node(), 'dir': directory or
+                tempfile.gettempdir(), 'date': time.strftime('%Y-%m-%d'),
+                'results': {**read_baseline(path), **results}}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2)
+
+
+def regressed(name, seconds, before, threshold, min_delta):
+    """Whether an operation is slower than its baseline past the threshold."""
+    return (name in before and seconds / before[name] > threshold
+            and seconds - before[name] > min_delta)
+
+
+def over_budget(name, seconds):
+    return seconds > BUDGETS.get(name, float('inf'))
+
+
+def main(args):
+    modules = load_modules()
+    workspace = temp_workspaces(modules, args.dir)
+    before = read_baseline(args.baseline)
+
+    names = [n for n in BENCHMARKS
+             if not args.only or any(o in n for o in args.only)]
+    results = {}
+    slower = []
+    too_slow = []
+    print(f'{"operation":<26}{"median_s":>10}{"baseline_s":>12}{"ratio":>8}')
+    for name in names:
+        results[name] = measure(name, workspace, args.repeat)
+        line = f'{name:<26}{results[name]:>10.4f}'
+        if name in before:
+            ratio = results[name] / before[name]
+            flag = ''
+            if regressed(name, results[name], before, args.threshold,
+                         args.min_delta):
+                slower.append(name)
+                flag = '  REGRESSION'
+            line += f'{before[name]:>12.4f}{ratio:>8.2f}{flag}'
+        if over_budget(name, results[name]):
+            too_slow.append(name)
+            line += f'  OVER BUDGET ({BUDGETS[name]}s)'
+        print(line)
+
+    if args.update:
+        save_baseline(args.baseline, args.dir, results)
+        print(f'Baseline saved to {args.baseline}')
+    elif not before:
+        print('No baseline yet. Run with --update to save one.')
+    if slower and not args.update:
+        print(f'{len(slower)} operations are more than {args.threshold}x '
+              f'slower than the baseline: {", ".join(slower)}')
+    if too_slow:
+        print(f'Over the startup budget: {", ".join(too_slow)}')
+    if (slower and not args.update) or too_slow:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.strip().split('\n')[2:]))
+    parser.add_argument('--dir', help='Directory for the temporary homes '
+                        '(default: the system temporary directory)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per operation (default: 5)')
+    parser.add_argument('--only', nargs='+',
+                        help='Only operations whose names contain one of these')
+    parser.add_argument('--baseline', default=FILE_BASELINE,
+                        help=f'Baseline file (default: {FILE_BASELINE})')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='Slowdown ratio that fails the run (default: 1.5)')
+    parser.add_argument('--min-delta', type=float, default=0.005,
+                        help='Ignore slowdowns smaller than this many seconds '
+                        '(default: 0.005)')
+    parser.add_argument('--update', action='store_true',
+                        help='Save the results as the new baseline')
+    main(parser.parse_args())
@@ -4,11 +4,95 @@ import profile
 from cookiecutter.main import cookiecutter
 from cookiecutter.generate import OutputDirExistsException
 import os
+import getpass
 from copy import deepcopy
 import yaml
 
+# Shared between-workflow cache for rules marked cache: True
+OUTPUT_CACHE = '/sc/arion/projects/load/snakemake_cache'
+
+# Shared local copies of files retrieved by Snakemake 8 storage plugins,
+# deduplicated and size-limited by storage_cache.py
+STORAGE_CACHE = '/sc/arion/projects/load/snakemake_storage'
+
+def output_cache_dir():
+    # The cache Snakemake will use, or None if it has not been set up. Only
+    # profiles of users with SNAKEMAKE_OUTPUT_CACHE set get cache: True,
+    # since Snakemake stops with an error when caching without it.
+    path = os.environ.get('SNAKEMAKE_OUTPUT_CACHE')
+    return path if path and os.path.isdir(path) else None
+
+def storage_cache_dir():
+    return STORAGE_CACHE if os.path.isdir(STORAGE_CACHE) else None
+
+def install_shared_dir(path, label):
+    # Group-writable with setgid so entries stay in the project group and
+    # every lab member can add and prune them
+    try:
+        os.makedirs(path, exist_ok=True)
+        if os.stat(path).st_uid == os.getuid():
+            os.chmod(path, 0o2775)
+    except OSError as e:
+        print(f'Could not set up the {label}: {e}')
+        return None
+    return path
+
+def install_output_cache(cachedir=None):
+    cachedir = cachedir or os.environ.get('SNAKEMAKE_OUTPUT_CACHE',
+                                          OUTPUT_CACHE)
+    return install_shared_dir(cachedir, 'Snakemake output cache')
+
+def install_storage_cache(cachedir=STORAGE_CACHE):
+    return install_shared_dir(cachedir, 'Snakemake storage cache')
+
+def storage_settings(storage_cache):
+    # Retrieved files are kept in the shared cache, and later runs only
+    # download them again if the remote copy is newer
+    if storage_cache is None:
+        storage_cache = storage_cache_dir()
+    elif storage_cache is True:
+        storage_cache = STORAGE_CACHE
+    if not storage_cache:
+        return {}
+    return {'local-storage-prefix': storage_cache,
+            'keep-storage-local-copies': True}
+
+# Node-local disk on the compute nodes, per user since it is shared
+SCRATCH = os.path.join('/local/tmp', getpass.getuser())
+
+# Rule classes for scratch_stage.py classes. The resources of each class are
+# set for the rules listed under it; tmpdir is where the rule's $TMPDIR, and
+# so scratch_stage.py run, puts its files.
+SCRATCH_CLASSES = """\
+# Rules staged to node-local disk with scratch_stage.py run
+io_heavy:
+  rules: []
+  resources:
+    tmpdir: /local/tmp
+# Rules whose temporary files do not fit on the node's disk
+large_tmp:
+  rules: []
+  resources:
+    tmpdir: /sc/arion/scratch/{user}
+"""
+
+def scratch_settings():
+    # Shadow directories of rules declaring shadow:, and local copies of
+    # storage plugin files unless the shared storage cache holds them, go on
+    # the node instead of GPFS
+    return {'shadow-prefix': os.path.join(SCRATCH, 'snakemake'),
+            'remote-job-local-storage-prefix':
+                os.path.join(SCRATCH, 'snakemake_storage')}
+
+def write_scratch_classes(outdir):
+    classfile = os.path.join(outdir, 'scratch.yaml')
+    if not os.path.exists(classfile):
+        with open(classfile, 'w') as f:
+            f.write(SCRATCH_CLASSES.format(user=getpass.getuser()))
+
 def install_lsf_profile(use_defaults=False, project='acc_LOAD',
-                        overwrt=False, p_name='choose'):
+                        overwrt=False, p_name='choose', output_cache=None,
+                        scratch=False):
     confdir = os.path.expanduser('~/.config/snakemake')
     if use_defaults and p_name in ['choose', 'choose_quiet']:
         p_name = 'lsf'
@@ -34,6 +118,27 @@ def install_lsf_profile(use_defaults=False, project='acc_LOAD',
                            output_dir=confdir, overwrite_if_exists=overwrt,
                            no_input=use_defaults)
 
+    if output_cache is None:
+        output_cache = output_cache_dir() is not None
+    if output_cache:
+        # Appended so the comments from the template are kept
+        lsf_profile_cnf = os.path.join(outpath, 'config.yaml')
+        with open(lsf_profile_cnf, 'r') as f:
+            has_cache = 'cache' in (yaml.safe_load(f) or {})
+        if not has_cache:
+            with open(lsf_profile_cnf, 'a') as f:
+                f.write('cache: True\n')
+
+    if scratch:
+        # Snakemake 7 has no remote-job-local-storage-prefix
+        lsf_profile_cnf = os.path.join(outpath, 'config.yaml')
+        with open(lsf_profile_cnf, 'r') as f:
+            has_shadow = 'shadow-prefix' in (yaml.safe_load(f) or {})
+        if not has_shadow:
+            with open(lsf_profile_cnf, 'a') as f:
+                f.write(f"shadow-prefix: {scratch_settings()['shadow-prefix']}\n")
+        write_scratch_classes(outpath)
+
     return outpath
 
 def install_local_profile(lsf_profile={}, use_defaults='if_no_lsf',
@@ -86,7 +191,9 @@ def install_local_profile(lsf_profile={}, use_defaults='if_no_lsf',
         yaml.dump(conf, f, default_flow_style=False)
 
 def install_lsf8_profile(lsf_profile={}, use_defaults='if_no_lsf', project='acc_LOAD',
-                         settings={}, profile_name='lsf8', overwrt=False):
+                         settings={}, profile_name='lsf8', overwrt=False,
+                         output_cache=None, scratch=False,
+                         storage_cache=None):
     confdir = os.path.expanduser('~/.config/snakemake')
 
     defaults = {'max-jobs-per-second': 10, 'max-status-checks-per-second': 1,
@@ -125,6 +232,19 @@ def install_lsf8_profile(lsf_profile={}, use_defaults='if_no_lsf', project='acc_
     conf['default-resources']['lsf_queue'] = conf.pop('default_queue')
     conf['default-resources']['lsf_project'] = conf.pop('default_project')
 
+    if output_cache is None:
+        output_cache = output_cache_dir() is not None
+    if output_cache:
+        conf['cache'] = True
+    if scratch:
+        conf.update(scratch_settings())
+    storage = storage_settings(storage_cache)
+    if storage:
+        # Jobs get the remote prefix as their local-storage-prefix, so it
+        # would send them past the shared cache to the node's disk
+        conf.pop('remote-job-local-storage-prefix', None)
+    conf.update(storage)
+
     assert os.path.sep not in profile_name, 'profile name should not be a path'
     outdir = os.path.join(confdir, profile_name)
     if os.path.exists(outdir):
@@ -135,9 +255,12 @@ def install_lsf8_profile(lsf_profile={}, use_defaults='if_no_lsf', project='acc_
 
     with open(os.path.join(outdir, 'config.yaml'), 'w') as f:
         yaml.dump(conf, f, default_flow_style=False)
+    if scratch:
+        write_scratch_classes(outdir)
 
 def install_local8_profile(lsf_profile={}, use_defaults='if_no_lsf',
-                           settings={}, profile_name='local8', overwrt=False):
+                           settings={}, profile_name='local8', overwrt=False,
+                           storage_cache=None):
     confdir = os.path.expanduser('~/.config/snakemake')
 
     defaults = {'latency-wait': 10, 'printshellcmds': True, 'jobs': 1,
@@ -170,6 +293,8 @@ def install_local8_profile(lsf_profile={}, use_defaults='if_no_lsf',
     if use_settings:
         conf.update(settings)
 
+    conf.update(storage_settings(storage_cache))
+
     assert os.path.sep not in profile_name, 'profile name should not be a path'
     outdir = os.path.join(confdir, profile_name)
     if os.path.exists(outdir):
@@ -184,6 +309,14 @@ def install_local8_profile(lsf_profile={}, use_defaults='if_no_lsf',
 
 if __name__ == '__main__':
     confdir = os.path.expanduser('~/.config/snakemake')
+    cachedir = install_output_cache()
+    if output_cache_dir() is not None:
+        print('LSF profiles will use the shared output cache.')
+    elif cachedir is not None:
+        print('To use the shared output cache, add this to your shell config '
+              'and run this again:')
+        print(f'  export SNAKEMAKE_OUTPUT_CACHE="{cachedir}"')
+    install_storage_cache()
     print('Setting up LSF profile.')
     profile_name='choose'
     try:
@@ -191,6 +324,9 @@ if __name__ == '__main__':
         proj = click.prompt('Minerva Project:', default='acc_LOAD')
         tf_default = click.confirm('Use all defaults?',
                                    default=True)
+        scratch = click.confirm('Let LSF jobs put shadow directories and '
+                                'staged files on node-local disk?',
+                                default=True)
         tf_overwrite = False
         if tf_default and os.path.isdir(os.path.join(confdir, 'lsf')):
             print('lsf profile already exists.')
@@ -211,23 +347,26 @@ if __name__ == '__main__':
         tf_default = yn[0].lower() == 'y' or not yn
         if tf_default:
             proj = 'acc_LOAD'
+        scratch = True
         tf_overwrite = False
         use_click = False
     
     try:
         outpath = install_lsf_profile(use_defaults=tf_default,
                                       project=proj, overwrt=tf_overwrite,
-                                      p_name=profile_name)
+                                      p_name=profile_name, scratch=scratch)
     except OutputDirExistsException:
         print('lsf profile already exists.')
         if use_click:
             if click.confirm('Overwrite LSF profile?', default=True):
                 outpath = install_lsf_profile(use_defaults=tf_default,
-                                              project=proj, overwrt=True)
+                                              project=proj, overwrt=True,
+                                              scratch=scratch)
             else:
                 profile_name = click.prompt('Profile Name:')
                 outpath = install_lsf_profile(use_defaults=tf_default,
-                                              project=proj, p_name=profile_name)
+                                              project=proj, p_name=profile_name,
+                                              scratch=scratch)
         else:
             raise
 
@@ -235,7 +374,7 @@ if __name__ == '__main__':
         print('Setting up local profile.')
         install_local_profile(lsf_profile=outpath)
         try:
-            install_lsf8_profile(lsf_profile=outpath)
+            install_lsf8_profile(lsf_profile=outpath, scratch=scratch)
             install_local8_profile(lsf_profile=outpath)
         except:
             print("Failed to install Snakemake 8 profiles!")
@@ -271,9 +410,9 @@ if __name__ == '__main__':
             lsf8_uselsf = click.confirm(prompt, default=True)
             if lsf8_uselsf:
                 install_lsf8_profile(lsf_profile=outpath,
-                                     profile_name=lsf8_name)
+                                     profile_name=lsf8_name, scratch=scratch)
             else:
-                install_lsf8_profile(profile_name=lsf8_name)
+                install_lsf8_profile(profile_name=lsf8_name, scratch=scratch)
         except OutputDirExistsException:
             print('LSF Snakemake 8 profile already exists.')
             overwrite_lsf8 = True
@@ -282,9 +421,10 @@ if __name__ == '__main__':
                 overwrite_lsf8 = False
             if lsf8_uselsf:
                 install_lsf8_profile(lsf_profile=outpath, profile_name=lsf8_name,
-                                     overwrt=overwrite_lsf8)
+                                     overwrt=overwrite_lsf8, scratch=scratch)
             else:
-                install_lsf8_profile(profile_name=lsf8_name, overwrt=overwrite_lsf8)
+                install_lsf8_profile(profile_name=lsf8_name, overwrt=overwrite_lsf8,
+                                     scratch=scratch)
         except:
             print("Failed to install Snakemake 8 lsf profile!")
 
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+
+"""
+Collect Snakemake benchmarks across runs and flag rules that got slower.
+
+Run collect in a workflow directory after each run. It reads the files
+written by benchmark: directives, and optionally the --stats JSON of
+Snakemake 7, into one Parquet store for all workflows. Each job is stored
+with its rule, the size of its inputs and a hash of the profile the run
+used. The rule and inputs of a job come from .snakemake/metadata. A
+benchmark file is matched to its rule by its path, which should follow
+benchmarks/<rule>/..., and to its job by the wildcard values the path
+shares with the job's outputs. If that matches more than one job, its
+input size is left empty:
+
+    smk_benchmarks.py collect --profile lsf8
+    smk_benchmarks.py regress
+    smk_benchmarks.py scaling --out scaling/
+
+regress compares the two latest runs of the workflow, job by job where the
+same job ran on inputs of about the same size, and exits with status 1 if
+a rule's runtime or max RSS grew by more than --threshold. scaling fits
+runtime and max RSS against input size for each rule, and writes the
+points and fits as CSV for plotting.
+
+Needs pandas with pyarrow.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import base64
+import hashlib
+import argparse
+
+STORE = os.path.expanduser('~/.local/share/lab_operations/smk_benchmarks.parquet')
+BENCHMARK_DIRS = ['benchmarks', 'benchmark']
+BENCHMARK_HEADER = 's\th:m:s\tmax_rss'
+METRICS = ['s', 'max_rss', 'max_vms', 'max_uss', 'max_pss', 'io_in', 'io_out',
+           'mean_load', 'cpu_time']
+
+
+def load_pandas():
+    try:
+        import pandas as pd
+    except ModuleNotFoundError:
+        print('Python package \'pandas\' (with pyarrow) is needed for '
+              'smk_benchmarks.py.')
+        sys.exit(1)
+    return pd
+
+
+def read_metadata(workdir):
+    """
+    Read the job records Snakemake keeps for each output file.
+
+    Returns:
+        dict: Record of each output path, relative to workdir.
+    """
+    metadir = os.path.join(workdir, '.snakemake', 'metadata')
+    records = {}
+    for root, _, names in os.walk(metadir):
+        for name in names:
+            path = os.path.join(root, name)
+            # Long encoded names are split into directories
+            encoded = os.path.relpath(path, metadir).replace(os.sep, '')
+            try:
+                output = base64.urlsafe_b64decode(encoded).decode()
+                with open(path) as f:
+                    records[output] = json.load(f)
+            except (ValueError, OSError):
+                continue
+    return records
+
+
+def input_bytes(workdir, record):
+    """Total size of a job's inputs that still exist, or None."""
+    sizes = [os.path.getsize(p) for p in
+             (os.path.join(workdir, i) for i in record.get('input') or [])
+             if os.path.isfile(p)]
+    return sum(sizes) if sizes else None
+
+
+def find_benchmarks(workdir, dirs):
+    """Benchmark files below dirs, recognized by their header."""
+    for d in dirs:
+        for root, _, names in os.walk(os.path.join(workdir, d)):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    with open(path) as f:
+                        if f.read(len(BENCHMARK_HEADER)) != BENCHMARK_HEADER:
+                            continue
+                except (OSError, UnicodeDecodeError):
+                    continue
+                yield os.path.relpath(path, workdir)
+
+
+def path_tokens(path):
+    """Parts of a path between separators, among them its wildcard values."""
+    return set(re.split(r'[/._-]+', path)) - {''}
+
+
+def benchmark_job(rel, metadata, rules):
+    """
+    Find the rule and job record of a benchmark file.
+
+    Uses the metadata of the benchmark itself if Snakemake kept it. Otherwise
+    the rule is the one named by the path, and the job is the one of that
+    rule whose outputs contain every wildcard value in the benchmark path,
+    that is each part of the path also found in the outputs of some job.
+
+    Returns:
+        tuple: Rule name and job record, each None if not found. The record
+            is None if more than one job matches.
+    """
+    if rel in metadata:
+        return metadata[rel].get('rule'), metadata[rel]
+    parts = rel.split('/')
+    rule = None
+    if len(parts) > 2 and parts[1] in rules:
+        rule = parts[1]
+    else:
+        stem = parts[-1]
+        matches = [r for r in rules if stem.startswith(r)]
+        rule = max(matches, key=len) if matches else (
+            parts[1] if len(parts) > 2 else stem.split('.')[0])
+
+    # Outputs of each job; a job has a record for each of its outputs
+    jobs = {}
+    for output, record in metadata.items():
+        if record.get('rule') != rule:
+            continue
+        key = record.get('job_hash') or (tuple(record.get('input') or []),
+                                         record.get('starttime'))
+        tokens, _ = jobs.get(key, (set(), record))
+        jobs[key] = (tokens | path_tokens(output), record)
+    if not jobs:
+        return rule, None
+    wanted = path_tokens(rel) & set().union(*(t for t, _ in jobs.values()))
+    found = [record for tokens, record in jobs.values() if wanted <= tokens]
+    return rule, found[0] if len(found) == 1 else None
+
+
+def profile_key(profile):
+    """Profile name and hash of its config.yaml, or (None, None)."""
+    profile = profile or os.environ.get('SNAKEMAKE_PROFILE')
+    if not profile:
+        return None, None
+    path = profile if os.path.isdir(profile) else os.path.join(
+        os.path.expanduser('~/.config/snakemake'), profile)
+    config = os.path.join(path, 'config.yaml')
+    assert os.path.isfile(config), f'No profile config at {config}'
+    with open(config, 'rb') as f:
+        return os.path.basename(path.rstrip('/')), \
+            hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+def run_label(workdir):
+    """The start time of the latest Snakemake run, from its log name."""
+    logdir = os.path.join(workdir, '.snakemake', 'log')
+    logs = sorted(f for f in os.listdir(logdir)
+                  if f.endswith('.snakemake.log')) if os.path.isdir(logdir) \
+        else []
+    return logs[-1].split('.snakemake.log')[0] if logs else \
+        time.strftime('%Y-%m-%dT%H%M%S')
+
+
+def collect(args):
+    pd = load_pandas()
+    workdir = os.path.abspath(args.workdir)
+    metadata = read_metadata(workdir)
+    rules = {r.get('rule') for r in metadata.values()} - {None}
+    profile, profile_hash = profile_key(args.profile)
+    run = args.run or run_label(workdir)
+    base = {'workflow': workdir, 'run': run, 'profile': profile,
+            'profile_hash': profile_hash, 'collected': time.time()}
+
+    rows = []
+    for rel in find_benchmarks(workdir, BENCHMARK_DIRS + args.search):
+        path = os.path.join(workdir, rel)
+        mtime = os.path.getmtime(path)
+        bench = pd.read_csv(path, sep='\t')
+        rule, record = benchmark_job(rel, metadata, rules)
+        row = {**base, 'source': 'benchmark', 'rule': rule, 'job': rel,
+               'mtime': mtime, 'repeats': len(bench),
+               'input_bytes': input_bytes(workdir, record) if record else None}
+        # Median over repeat() runs of the same job
+        for col in METRICS:
+            row[col] = (pd.to_numeric(bench[col], errors='coerce').median()
+                        if col in bench else None)
+        rows.append(row)
+
+    for stats in args.stats:
+        with open(stats) as f:
+            files = json.load(f).get('files', {})
+        for output, rec in files.items():
+            record = metadata.get(output)
+            rows.append({**base, 'source': 'stats',
+                         'rule': record.get('rule') if record else None,
+                         'job': output, 'mtime': rec.get('stop-time'),
+                         'repeats': 1, 's': rec.get('duration'),
+                         'input_bytes': input_bytes(workdir, record)
+                         if record else None})
+
+    assert rows, f'No benchmark files or stats found in {workdir}'
+    new = pd.DataFrame(rows)
+    n_new = len(new)
+    if os.path.exists(args.store):
+        old = pd.read_parquet(args.store)
+        # A job collected before keeps the run it was first collected in
+        new = pd.concat([old, new], ignore_index=True).drop_duplicates(
+            ['workflow', 'source', 'job', 'mtime'], keep='first')
+        n_new = len(new) - len(old)
+    os.makedirs(os.path.dirname(args.store), exist_ok=True)
+    new.to_parquet(args.store + '.tmp', index=False)
+    os.replace(args.store + '.tmp', args.store)
+    unknown = new.loc[new['workflow'] == workdir, 'rule'].isna().sum()
+    print(f'Added {n_new} jobs from run {run} to {args.store}')
+    if unknown:
+        print(f'{unknown} jobs have no rule. Put benchmarks in '
+              'benchmarks/<rule>/ so they can be matched.')
+
+
+def load_store(args):
+    pd = load_pandas()
+    assert os.path.exists(args.store), \
+        f'No benchmarks collected yet in {args.store}'
+    df = pd.read_parquet(args.store)
+    if not args.all_workflows:
+        df = df[df['workflow'] == os.path.abspath(args.workdir)]
+        assert len(df), f'No benchmarks for {os.path.abspath(args.workdir)}. ' \
+            'Run collect there, or use --all-workflows.'
+    return pd, df
+
+
+def regress(args):
+    pd, df = load_store(args)
+    runs = (df.groupby('run')['collected'].min().sort_values().index.tolist())
+    base = args.base or (runs[-2] if len(runs) > 1 else None)
+    new = args.new or runs[-1]
+    assert base is not None, 'Only one run collected, nothing to compare'
+    assert {base, new} <= set(runs), f'Runs collected: {", ".join(runs)}'
+    a = df[df['run'] == base]
+    b = df[df['run'] == new]
+
+    hashes = [set(x['profile_hash'].dropna()) for x in [a, b]]
+    if hashes[0] != hashes[1]:
+        print(f'Note: the profile changed between {base} and {new}\n')
+
+    pairs = a.merge(b, on=['workflow', 'source', 'job', 'rule'],
+                    suffixes=('_a', '_b'))
+    size_a, size_b = pairs['input_bytes_a'], pairs['input_bytes_b']
+    same_size = (size_a.isna() & size_b.isna()) | \
+        ((size_b - size_a).abs() <= 0.1 * size_a)
+    pairs = pairs[same_size]
+
+    print(f'Comparing {new} with {base}\n')
+    print(f'{"Rule":<28} {"Jobs":>5} {"Runtime":>18} {"Change":>7} '
+          f'{"Max RSS":>20} {"Change":>7}')
+    flagged = []
+    for rule in sorted(set(a['rule'].dropna()) & set(b['rule'].dropna())):
+        p = pairs[pairs['rule'] == rule]
+        if len(p):
+            # Ratios of matched jobs, so changes in the job mix cancel out
+            cols = {m: (p[f'{m}_a'].median(), p[f'{m}_b'].median(),
+                        (p[f'{m}_b'] / p[f'{m}_a']).median())
+                    for m in ['s', 'max_rss']}
+            n = f'{len(p)}'
+        else:
+            ra, rb = a[a['rule'] == rule], b[b['rule'] == rule]
+            cols = {m: (ra[m].median(), rb[m].median(),
+                        rb[m].median() / ra[m].median())
+                    for m in ['s', 'max_rss']}
+            n = f'{len(rb)}*'
+        marks = []
+        for m, min_delta in [('s', args.min_seconds), ('max_rss', args.min_mb)]:
+            old, cur, ratio = cols[m]
+            bad = (pd.notna(ratio) and ratio > args.threshold and
+                   cur - old > min_delta)
+            marks.append('!' if bad else ' ')
+            if bad:
+                flagged.append((rule, m, ratio))
+        fmt = lambda v, unit: '-' if pd.isna(v) else f'{v:.0f}{unit}'
+        pct = lambda r: '-' if pd.isna(r) else f'{100 * (r - 1):+.0f}%'
+        print(f'{rule:<28} {n:>5} '
+              f'{fmt(cols["s"][0], "s") + " > " + fmt(cols["s"][1], "s"):>18} '
+              f'{pct(cols["s"][2]):>6}{marks[0]} '
+              f'{fmt(cols["max_rss"][0], "MB") + " > " + fmt(cols["max_rss"][1], "MB"):>20} '
+              f'{pct(cols["max_rss"][2]):>6}{marks[1]}')
+    print('\nMedians over jobs that ran in both runs on inputs within 10% of '
+          'the same size.\n* No such jobs, so these are medians over all '
+          'jobs of the rule.')
+    if flagged:
+        print(f'\n{len(flagged)} regressions beyond {args.threshold:g}x:')
+        for rule, m, ratio in flagged:
+            print(f'  {rule}: {"runtime" if m == "s" else "max RSS"} '
+                  f'{ratio:.2f}x')
+        sys.exit(1)
+
+
+def scaling(args):
+    import numpy as np
+    pd, df = load_store(args)
+    df = df[df['input_bytes'].notna() & (df['input_bytes'] > 0) &
+            df['rule'].notna()]
+    assert len(df), 'No jobs with known input sizes'
+    os.makedirs(args.out, exist_ok=True)
+    fits = []
+    for rule, g in df.groupby('rule'):
+        points = g[['run', 'job', 's', 'max_rss']].assign(
+            input_mb=g['input_bytes'] / 1e6)
+        points[['run', 'job', 'input_mb', 's', 'max_rss']].sort_values(
+            'input_mb').to_csv(
+            os.path.join(args.out, f'{rule}.csv'), index=False)
+        fit = {'rule': rule, 'jobs': len(g),
+               'min_input_mb': g['input_bytes'].min() / 1e6,
+               'max_input_mb': g['input_bytes'].max() / 1e6}
+        for m in ['s', 'max_rss']:
+            ok = g[g[m] > 0]
+            fit[f'{m}_median'] = ok[m].median()
+            if ok['input_bytes'].nunique() < 3:
+                fit[f'{m}_exponent'] = fit[f'{m}_at_1gb'] = None
+                continue
+            # value = c * size^k, fitted on the log-log scale
+            k, logc = np.polyfit(np.log(ok['input_bytes'] / 1e9),
+                                 np.log(ok[m]), 1)
+            fit[f'{m}_exponent'] = k
+            fit[f'{m}_at_1gb'] = np.exp(logc)
+        fits.append(fit)
+    fits = pd.DataFrame(fits)
+    fits.to_csv(os.path.join(args.out, 'scaling.csv'), index=False)
+
+    print(f'{"Rule":<28} {"Jobs":>5} {"Input MB":>17} {"Runtime":>8} '
+          f'{"Exponent":>8} {"Max RSS":>9} {"Exponent":>8}')
+    for f in fits.itertuples():
+        k = lambda v: '-' if pd.isna(v) else f'{v:.2f}'
+        print(f'{f.rule:<28} {f.jobs:>5} '
+              f'{f"{f.min_input_mb:.1f}-{f.max_input_mb:.1f}":>17} '
+              f'{f.s_median:>7.0f}s {k(f.s_exponent):>8} '
+              f'{f.max_rss_median:>7.0f}MB {k(f.max_rss_exponent):>8}')
+    print(f'\nMedians over jobs; runtime and max RSS grow as input size to the '
+          f'power of the\nexponent, so 1 is linear. Points and fits written to '
+          f'{args.out}.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.strip().split('\n')[2:]))
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_collect = sub.add_parser('collect', help='Add the benchmarks of a '
+                               'workflow directory to the store')
+    p_collect.add_argument('--profile', help='Profile the run used, by name '
+                           'or path (default: $SNAKEMAKE_PROFILE)')
+    p_collect.add_argument('--run', help='Label for this run (default: the '
+                           'start time of the latest Snakemake log)')
+    p_collect.add_argument('--stats', nargs='*', default=[],
+                           help='Snakemake 7 --stats JSON files to add')
+    p_collect.add_argument('--search', nargs='*', default=[],
+                           help='More directories with benchmark files')
+    p_collect.set_defaults(func=collect)
+
+    p_regress = sub.add_parser('regress', help='Rules that got slower or '
+                               'use more memory')
+    p_regress.add_argument('--base', help='Run to compare against '
+                           '(default: the second latest)')
+    p_regress.add_argument('--new', help='Run to check (default: the latest)')
+    p_regress.add_argument('--threshold', type=float, default=1.25,
+                           help='Ratio counted as a regression (default: 1.25)')
+    p_regress.add_argument('--min-seconds', type=float, default=10,
+                           help='Ignore smaller runtime increases '
+                           '(default: 10)')
+    p_regress.add_argument('--min-mb', type=float, default=100,
+                           help='Ignore smaller max RSS increases '
+                           '(default: 100)')
+    p_regress.set_defaults(func=regress)
+
+    p_scaling = sub.add_parser('scaling', help='Fit runtime and memory '
+                               'against input size per rule')
+    p_scaling.add_argument('--out', default='benchmark_scaling',
+                           help='Directory for the CSV files '
+                           '(default: benchmark_scaling)')
+    p_scaling.set_defaults(func=scaling)
+
+    for p in [p_regress, p_scaling]:
+        p.add_argument('--all-workflows', action='store_true',
+                       help='Use the jobs of every workflow in the store')
+    for p in [p_collect, p_regress, p_scaling]:
+        p.add_argument('--workdir', default='.',
+                       help='Workflow directory (default: current)')
+        p.add_argument('--store', default=STORE,
+                       help=f'Parquet store (default: {STORE})')
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except AssertionError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+"""
+Report on and prune the shared Snakemake between-workflow output cache.
+
+Rules marked cache: True store their outputs in $SNAKEMAKE_OUTPUT_CACHE
+(set up by setup_snakemake_profiles.py), and later runs of any workflow
+with the same rule, inputs and parameters reuse them instead of recomputing:
+
+    snakemake_cache.py stats
+    snakemake_cache.py prune --older-than 180 --max-size 2T --dry-run
+
+stats counts an entry as reused when it was last read after it was written
+(atime later than mtime). A hit that only symlinks the entry into a workflow
+does not read it, and on filesystems mounted with noatime nothing does, so
+this undercounts. Snakemake logs every hit as "Symlinking output file ...
+from cache." or "Copying output file ... from cache.", and with --logs stats
+also counts those in the logs of the given workflow directories:
+
+    snakemake_cache.py stats --logs ~/projects/*/
+"""
+
+import os
+import re
+import sys
+import pwd
+import time
+import shutil
+import argparse
+
+try:
+    from labops.util import human, parse_size
+except ImportError:
+    # Run from a checkout, also through a symlink in ~/local/scripts
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.realpath(__file__))))
+    from labops.util import human, parse_size
+
+OUTPUT_CACHE = '/sc/arion/projects/load/snakemake_cache'
+
+LOG_HIT = re.compile(r'(?:Symlinking|Copying) output file (.+?) from cache')
+LOG_STORE = re.compile(r'Moving output file (.+?) to cache')
+
+AGE_BUCKETS = [(1, '< 1 day'), (7, '< 1 week'), (30, '< 1 month'),
+               (90, '< 3 months'), (365, '< 1 year'), (None, 'older')]
+
+
+def entries(cachedir):
+    """
+    List the cache entries, each a file or directory at the top level.
+
+    Returns:
+        list: Dicts with path, size, mtime, atime (the latest below a
+            directory entry) and uid.
+    """
+    assert os.path.isdir(cachedir), \
+        f'No output cache at {cachedir}. Set SNAKEMAKE_OUTPUT_CACHE or --cache.'
+    found = []
+    with os.scandir(cachedir) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue  # lock and temporary files
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            size, atime = st.st_size, st.st_atime
+            if entry.is_dir(follow_symlinks=False):
+                for root, _, names in os.walk(entry.path):
+                    for name in names:
+                        try:
+                            fst = os.lstat(os.path.join(root, name))
+                        except OSError:
+                            continue
+                        size += fst.st_size
+                        atime = max(atime, fst.st_atime)
+            found.append({'path': entry.path, 'size': size,
+                          'mtime': st.st_mtime, 'atime': atime,
+                          'uid': st.st_uid})
+    return found
+
+
+def log_counts(workdirs):
+    """
+    Count cache hits and stores in the Snakemake logs of workflow directories.
+
+    Returns:
+        tuple: Number of logs read, outputs taken from the cache and outputs
+            moved into it.
+    """
+    logs = hits = stores = 0
+    for workdir in workdirs:
+        logdir = os.path.join(workdir, '.snakemake', 'log')
+        if not os.path.isdir(logdir):
+            print(f'No Snakemake logs in {workdir}', file=sys.stderr)
+            continue
+        for name in os.listdir(logdir):
+            if not name.endswith('.log'):
+                continue
+            logs += 1
+            with open(os.path.join(logdir, name), errors='replace') as f:
+                for line in f:
+                    hits += bool(LOG_HIT.search(line))
+                    stores += bool(LOG_STORE.search(line))
+    return logs, hits, stores
+
+
+def owner(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return str(uid)
+
+
+def stats(args):
+    found = entries(args.cache)
+    now = time.time()
+    reused = [e for e in found if e['atime'] > e['mtime']]
+    total = sum(e['size'] for e in found)
+    print(f'{args.cache}: {len(found)} entries, {human(total)}')
+    if not found:
+        return
+    print(f'Reused after being written: {len(reused)} entries '
+          f'({100 * len(reused) / len(found):.0f}%), '
+          f'{human(sum(e["size"] for e in reused))}')
+    if args.logs:
+        logs, hits, stores = log_counts(args.logs)
+        print(f'In {logs} Snakemake logs: {hits} outputs taken from the '
+              f'cache, {stores} stored in it')
+    print()
+
+    print(f'{"Written":<12} {"Entries":>8} {"Reused":>7} {"Size":>8}')
+    lo = 0
+    for days, label in AGE_BUCKETS:
+        hi = days * 86400 if days else float('inf')
+        bucket = [e for e in found if lo <= now - e['mtime'] < hi]
+        if not bucket:
+            lo = hi
+            continue
+        hits = sum(e['atime'] > e['mtime'] for e in bucket)
+        print(f'{label:<12} {len(bucket):>8} {100 * hits / len(bucket):>6.0f}% '
+              f'{human(sum(e["size"] for e in bucket)):>8}')
+        lo = hi
+
+    by_owner = {}
+    for e in found:
+        n, size, hits = by_owner.get(e['uid'], (0, 0, 0))
+        by_owner[e['uid']] = (n + 1, size + e['size'],
+                              hits + (e['atime'] > e['mtime']))
+    print(f'\n{"Owner":<12} {"Entries":>8} {"Reused":>7} {"Size":>8}')
+    for uid, (n, size, hits) in sorted(by_owner.items(),
+                                       key=lambda kv: -kv[1][1]):
+        print(f'{owner(uid):<12} {n:>8} {100 * hits / n:>6.0f}% '
+              f'{human(size):>8}')
+
+    print('\nLargest entries:')
+    for e in sorted(found, key=lambda e: -e['size'])[:args.limit]:
+        used = time.strftime('%Y-%m-%d', time.localtime(e['atime']))
+        print(f'{human(e["size"]):>8}  last used {used}  '
+              f'{owner(e["uid"]):<10}  {os.path.basename(e["path"])}')
+
+
+def prune(args):
+    assert args.older_than is not None or args.max_size is not None, \
+        'Give --older-than, --max-size or both'
+    found = entries(args.cache)
+    now = time.time()
+    # Least recently used first
+    found.sort(key=lambda e: max(e['atime'], e['mtime']))
+    remove = []
+    if args.older_than is not None:
+        cutoff = now - args.older_than * 86400
+        remove = [e for e in found if max(e['atime'], e['mtime']) < cutoff]
+    if args.max_size is not None:
+        limit = parse_size(args.max_size)
+        keep = [e for e in found if e not in remove]
+        total = sum(e['size'] for e in keep)
+        for e in keep:
+            if total <= limit:
+                break
+            remove.append(e)
+            total -= e['size']
+
+    freed = 0
+    for e in remove:
+        used = time.strftime('%Y-%m-%d',
+                             time.localtime(max(e['atime'], e['mtime'])))
+        print(f'{"Would remove" if args.dry_run else "Removing"} '
+              f'{human(e["size"]):>8}  last used {used}  '
+              f'{os.path.basename(e["path"])}')
+        if args.dry_run:
+            freed += e['size']
+            continue
+        try:
+            if os.path.isdir(e['path']) and not os.path.islink(e['path']):
+                shutil.rmtree(e['path'])
+            else:
+                os.remove(e['path'])
+            freed += e['size']
+        except OSError as err:
+            print(f'  Could not remove: {err}', file=sys.stderr)
+    print(f'{"Would free" if args.dry_run else "Freed"} {human(freed)} '
+          f'from {len(remove)} of {len(found)} entries')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.strip().split('\n')[2:]))
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_stats = sub.add_parser('stats', help='Size, reuse and owners of '
+                             'cache entries')
+    p_stats.add_argument('-n', '--limit', type=int, default=10,
+                         help='Largest entries to list (default: 10)')
+    p_stats.add_argument('--logs', nargs='+', metavar='WORKDIR',
+                         help='Also count hits in the Snakemake logs of these '
+                         'workflow directories')
+    p_stats.set_defaults(func=stats)
+
+    p_prune = sub.add_parser('prune', help='Remove old or least recently '
+                             'used entries')
+    p_prune.add_argument('--older-than', type=float, metavar='DAYS',
+                         help='Remove entries not used for this many days')
+    p_prune.add_argument('--max-size', metavar='SIZE',
+                         help='Remove least recently used entries until the '
+                         'cache is at most this size, e.g. 2T')
+    p_prune.add_argument('--dry-run', action='store_true',
+                         help='Only list what would be removed')
+    p_prune.set_defaults(func=prune)
+
+    for p in [p_stats, p_prune]:
+        p.add_argument('--cache', default=os.environ.get(
+            'SNAKEMAKE_OUTPUT_CACHE', OUTPUT_CACHE),
+            help='Cache directory (default: $SNAKEMAKE_OUTPUT_CACHE or '
+            f'{OUTPUT_CACHE})')
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except AssertionError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+"""
+Keep one authenticated SSH master connection per host open for all scripts.
+
+start logs in once, with your password and token, and leaves a master
+connection on the socket in ~/.ssh/cm_socket that the ~/.ssh/config from
+setup.py points every ssh at. ssh, scp, sshfs, mtransfer.py, glance_minerva
+and the other lab scripts then open sessions over it without logging in
+again. A background watcher opens a short session over each master every
+few minutes, so idle timeouts on the way to Minerva never close it, and
+tells you when a master has gone away:
+
+    ssh_keeper.py start minerva
+    ssh_keeper.py status
+    ssh -S "$(ssh_keeper.py socket minerva)" minerva hostname
+
+status times a new session and shows whether it went over the master or
+needed a login of its own. With --fresh it also times a new login for
+comparison, which only works without a password prompt, as with the local
+sshd that selftest uses.
+"""
+
+import os
+import sys
+import time
+import signal
+import argparse
+import subprocess
+
+SOCKDIR = os.path.expanduser('~/.ssh/cm_socket')
+CONTROLPATH = os.path.join(SOCKDIR, '%r@%h:%p')
+STATEDIR = os.path.expanduser('~/.cache/lab_operations/ssh_keeper')
+WATCHER_PID = os.path.join(STATEDIR, 'watcher.pid')
+WATCHER_LOG = os.path.join(STATEDIR, 'watcher.log')
+
+
+def socket_path(host):
+    """The ControlPath for host, with the %r, %h and %p tokens filled in."""
+    r = subprocess.run(['ssh', '-G', host], capture_output=True, text=True)
+    assert r.returncode == 0, f'Unknown host {host}: {r.stderr.strip()}'
+    conf = dict(line.partition(' ')[::2] for line in r.stdout.splitlines())
+    return (CONTROLPATH.replace('%r', conf['user'])
+            .replace('%h', conf['hostname']).replace('%p', conf['port']))
+
+
+def wantpath(host):
+    return os.path.join(STATEDIR, f'{host}.want')
+
+
+def wanted_hosts():
+    if not os.path.isdir(STATEDIR):
+        return []
+    return sorted(f[:-5] for f in os.listdir(STATEDIR) if f.endswith('.want'))
+
+
+def master_pid(host):
+    """Pid of the running master for host, or None."""
+    r = subprocess.run(['ssh', '-o', f'ControlPath={CONTROLPATH}',
+                        '-O', 'check', host], capture_output=True, text=True)
+    if r.returncode != 0:
+        return None
+    return r.stderr.strip().partition('pid=')[2].rstrip(')') or '?'
+
+
+def timed_session(host, via_master=True):
+    """
+    Run true on host and time it.
+
+    Returns:
+        tuple: Seconds, and the master's id for the session if it went over
+            the master, or None if it was a separate login. Seconds is None
+            if the session failed.
+    """
+    opts = (['-o', f'ControlPath={CONTROLPATH}', '-o', 'ControlMaster=no']
+            if via_master else
+            ['-o', 'ControlPath=none', '-o', 'ControlMaster=no'])
+    t0 = time.perf_counter()
+    r = subprocess.run(['ssh', '-v', '-o', 'BatchMode=yes', *opts, host,
+                        'true'], capture_output=True, text=True)
+    elapsed = time.perf_counter() - t0
+    session = None
+    for line in r.stderr.splitlines():
+        if 'master session id:' in line:
+            session = line.rpartition(':')[2].strip()
+    return (elapsed if r.returncode == 0 else None), session
+
+
+def open_master(host):
+    """Log in to host and leave the master running in the background."""
+    os.makedirs(SOCKDIR, mode=0o700, exist_ok=True)
+    sock = socket_path(host)
+    if os.path.exists(sock):
+        os.remove(sock)  # left by a master that died
+    r = subprocess.run(['ssh', '-M', '-fNT',
+                        '-o', f'ControlPath={CONTROLPATH}',
+                        '-o', 'ControlPersist=yes',
+                        '-o', 'ServerAliveInterval=60',
+                        '-o', 'ServerAliveCountMax=3', host])
+    assert r.returncode == 0, f'Could not log in to {host}'
+
+
+def watcher_running():
+    try:
+        with open(WATCHER_PID) as f:
+            pid = int(f.read())
+        os.kill(pid, 0)
+        return pid
+    except (OSError, ValueError):
+        return None
+
+
+def start_watcher(interval):
+    """Fork a watcher that outlives this command."""
+    if watcher_running():
+        return
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    with open(WATCHER_PID, 'w') as f:
+        f.write(str(os.getpid()))
+    log = os.open(WATCHER_LOG, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    try:
+        watch(argparse.Namespace(interval=interval))
+    finally:
+        os._exit(0)
+
+
+def start(args):
+    os.makedirs(STATEDIR, exist_ok=True)
+    for host in args.hosts:
+        pid = master_pid(host)
+        if pid:
+            print(f'Reusing master to {host} (pid {pid})')
+        else:
+            print(f'Logging in to {host}')
+            open_master(host)
+        open(wantpath(host), 'w').close()
+    if not args.no_watch:
+        start_watcher(args.interval)
+
+
+def watch(args):
+    """Keep the masters busy enough not to time out, until none are wanted."""
+    sys.stdout.reconfigure(line_buffering=True)
+    down = set()
+    while True:
+        hosts = wanted_hosts()
+        if not hosts:
+            break
+        for host in hosts:
+            stamp = time.strftime('%Y-%m-%d %H:%M:%S')
+            if master_pid(host):
+                elapsed, _ = timed_session(host)
+                if elapsed is not None:
+                    down.discard(host)
+                    continue
+            if host not in down:
+                print(f'{stamp} Master to {host} is down. Run ssh_keeper.py '
+                      f'start {host} to log in again.')
+                down.add(host)
+        time.sleep(args.interval)
+    if watcher_running() == os.getpid():
+        os.remove(WATCHER_PID)
+
+
+def status(args):
+    hosts = args.hosts or wanted_hosts()
+    assert hosts, 'No masters started. Run ssh_keeper.py start HOST first.'
+    watcher = watcher_running()
+    print(f'Watcher: {"running (pid %d)" % watcher if watcher else "stopped"}')
+    for host in hosts:
+        sock = socket_path(host)
+        pid = master_pid(host)
+        if not pid:
+            print(f'{host}: down  {sock}')
+            continue
+        age = (time.time() - os.stat(sock).st_mtime) / 3600
+        elapsed, session = timed_session(host)
+        reuse = 'over the master' if session else 'logged in separately'
+        timing = f'{elapsed * 1000:.0f} ms' if elapsed is not None else 'failed'
+        print(f'{host}: up {age:.1f}h (pid {pid})  {sock}')
+        print(f'  new session: {timing}, {reuse}')
+        if args.fresh:
+            elapsed, _ = timed_session(host, via_master=False)
+            print('  new login:   ' + (f'{elapsed * 1000:.0f} ms'
+                                       if elapsed is not None else
+                                       'failed (needs a password or token)'))
+
+
+def stop(args):
+    hosts = wanted_hosts() if args.all else args.hosts
+    assert hosts, 'Give hosts to stop, or --all'
+    for host in hosts:
+        if os.path.exists(wantpath(host)):
+            os.remove(wantpath(host))
+        if master_pid(host):
+            subprocess.run(['ssh', '-o', f'ControlPath={CONTROLPATH}',
+                            '-O', 'exit', host], capture_output=True)
+            print(f'Closed master to {host}')
+    watcher = watcher_running()
+    if watcher and not wanted_hosts():
+        os.kill(watcher, signal.SIGTERM)
+        os.remove(WATCHER_PID)
+
+
+def socket(args):
+    print(socket_path(args.host))
+
+
+def selftest(args):
+    """Start, reuse, time and stop a master to a local sshd."""
+    host = args.host
+    stop(argparse.Namespace(hosts=[host], all=False))
+    start(argparse.Namespace(hosts=[host], no_watch=True, interval=0))
+    pid = master_pid(host)
+    assert pid, 'Master did not start'
+    sessions = [timed_session(host) for _ in range(3)]
+    assert all(t is not None and s for t, s in sessions), \
+        f'Sessions did not go over the master: {sessions}'
+    start(argparse.Namespace(hosts=[host], no_watch=True, interval=0))
+    assert master_pid(host) == pid, 'start opened a second master'
+    fresh, _ = timed_session(host, via_master=False)
+    muxed = min(t for t, _ in sessions)
+    print(f'Over the master: {muxed * 1000:.0f} ms, new login: '
+          + (f'{fresh * 1000:.0f} ms' if fresh else 'failed'))
+    stop(argparse.Namespace(hosts=[host], all=False))
+    assert not master_pid(host), 'Master did not stop'
+    print('Self-test passed')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.strip().split('\n')[2:]))
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_start = sub.add_parser('start', help='Log in, or reuse the running '
+                             'master, and keep it open')
+    p_start.add_argument('hosts', nargs='+', metavar='host')
+    p_start.add_argument('--no-watch', action='store_true',
+                         help='Do not start the background watcher')
+    p_start.add_argument('--interval', type=float, default=240,
+                         help='Seconds between keepalive sessions '
+                         '(default: 240)')
+    p_start.set_defaults(func=start)
+
+    p_status = sub.add_parser('status', help='Masters, their age and the '
+                              'time to open a session')
+    p_status.add_argument('hosts', nargs='*', metavar='host',
+                          help='Hosts to check (default: all started)')
+    p_status.add_argument('--fresh', action='store_true',
+                          help='Also time a new login')
+    p_status.set_defaults(func=status)
+
+    p_stop = sub.add_parser('stop', help='Close masters')
+    p_stop.add_argument('hosts', nargs='*', metavar='host')
+    p_stop.add_argument('--all', action='store_true',
+                        help='Close all started masters')
+    p_stop.set_defaults(func=stop)
+
+    p_socket = sub.add_parser('socket', help='Print the socket path for a '
+                              'host, for ssh -S')
+    p_socket.add_argument('host')
+    p_socket.set_defaults(func=socket)
+
+    p_watch = sub.add_parser('watch', help='Run the watcher in the '
+                             'foreground')
+    p_watch.add_argument('--interval', type=float, default=240,
+                         help='Seconds between keepalive sessions '
+                         '(default: 240)')
+    p_watch.set_defaults(func=watch)
+
+    p_test = sub.add_parser('selftest', help='Test against a local sshd')
+    p_test.add_argument('--host', default='localhost',
+                        help='SSH host that accepts key logins '
+                        '(default: localhost)')
+    p_test.set_defaults(func=selftest)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except AssertionError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
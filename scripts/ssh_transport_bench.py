@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark SSH transport settings for tunnels and save per-host recommendations.
+
+For every combination of compression and cipher, a frame server is started
+on the target host and reached through an ssh -L tunnel, the same way the
+screenshare and glances tunnels work. The client measures frame latency,
+bulk throughput and the CPU time of the local ssh process. Connection setup
+is timed with and without a ControlMaster.
+
+The best settings are written to ~/.config/lab_operations/ssh_transport.json,
+which setup.py and screenshare_tunnel.py read. Use localhost to test against
+a local sshd.
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import socket
+import struct
+import argparse
+import resource
+import tempfile
+import subprocess
+
+FILE_RECOMMEND = os.path.expanduser(
+    '~/.config/lab_operations/ssh_transport.json')
+CIPHERS = ['aes128-gcm@openssh.com', 'chacha20-poly1305@openssh.com',
+           'aes256-gcm@openssh.com', 'aes128-ctr']
+
+# Runs on the target host. "raw" frames compress well, like VNC's raw
+# encoding; "random" frames do not, like its already compressed encodings.
+FRAME_SERVER = '''
+import os, sys, socket, struct
+s = socket.socket()
+s.bind(("127.0.0.1", 0))
+s.listen(1)
+print(s.getsockname()[1], flush=True)
+c, _ = s.accept()
+if sys.argv[1] == "random":
+    block = os.urandom(1 << 20)
+else:
+    block = bytes(range(256)) * 4096
+while True:
+    hdr = b""
+    while len(hdr) < 4:
+        chunk = c.recv(4 - len(hdr))
+        if not chunk:
+            sys.exit(0)
+        hdr += chunk
+    n = struct.unpack("!I", hdr)[0]
+    while n:
+        k = min(n, len(block))
+        c.sendall(block[:k])
+        n -= k
+'''
+
+
+def ssh_options(compression, cipher):
+    return ['-o', 'ControlMaster=no', '-o', 'ControlPath=none',
+            '-o', f'Compression={"yes" if compression else "no"}',
+            '-o', f'Ciphers={cipher}']
+
+
+def supported_ciphers():
+    r = subprocess.run(['ssh', '-Q', 'cipher'], capture_output=True,
+                       text=True)
+    return set(r.stdout.split())
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def recv_exact(sock, n):
+    got = 0
+    while got < n:
+        chunk = sock.recv(min(n - got, 1 << 20))
+        assert chunk, 'Tunnel closed'
+        got += len(chunk)
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_config(host, compression, cipher, args):
+    """
+    Measure one transport configuration.
+
+    Returns:
+        dict: Latency percentiles, throughput and ssh CPU use.
+    """
+    opts = ssh_options(compression, cipher)
+    server = subprocess.Popen(
+        ['ssh', *opts, host,
+         f'python3 -c {shlex.quote(FRAME_SERVER)} {args.payload}'],
+        stdout=subprocess.PIPE, text=True)
+    rport = int(server.stdout.readline())
+    lport = free_port()
+    cpu_start = children_cpu()
+    tunnel = subprocess.Popen(
+        ['ssh', *opts, '-N', '-o', 'ExitOnForwardFailure=yes',
+         '-L', f'{lport}:127.0.0.1:{rport}', host])
+    try:
+        for _ in range(100):
+            try:
+                sock = socket.create_connection(('127.0.0.1', lport))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+        else:
+            raise AssertionError('Tunnel did not come up')
+        with sock:
+            frame = args.frame_kb * 1024
+            latencies = []
+            for _ in range(args.frames):
+                t0 = time.perf_counter()
+                sock.sendall(struct.pack('!I', frame))
+                recv_exact(sock, frame)
+                latencies.append(time.perf_counter() - t0)
+            bulk = args.bulk_mb << 20
+            t0 = time.perf_counter()
+            sock.sendall(struct.pack('!I', bulk))
+            recv_exact(sock, bulk)
+            bulk_s = time.perf_counter() - t0
+    finally:
+        tunnel.terminate()
+        tunnel.wait()
+        cpu = children_cpu() - cpu_start
+        server.terminate()
+        server.wait()
+    latencies.sort()
+    return {'compression': compression, 'cipher': cipher,
+            'latency_p50_ms': 1000 * latencies[len(latencies) // 2],
+            'latency_p95_ms': 1000 * latencies[int(len(latencies) * 0.95)],
+            'throughput_mbps': 8 * bulk / bulk_s / 1e6,
+            'ssh_cpu_s': cpu}
+
+
+def time_setup(host, master):
+    """Time running a trivial command, optionally over a ControlMaster."""
+    opts = ['-o', 'ControlMaster=no', '-o', 'ControlPath=none']
+    sockdir = None
+    if master:
+        sockdir = tempfile.mkdtemp(dir=os.path.expanduser('~/.ssh'))
+        sock = os.path.join(sockdir, 'bench')
+        subprocess.run(['ssh', '-M', '-S', sock, '-fN',
+                        '-o', 'ControlPersist=30', host], check=True)
+        opts = ['-S', sock]
+    t0 = time.perf_counter()
+    subprocess.run(['ssh', *opts, host, 'true'], check=True)
+    elapsed = time.perf_counter() - t0
+    if master:
+        subprocess.run(['ssh', '-S', sock, '-O', 'exit', host],
+                       capture_output=True)
+        os.rmdir(sockdir)
+    return elapsed
+
+
+def recommend(results, setup):
+    """
+    Pick the settings with the lowest p95 frame latency.
+
+    Configurations within 5% of the best latency are ranked by throughput,
+    then by ssh CPU time.
+    """
+    best_latency = min(r['latency_p95_ms'] for r in results)
+    close = [r for r in results if r['latency_p95_ms'] <= 1.05 * best_latency]
+    best = sorted(close, key=lambda r: (-r['throughput_mbps'],
+                                        r['ssh_cpu_s']))[0]
+    options = {'Compression': 'yes' if best['compression'] else 'no',
+               'Ciphers': best['cipher'],
+               'ControlMaster': 'auto' if setup[True] < setup[False] else 'no'}
+    return options, best
+
+
+def main(args):
+    available = supported_ciphers()
+    ciphers = [c for c in args.ciphers if c in available]
+    assert ciphers, 'None of the requested ciphers are supported by ssh'
+    results = []
+    print('compression\tcipher\tp50_ms\tp95_ms\tMbit/s\tssh_cpu_s')
+    for compression in [False, True]:
+        for cipher in ciphers:
+            r = run_config(args.host, compression, cipher, args)
+            results.append(r)
+            print(f'{"yes" if compression else "no"}\t{cipher}\t'
+                  f'{r["latency_p50_ms"]:.2f}\t{r["latency_p95_ms"]:.2f}\t'
+                  f'{r["throughput_mbps"]:.1f}\t{r["ssh_cpu_s"]:.2f}')
+    setup = {m: time_setup(args.host, m) for m in [False, True]}
+    print(f'\nConnection setup: {setup[False]:.3f}s new, '
+          f'{setup[True]:.3f}s over ControlMaster')
+
+    options, best = recommend(results, setup)
+    print(f'\nRecommended for {args.host}: ' +
+          ', '.join(f'{k} {v}' for k, v in options.items()))
+    if args.dry_run:
+        return
+    saved = {}
+    if os.path.exists(FILE_RECOMMEND):
+        with open(FILE_RECOMMEND) as f:
+            saved = json.load(f)
+    saved[args.save_as or args.host] = {
+        'options': options, 'payload': args.payload, 'measured': best,
+        'setup_s': {'new': setup[False], 'controlmaster': setup[True]},
+        'date': time.strftime('%Y-%m-%d')}
+    os.makedirs(os.path.dirname(FILE_RECOMMEND), exist_ok=True)
+    with open(FILE_RECOMMEND, 'w') as f:
+        json.dump(saved, f, indent=2)
+    print(f'Saved to {FILE_RECOMMEND}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('host', nargs='?', default='localhost',
+                        help='SSH host to test (default: localhost)')
+    parser.add_argument('--save-as', help='Host name to save the results '
+                        'under, e.g. the name in ~/.screenshare.hosts')
+    parser.add_argument('--payload', choices=['random', 'raw'],
+                        default='random', help='Frame content. VNC streams '
+                        'are already compressed, like random (default).')
+    parser.add_argument('--frames', type=int, default=200,
+                        help='Frames for the latency test (default: 200)')
+    parser.add_argument('--frame-kb', type=int, default=64,
+                        help='Frame size in KiB (default: 64)')
+    parser.add_argument('--bulk-mb', type=int, default=64,
+                        help='MiB for the throughput test (default: 64)')
+    parser.add_argument('--ciphers', nargs='+', default=CIPHERS,
+                        help='Ciphers to test')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Do not save the recommendations')
+    try:
+        main(parser.parse_args())
+    except (AssertionError, subprocess.CalledProcessError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""
+Measure metadata and sequential read speed of each mc mount profile.
+
+Each profile mounts the remote directory at a temporary mount point with
+mc -m, walks it twice (cold, then with warm caches) counting stat and
+listdir calls per second, and reads a file to measure MB/s. The directory
+and file must be on Minerva, e.g. /sc/arion/projects/load/data.
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+PROFILES = ['browse', 'bulk-read', 'safe-write']
+
+
+def walk_ops(root, limit):
+    """
+    Stat every entry under root, up to limit entries.
+
+    Returns:
+        float: Metadata operations (listdir and stat calls) per second.
+    """
+    ops = 0
+    t0 = time.perf_counter()
+    stack = [root]
+    while stack and ops < limit:
+        path = stack.pop()
+        with os.scandir(path) as entries:
+            ops += 1
+            for entry in entries:
+                entry.stat(follow_symlinks=False)
+                ops += 1
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                if ops >= limit:
+                    break
+    return ops / (time.perf_counter() - t0)
+
+
+def read_mbps(path, max_mb):
+    """Read up to max_mb MiB of a file sequentially and return MB/s."""
+    limit = max_mb << 20
+    got = 0
+    t0 = time.perf_counter()
+    with open(path, 'rb', buffering=0) as f:
+        while got < limit:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            got += len(chunk)
+    return got / 1e6 / (time.perf_counter() - t0)
+
+
+def unmount(mountpoint):
+    cmd = (['diskutil', 'unmount', 'force', mountpoint]
+           if sys.platform == 'darwin' else ['fusermount', '-u', mountpoint])
+    subprocess.run(cmd, capture_output=True)
+
+
+def bench_profile(profile, args):
+    mountpoint = tempfile.mkdtemp(prefix=f'mc_{profile}_')
+    remote_dir = os.path.dirname(args.file)
+    subprocess.run(['mc', '-p', profile, '-m', mountpoint, remote_dir],
+                   check=True)
+    try:
+        local_tree = os.path.join(mountpoint,
+                                  os.path.relpath(args.dir, remote_dir))
+        cold = walk_ops(local_tree, args.entries)
+        warm = walk_ops(local_tree, args.entries)
+        mbps = read_mbps(os.path.join(mountpoint, os.path.basename(args.file)),
+                         args.read_mb)
+    finally:
+        unmount(mountpoint)
+        os.rmdir(mountpoint)
+    return cold, warm, mbps
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('dir', help='Remote directory tree to walk')
+    parser.add_argument('file', help='Remote file to read. Its directory is '
+                        'mounted, so dir must be inside it.')
+    parser.add_argument('--profiles', nargs='+', default=PROFILES,
+                        choices=PROFILES, help='Profiles to test')
+    parser.add_argument('--entries', type=int, default=5000,
+                        help='Entries to stat per walk (default: 5000)')
+    parser.add_argument('--read-mb', type=int, default=512,
+                        help='MiB to read from the file (default: 512)')
+    args = parser.parse_args()
+    args.dir = os.path.normpath(args.dir)
+    args.file = os.path.normpath(args.file)
+    if os.path.commonpath([args.dir, os.path.dirname(args.file)]) != \
+            os.path.dirname(args.file):
+        parser.error('dir must be inside the directory containing file')
+
+    print('profile\tcold_ops_s\twarm_ops_s\tread_MB_s')
+    for profile in args.profiles:
+        cold, warm, mbps = bench_profile(profile, args)
+        print(f'{profile}\t{cold:.0f}\t{warm:.0f}\t{mbps:.1f}')
@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+
+"""
+Deduplicate, limit and report on the shared Snakemake storage cache.
+
+The Snakemake 8 profiles keep files retrieved by storage plugins, such as
+storage.http("https://...") inputs, in the shared local-storage-prefix
+below, so later runs by anyone in the lab reuse them instead of
+downloading them again.
+
+scan stores every file in the cache once under its SHA-256 in .objects and
+hard links the retrieved paths to it, so the same reference fetched from
+two mirrors takes space once. It records new and re-downloaded files as
+misses and files read since the last scan as hits. With --max-size it then
+evicts the least recently used files. Run it from cron or a daily job:
+
+    storage_cache.py scan --max-size 2T
+    storage_cache.py report --days 30
+
+Hits are counted from access times, so a file is counted at most once
+between scans and not at all on filesystems mounted with noatime.
+Deduplicated files are made read-only, so a workflow cannot overwrite
+another URL's copy. If a remote file changes, evict it before the next run:
+
+    storage_cache.py evict https://example.org/GRCh38.fa.gz
+
+selftest serves test files from a local HTTP server, retrieves them twice
+and checks the requests, hits, deduplication and eviction. It runs
+Snakemake with the http storage plugin when both are installed, and
+otherwise fetches the files itself into the same layout.
+"""
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.parse
+import urllib.request
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+try:
+    from labops.util import human, parse_size
+except ImportError:
+    # Run from a checkout, also through a symlink in ~/local/scripts
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.realpath(__file__))))
+    from labops.util import human, parse_size
+
+STORAGE_CACHE = '/sc/arion/projects/load/snakemake_storage'
+OBJECTS = '.objects'
+DB = '.storage_cache.sqlite'
+COMMIT_EVERY = 100
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS paths (
+    path TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, mtime REAL);
+CREATE INDEX IF NOT EXISTS paths_sha256 ON paths (sha256);
+CREATE TABLE IF NOT EXISTS objects (
+    sha256 TEXT PRIMARY KEY, size INTEGER, atime REAL);
+CREATE TABLE IF NOT EXISTS events (
+    time REAL, kind TEXT, path TEXT, size INTEGER);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+'''
+
+
+def connect(cache):
+    assert os.path.isdir(cache), \
+        f'No storage cache at {cache}. Run setup_snakemake_profiles.py first.'
+    path = os.path.join(cache, DB)
+    new = not os.path.exists(path)
+    db = sqlite3.connect(path, timeout=60)
+    db.executescript(SCHEMA)
+    if new:
+        os.chmod(path, 0o664)  # every lab member runs scan
+    return db
+
+
+def object_path(cache, sha256):
+    return os.path.join(cache, OBJECTS, sha256[:2], sha256)
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def rearm_atime(path, st):
+    """
+    Set the access time back to the modification time.
+
+    With relatime, the default mount option, a read only updates the access
+    time if it is not already later than the modification time. Resetting it
+    after hashing or counting a hit makes the next read show up.
+    """
+    try:
+        os.utime(path, ns=(st.st_mtime_ns, st.st_mtime_ns))
+    except OSError:
+        pass  # owned by someone else
+
+
+def cached_files(cache):
+    """Retrieved files in the cache, as paths relative to it."""
+    for root, dirs, names in os.walk(cache):
+        if root == cache:
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in names:
+            path = os.path.join(root, name)
+            if not name.startswith('.') and not os.path.islink(path):
+                yield os.path.relpath(path, cache)
+
+
+def object_dir(cache, sha256):
+    """Create the directory for an object, writable by the whole lab."""
+    path = os.path.dirname(object_path(cache, sha256))
+    for d in [os.path.dirname(path), path]:
+        if not os.path.isdir(d):
+            os.makedirs(d, exist_ok=True)
+            try:
+                os.chmod(d, 0o2775)
+            except OSError:
+                pass  # created by someone else at the same time
+    return path
+
+
+def link_object(cache, rel, sha256, st):
+    """
+    Make rel a hard link of the object for its content.
+
+    Returns:
+        bool: Whether rel was a separate copy of an existing object.
+    """
+    path = os.path.join(cache, rel)
+    obj = object_path(cache, sha256)
+    object_dir(cache, sha256)
+    try:
+        ost = os.stat(obj)
+    except FileNotFoundError:
+        os.link(path, obj)
+        return False
+    if ost.st_ino == st.st_ino:
+        return False
+    tmp = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.tmp')
+    os.link(obj, tmp)
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        os.remove(tmp)
+        raise
+    if ost.st_uid == os.getuid():
+        os.chmod(obj, 0o444)
+    return True
+
+
+def scan_file(db, cache, rel, st, row, now, counts):
+    """Hash, deduplicate and record one new or downloaded again file."""
+    path = os.path.join(cache, rel)
+    sha256 = file_sha256(path)
+    if row and row[0] != sha256:
+        old = object_path(cache, row[0])
+        if os.path.exists(old) and os.stat(old).st_ino == st.st_ino:
+            os.remove(old)  # rewritten in place, no longer that content
+    if link_object(cache, rel, sha256, st):
+        counts['dedupe'] += 1
+        db.execute('INSERT INTO events VALUES (?, ?, ?, ?)',
+                   (now, 'dedupe', rel, st.st_size))
+    linked = os.stat(path)
+    rearm_atime(path, linked)
+    db.execute('INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?)',
+               (rel, sha256, st.st_size, linked.st_mtime))
+    db.execute('INSERT OR IGNORE INTO objects VALUES (?, ?, ?)',
+               (sha256, st.st_size, st.st_atime))
+    db.execute('INSERT INTO events VALUES (?, ?, ?, ?)',
+               (now, 'miss', rel, st.st_size))
+    counts['miss'] += 1
+
+
+def scan(args):
+    cache = args.cache
+    db = connect(cache)
+    now = time.time()
+    counts = {'miss': 0, 'hit': 0, 'dedupe': 0, 'skipped': 0}
+    known = dict((r[0], r[1:]) for r in db.execute(
+        'SELECT path, sha256, size, mtime FROM paths'))
+    seen = set()
+    for rel in cached_files(cache):
+        seen.add(rel)
+        try:
+            st = os.stat(os.path.join(cache, rel))
+        except OSError:
+            continue
+        row = known.get(rel)
+        if row and (row[1], row[2]) == (st.st_size, st.st_mtime):
+            continue
+        # New or downloaded again. Files and directories of other lab members
+        # may not allow linking, so they are skipped until their owner scans.
+        try:
+            scan_file(db, cache, rel, st, row, now, counts)
+        except OSError as e:
+            print(f'Skipped {rel}: {e.strerror}', file=sys.stderr)
+            counts['skipped'] += 1
+            continue
+        # Keep what was done if the scan is interrupted
+        if counts['miss'] % COMMIT_EVERY == 0:
+            db.commit()
+
+    for rel in set(known) - seen:
+        db.execute('DELETE FROM paths WHERE path = ?', (rel,))
+    db.commit()
+
+    for sha256, size, atime in db.execute(
+            'SELECT sha256, size, atime FROM objects').fetchall():
+        obj = object_path(cache, sha256)
+        try:
+            st = os.stat(obj)
+        except FileNotFoundError:
+            st = None
+        if st is None or st.st_nlink == 1:
+            # Every retrieved path was deleted, so the copy is unused
+            if st is not None:
+                try:
+                    os.remove(obj)
+                except OSError as e:
+                    print(f'Could not remove unused {obj}: {e.strerror}',
+                          file=sys.stderr)
+                    continue
+            db.execute('DELETE FROM objects WHERE sha256 = ?', (sha256,))
+            db.execute('DELETE FROM paths WHERE sha256 = ?', (sha256,))
+            continue
+        if st.st_atime > atime:
+            if st.st_atime > st.st_mtime:
+                path = db.execute('SELECT path FROM paths WHERE sha256 = ? '
+                                  'LIMIT 1', (sha256,)).fetchone()
+                db.execute('INSERT INTO events VALUES (?, ?, ?, ?)',
+                           (now, 'hit', path[0] if path else None, size))
+                counts['hit'] += 1
+                rearm_atime(obj, st)
+            db.execute('UPDATE objects SET atime = ? WHERE sha256 = ?',
+                       (st.st_atime, sha256))
+    db.commit()
+    print(f'{counts["miss"]} new or downloaded again, {counts["hit"]} read '
+          f'from the cache, {counts["dedupe"]} duplicates linked'
+          + (f', {counts["skipped"]} skipped' if counts['skipped'] else ''))
+    if args.max_size:
+        prune(db, cache, parse_size(args.max_size), args.dry_run)
+    db.close()
+
+
+def remove_object(db, cache, sha256, size, dry_run=False):
+    """
+    Remove an object and every path linked to it.
+
+    Returns:
+        list: Paths removed, or None if some could not be.
+    """
+    paths = [r[0] for r in db.execute(
+        'SELECT path FROM paths WHERE sha256 = ?', (sha256,))]
+    if dry_run:
+        return paths
+    try:
+        for target in [os.path.join(cache, rel) for rel in paths] + \
+                [object_path(cache, sha256)]:
+            try:
+                os.remove(target)
+            except FileNotFoundError:
+                pass
+    except OSError as e:
+        # Kept in the database so a scan by the owner can evict it
+        print(f'Could not evict {e.filename}: {e.strerror}', file=sys.stderr)
+        return None
+    db.execute('DELETE FROM paths WHERE sha256 = ?', (sha256,))
+    db.execute('DELETE FROM objects WHERE sha256 = ?', (sha256,))
+    db.execute('INSERT INTO events VALUES (?, ?, ?, ?)',
+               (time.time(), 'evict', paths[0] if paths else None, size))
+    return paths
+
+
+def prune(db, cache, max_size, dry_run=False):
+    """Evict least recently used objects until the cache fits max_size."""
+    objects = db.execute(
+        'SELECT sha256, size FROM objects ORDER BY atime').fetchall()
+    total = sum(size for _, size in objects)
+    evicted = 0
+    for sha256, size in objects:
+        if total <= max_size:
+            break
+        removed = remove_object(db, cache, sha256, size, dry_run)
+        if removed is None:
+            continue
+        for rel in removed:
+            print(f'{"Would evict" if dry_run else "Evicted"} '
+                  f'{human(size):>8}  {rel}')
+        total -= size
+        evicted += size
+    db.commit()
+    print(f'Cache holds {human(total)} of at most {human(max_size)}'
+          + (f', {human(evicted)} evicted' if evicted else ''))
+
+
+def url_path(url):
+    """Path in the cache that the http and ftp storage plugins use for url."""
+    parsed = urllib.parse.urlparse(url)
+    return os.path.join(parsed.scheme, parsed.netloc + parsed.path)
+
+
+def evict(args):
+    db = connect(args.cache)
+    for target in args.paths:
+        rel = url_path(target) if '://' in target else target
+        row = db.execute('SELECT sha256, size FROM paths WHERE path = ?',
+                         (rel,)).fetchone()
+        if row is None:
+            path = os.path.join(args.cache, rel)
+            assert os.path.isfile(path), f'{target} is not in the cache'
+            os.remove(path)
+            print(f'Removed {rel}')
+            continue
+        # Removes the other URLs with the same content too; the read-only
+        # object cannot be changed for just one of them
+        for removed in remove_object(db, args.cache, *row) or []:
+            print(f'Removed {removed}')
+    db.commit()
+
+
+def report(args):
+    if not args.no_scan:
+        scan(argparse.Namespace(cache=args.cache, max_size=None,
+                                dry_run=False))
+        print()
+    db = connect(args.cache)
+    since = time.time() - args.days * 86400
+    events = dict((kind, (n, size or 0)) for kind, n, size in db.execute(
+        'SELECT kind, COUNT(*), SUM(size) FROM events WHERE time >= ? '
+        'GROUP BY kind', (since,)))
+    hits, hit_bytes = events.get('hit', (0, 0))
+    misses, miss_bytes = events.get('miss', (0, 0))
+    print(f'Last {args.days:g} days:')
+    if hits + misses:
+        print(f'  hit rate       {100 * hits / (hits + misses):.0f}% '
+              f'({hits} hits, {misses} misses)')
+    print(f'  from cache     {human(hit_bytes)}')
+    print(f'  downloaded     {human(miss_bytes)}')
+    print(f'  deduplicated   {human(events.get("dedupe", (0, 0))[1])} in '
+          f'{events.get("dedupe", (0, 0))[0]} files')
+    print(f'  evicted        {human(events.get("evict", (0, 0))[1])} in '
+          f'{events.get("evict", (0, 0))[0]} objects')
+
+    n_paths, logical = db.execute(
+        'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM paths').fetchone()
+    n_objects, stored = db.execute(
+        'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects').fetchone()
+    print(f'\n{args.cache}: {n_paths} files, {human(logical)}, stored once '
+          f'in {n_objects} objects, {human(stored)}')
+
+    rows = db.execute(
+        "SELECT path, COUNT(*), MAX(size) FROM events WHERE kind = 'hit' "
+        'AND time >= ? GROUP BY path ORDER BY COUNT(*) * MAX(size) DESC '
+        'LIMIT ?', (since, args.limit)).fetchall()
+    if rows:
+        print('\nMost reused:')
+        for rel, n, size in rows:
+            print(f'{n:>6} hits  {human(size):>8}  {rel}')
+
+
+class CountingHandler(SimpleHTTPRequestHandler):
+    """Serves a directory and counts GET requests per path."""
+    gets = {}
+
+    def do_GET(self):
+        self.gets[self.path] = self.gets.get(self.path, 0) + 1
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+def retrieve(urls, cache, workdir):
+    """Fetch urls into cache like Snakemake with keep-storage-local-copies."""
+    try:
+        import snakemake_storage_plugin_http  # noqa: F401
+        use_snakemake = shutil.which('snakemake') is not None
+    except ImportError:
+        use_snakemake = False
+    if use_snakemake:
+        with open(os.path.join(workdir, 'Snakefile'), 'w') as f:
+            inputs = ', '.join(f'storage.http("{u}")' for u in urls)
+            f.write(f'rule all:\n    input: {inputs}\n    output: "all.txt"\n'
+                    '    shell: "cat {input} > {output}"\n')
+        out = os.path.join(workdir, 'all.txt')
+        if os.path.exists(out):
+            os.remove(out)
+        subprocess.run(['snakemake', '-c1', '--local-storage-prefix', cache,
+                        '--keep-storage-local-copies', '--quiet'],
+                       cwd=workdir, check=True)
+        return 'Snakemake'
+    for url in urls:
+        path = os.path.join(cache, url_path(url))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with urllib.request.urlopen(url) as r, open(path, 'wb') as f:
+                shutil.copyfileobj(r, f)
+        with open(path, 'rb') as f:
+            f.read()
+    return 'urllib (Snakemake or its http storage plugin is not installed)'
+
+
+def selftest(args):
+    work = tempfile.mkdtemp(prefix='storage_cache_')
+    server = None
+    try:
+        www = os.path.join(work, 'www')
+        ref = os.urandom(args.kb << 10)
+        files = {'ref/genome.fa': ref, 'mirror/genome.fa': ref,
+                 'ref/panel.vcf': os.urandom(args.kb << 9)}
+        for rel, data in files.items():
+            os.makedirs(os.path.join(www, os.path.dirname(rel)), exist_ok=True)
+            with open(os.path.join(www, rel), 'wb') as f:
+                f.write(data)
+        cache = os.path.join(work, 'cache')
+        os.makedirs(cache)
+        workdir = os.path.join(work, 'workflow')
+        os.makedirs(workdir)
+
+        handler = lambda *a, **kw: CountingHandler(*a, directory=www, **kw)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f'http://127.0.0.1:{server.server_address[1]}'
+        urls = [f'{base}/{rel}' for rel in files]
+        scan_args = argparse.Namespace(cache=cache, max_size=None,
+                                       dry_run=False)
+
+        how = retrieve(urls, cache, workdir)
+        print(f'Retrieving with {how}')
+        scan(scan_args)
+        time.sleep(1.1)  # so reads below get a later atime
+        retrieve(urls, cache, workdir)
+        assert all(CountingHandler.gets.get(f'/{rel}') == 1
+                   for rel in files), \
+            f'Files were downloaded again: {CountingHandler.gets}'
+        scan(scan_args)
+
+        db = connect(cache)
+        events = dict(db.execute(
+            'SELECT kind, COUNT(*) FROM events GROUP BY kind'))
+        assert events.get('miss') == len(files), events
+        assert events.get('dedupe') == 1, events
+        genome = [os.path.join(cache, url_path(u)) for u in urls[:2]]
+        assert os.stat(genome[0]).st_ino == os.stat(genome[1]).st_ino, \
+            'Duplicate was not linked'
+        if events.get('hit', 0) != 2:
+            print('Warning: reads did not update access times here, so hits '
+                  'are not counted on this filesystem')
+
+        prune(db, cache, (args.kb << 10) + 1)
+        remaining = db.execute('SELECT COUNT(*) FROM objects').fetchone()[0]
+        assert remaining == 1, f'{remaining} objects left after eviction'
+        db.close()
+        report(argparse.Namespace(cache=cache, days=1, limit=5,
+                                  no_scan=True))
+        print('\nSelf-test passed')
+    finally:
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.strip().split('\n')[2:]))
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_scan = sub.add_parser('scan', help='Deduplicate, record hits and '
+                            'misses, and evict')
+    p_scan.add_argument('--max-size', metavar='SIZE',
+                        help='Evict least recently used files until the '
+                        'cache is at most this size, e.g. 2T')
+    p_scan.add_argument('--dry-run', action='store_true',
+                        help='Only list what would be evicted')
+    p_scan.set_defaults(func=scan)
+
+    p_report = sub.add_parser('report', help='Hit rate, downloads and '
+                              'space saved')
+    p_report.add_argument('--days', type=float, default=30,
+                          help='Period to report on (default: 30)')
+    p_report.add_argument('-n', '--limit', type=int, default=10,
+                          help='Most reused files to list (default: 10)')
+    p_report.add_argument('--no-scan', action='store_true',
+                          help='Report without scanning first')
+    p_report.set_defaults(func=report)
+
+    p_evict = sub.add_parser('evict', help='Remove files so they are '
+                             'downloaded again')
+    p_evict.add_argument('paths', nargs='+', metavar='URL',
+                         help='URL, or path relative to the cache')
+    p_evict.set_defaults(func=evict)
+
+    p_test = sub.add_parser('selftest', help='Test against a local HTTP '
+                            'server')
+    p_test.add_argument('--kb', type=int, default=256,
+                        help='Size of the largest test file in KiB '
+                        '(default: 256)')
+    p_test.set_defaults(func=selftest)
+
+    for p in [p_scan, p_report, p_evict]:
+        p.add_argument('--cache', default=STORAGE_CACHE,
+                       help=f'Cache directory (default: {STORAGE_CACHE})')
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except (AssertionError, OSError, subprocess.CalledProcessError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,153 @@
+"""
+Fixtures for the setup benchmarks in scripts/setup_bench.py.
+
+The benchmarks need pygit2 and pyyaml, which are in the py3.13 environment
+from setup.sh; without them the tests are skipped. The benchmarks themselves
+take a minute or more and only run with --bench (or --bench-update).
+"""
+
+import os
+import sys
+import types
+import shutil
+import tempfile
+
+import pytest
+
+pytest.importorskip('pygit2')
+pytest.importorskip('yaml')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'scripts'))
+import setup_bench  # noqa: E402
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('setup_bench', 'setup benchmarks')
+    group.addoption('--bench', action='store_true',
+                    help='Run the benchmarks, compared with the baseline')
+    group.addoption('--bench-dir', help='Directory for the temporary homes '
+                    '(default: the system temporary directory)')
+    group.addoption('--bench-repeat', type=int, default=5,
+                    help='Runs per operation (default: 5)')
+    group.addoption('--bench-baseline', default=setup_bench.FILE_BASELINE,
+                    help='Baseline file (default: '
+                    f'{setup_bench.FILE_BASELINE})')
+    group.addoption('--bench-threshold', type=float, default=1.5,
+                    help='Slowdown ratio that fails a test (default: 1.5)')
+    group.addoption('--bench-min-delta', type=float, default=0.005,
+                    help='Ignore slowdowns smaller than this many seconds '
+                    '(default: 0.005)')
+    group.addoption('--bench-update', action='store_true',
+                    help='Run the benchmarks and save the results as the new '
+                    'baseline')
+    group.addoption('--bench-budgets', action='store_true',
+                    help='Also fail operations over their fixed time budget, '
+                    'which only holds on an idle machine')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'bench: timing benchmark, skipped '
+                            'unless --bench or --bench-update is given')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('bench') or config.getoption('bench_update'):
+        return
+    skip = pytest.mark.skip(reason='benchmark, run with --bench')
+    for item in items:
+        if 'bench' in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture(scope='session')
+def bench_options(request):
+    """The --bench-* options without their prefix."""
+    return types.SimpleNamespace(**{
+        name: request.config.getoption(f'bench_{name}')
+        for name in ['dir', 'repeat', 'baseline', 'threshold', 'min_delta',
+                     'update', 'budgets']})
+
+
+@pytest.fixture(scope='session')
+def stub_cookiecutter():
+    """cookiecutter replaced by a stand-in that renders the LSF profile."""
+    saved = {k: v for k, v in sys.modules.items()
+             if k.split('.')[0] == 'cookiecutter'}
+    setup_bench.stub_cookiecutter()
+    yield sys.modules['cookiecutter']
+    for name in ['cookiecutter', 'cookiecutter.main', 'cookiecutter.generate']:
+        sys.modules.pop(name, None)
+    sys.modules.update(saved)
+
+
+@pytest.fixture(scope='session')
+def setup_modules(stub_cookiecutter):
+    """setup.py and setup_snakemake_profiles.py, imported as modules."""
+    os.environ.pop('LABOPS_TRACE', None)
+    return {'setup': setup_bench.load_script('labops_setup', 'setup.py'),
+            'profiles': setup_bench.load_script(
+                'snakeprofile', 'setup_snakemake_profiles.py')}
+
+
+@pytest.fixture
+def temp_home(bench_options, monkeypatch):
+    """
+    Factory for fresh temporary homes laid out like one after setup.sh.
+
+    Each call makes a new home below its own base directory and points HOME
+    at it. Everything is removed when the test ends.
+    """
+    made = []
+
+    def make():
+        base = tempfile.mkdtemp(prefix='setup_bench_', dir=bench_options.dir)
+        made.append(base)
+        home = setup_bench.make_home(base)
+        monkeypatch.setenv('HOME', home)
+        return home
+    yield make
+    for base in made:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+@pytest.fixture
+def bare_remote(tmp_path):
+    """Factory for local bare git remotes with nfiles files on main."""
+    def make(nfiles, path=None):
+        path = path or tempfile.mkdtemp(suffix='.git', dir=tmp_path)
+        return setup_bench.make_remote(path, nfiles)
+    return make
+
+
+@pytest.fixture
+def config_dir(tmp_path):
+    """Factory for directories of nfiles small config files."""
+    def make(nfiles, path=None):
+        path = path or os.path.join(tempfile.mkdtemp(dir=tmp_path),
+                                    'config_files')
+        return setup_bench.make_config_dir(path, nfiles)
+    return make
+
+
+@pytest.fixture
+def workspace(bench_options, setup_modules):
+    """Workspace factory for setup_bench.measure, as the runner uses."""
+    return setup_bench.temp_workspaces(setup_modules, bench_options.dir)
+
+
+@pytest.fixture(scope='session')
+def baseline(bench_options):
+    """
+    The saved results, and a dict collecting this session's results.
+
+    With --bench-update the collected results are saved as the new baseline
+    when the session ends.
+    """
+    results = {}
+    yield types.SimpleNamespace(
+        before=setup_bench.read_baseline(bench_options.baseline),
+        results=results)
+    if bench_options.update and results:
+        setup_bench.save_baseline(bench_options.baseline, bench_options.dir,
+                                  results)
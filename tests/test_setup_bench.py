@@ -0,0 +1,45 @@
+"""
+Timing regression tests for the setup.py helpers and profile installers.
+
+Each operation in setup_bench.BENCHMARKS is a test, run with --bench, that
+fails when its median time is more than --bench-threshold times the saved
+baseline, and with --bench-budgets also when over its fixed startup budget.
+See scripts/setup_bench.py for what is measured.
+"""
+
+import os
+
+import pytest
+
+import setup_bench
+
+
+def test_fixtures(temp_home, bare_remote, config_dir):
+    home = temp_home()
+    assert os.path.isdir(os.path.join(home, '.config', 'snakemake'))
+    repo = setup_bench.pygit2.Repository(bare_remote(150))
+    assert repo.is_bare
+    assert [e.name for e in repo.head.peel().tree] == ['dir0', 'dir1']
+    assert len(os.listdir(config_dir(20))) == 20
+
+
+@pytest.mark.bench
+@pytest.mark.parametrize('name', list(setup_bench.BENCHMARKS))
+def test_benchmark(name, workspace, baseline, bench_options):
+    if not (bench_options.update or name in baseline.before
+            or bench_options.budgets and name in setup_bench.BUDGETS):
+        pytest.skip(f'No baseline for {name}. Run with --bench-update to '
+                    'save one.')
+    seconds = setup_bench.measure(name, workspace, bench_options.repeat)
+    baseline.results[name] = seconds
+    if bench_options.budgets:
+        assert not setup_bench.over_budget(name, seconds), \
+            f'{name} took {seconds:.4f}s, over its startup budget of ' \
+            f'{setup_bench.BUDGETS[name]}s'
+    if bench_options.update or name not in baseline.before:
+        return
+    assert not setup_bench.regressed(name, seconds, baseline.before,
+                                     bench_options.threshold,
+                                     bench_options.min_delta), \
+        f'{name} took {seconds:.4f}s, {seconds / baseline.before[name]:.2f}x ' \
+        f'the baseline of {baseline.before[name]:.4f}s'